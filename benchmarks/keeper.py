@@ -0,0 +1,110 @@
+"""Keeper load test against the in-process fake Telegram backend.
+
+Usage: python -m benchmarks.keeper [--sessions N] [--concurrency N]
+                                  [--latency MIN MAX] [--flood-wait P]
+                                  [--output FILE]
+
+Starts a keeper over a synthetic storage, fetches the last message for
+every session with ``get_all`` and reports the time, throughput and errors
+as JSON.
+"""
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from collections import Counter
+
+from session_keeper import BaseKeeper, version
+from session_keeper.keeper.fake import FakeBackend
+from session_keeper.storage import EncryptedJsonStorage
+
+from .storage import make_sessions, PASSWORD
+
+
+class Keeper(BaseKeeper):
+    async def add(self) -> None:
+        pass
+
+    async def setup_storage(self) -> None:
+        pass
+
+    @classmethod
+    def run(cls) -> None:
+        pass
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Load test a keeper without '
+                                        'network access.')
+    parser.add_argument('--sessions',
+                        type=int, default=10_000,
+                        help='number of stored sessions')
+    parser.add_argument('--concurrency',
+                        type=int, default=256,
+                        help='clients connected at once')
+    parser.add_argument('--latency',
+                        type=float, nargs=2, default=(0.05, 0.2),
+                        metavar=('MIN', 'MAX'),
+                        help='seconds every request takes')
+    parser.add_argument('--flood-wait',
+                        type=float, default=0.001,
+                        help='chance of a request to fail with FloodWait')
+    parser.add_argument('--output',
+                        help='write JSON results to a file instead of stdout')
+    return parser.parse_args()
+
+
+async def load_test(args: Namespace, filename: str) -> dict:
+    storage = EncryptedJsonStorage(PASSWORD, filename=filename)
+    await storage.setup(1, 'hash')
+    storage._load(dict(enumerate(make_sessions(args.sessions))))
+    await storage.save()
+
+    backend = FakeBackend(latency=tuple(args.latency),
+                          flood_wait=args.flood_wait, seed=0)
+    keeper = Keeper()
+    start = time.perf_counter()
+    await keeper.start(PASSWORD, filename=filename,
+                       concurrency=args.concurrency,
+                       pool_size=args.sessions, client_factory=backend)
+    started = time.perf_counter() - start
+
+    errors = Counter()
+    start = time.perf_counter()
+    async for result in keeper.get_all():
+        if not result.ok:
+            error = result.error.__cause__ or result.error
+            errors[type(error).__name__] += 1
+    elapsed = time.perf_counter() - start
+    await keeper.stop()
+
+    return {'sessions': args.sessions, 'concurrency': args.concurrency,
+            'latency': args.latency, 'flood_wait': args.flood_wait,
+            'start': started, 'get_all': elapsed,
+            'sessions_per_second': args.sessions / elapsed,
+            'requests': backend.requests, 'errors': dict(errors)}
+
+
+def main() -> None:
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        result = asyncio.run(load_test(args,
+                                       os.path.join(directory, 'load.tgsk')))
+    report = {'version': version.__version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': [result]}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
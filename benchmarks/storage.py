@@ -0,0 +1,197 @@
+"""Offline storage benchmarks on synthetic sessions.
+
+Usage: python -m benchmarks.storage [--sizes N ...] [--repeat N]
+                                   [--output FILE]
+
+Every operation is timed ``--repeat`` times and the best time is reported,
+peak memory of Python allocations is measured with tracemalloc in one more
+run (memory taken by OpenSSL, e.g. for scrypt, is not seen). Storages are
+opened with the derived key, so no row but ``transform_password`` includes
+key derivation. Results are written as JSON, so runs of different releases
+can be compared.
+"""
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from typing import Awaitable, Callable, List, Optional, Union
+
+from session_keeper import CLIKeeper, version
+from session_keeper.session import KeeperSession
+from session_keeper.storage import (EncryptedJsonStorage, kdf, ShardedStorage,
+                                    SqliteStorage)
+
+
+SIZES = (10, 1_000, 100_000)
+REPEAT = 3
+PASSWORD = 'benchmark'
+
+
+Operation = Callable[[], Union[Awaitable, None]]
+
+
+def make_sessions(count: int) -> List[KeeperSession]:
+    return [KeeperSession(id=user_id, phone=f'+7999{user_id:07d}',
+                          mention=f'@user{user_id}', dc_id=2,
+                          server_address='149.154.167.40', port=443,
+                          auth_key=os.urandom(256))
+            for user_id in range(count)]
+
+
+def run(loop: asyncio.AbstractEventLoop, operation: Operation) -> None:
+    result = operation()
+    if asyncio.iscoroutine(result):
+        loop.run_until_complete(result)
+
+
+def measure(loop: asyncio.AbstractEventLoop, name: str, sessions: int,
+            operation: Operation, repeat: int,
+            setup: Optional[Callable[[], None]] = None) -> dict:
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        run(loop, operation)
+        times.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        run(loop, operation)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result = {'name': name, 'sessions': sessions, 'best': min(times),
+              'mean': sum(times) / len(times), 'peak_memory': peak}
+    print(f'{name:<20} {sessions:>7} sessions  {min(times) * 1000:9.1f} ms  '
+          f'{peak / 2 ** 20:8.1f} MiB', file=sys.stderr)
+    return result
+
+
+def bench_size(loop: asyncio.AbstractEventLoop, directory: str, count: int,
+               repeat: int) -> List[dict]:
+    filename = os.path.join(directory, f'{count}.tgsk')
+    storage = EncryptedJsonStorage(PASSWORD, filename=filename)
+    loop.run_until_complete(storage.setup(1, 'hash'))
+    storage._load(dict(enumerate(make_sessions(count))))
+    key = storage.transform_password(PASSWORD, storage.kdf_header)
+
+    results = [
+        measure(loop, 'save', count, storage.save, repeat),
+        measure(loop, '_encrypt_sessions', count, storage._encrypt_sessions,
+                repeat)
+    ]
+
+    with open(filename, 'rb') as file:
+        data = memoryview(file.read())
+    header, body = storage._split_header(data[1:])
+    loaded = None
+
+    def fresh_storage() -> None:
+        nonlocal loaded
+        loaded = EncryptedJsonStorage(key, filename=filename)
+        loaded._header = header
+
+    results.append(measure(loop, '_decrypt_sessions', count,
+                           lambda: loaded._decrypt_sessions(body), repeat,
+                           fresh_storage))
+    results.append(measure(loop, 'start', count, lambda: loaded.start(),
+                           repeat, fresh_storage))
+
+    sharded = ShardedStorage(key, filename=filename + '.sharded')
+    sharded._api_id, sharded._api_hash = storage.api_id, storage.api_hash
+    sharded._header = storage.kdf_header
+    sharded._load(dict(enumerate(loaded.sessions)))
+    results.append(measure(loop, 'ShardedStorage.save', count,
+                           sharded.save, repeat,
+                           lambda: setattr(sharded, '_rewrite', True)))
+    results.append(measure(loop, 'ShardedStorage.start', count,
+                           lambda: ShardedStorage(
+                               key, filename=sharded.filename
+                           ).start(), repeat))
+
+    database = SqliteStorage(key, filename=filename + '.db')
+
+    def remove_database() -> None:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(database.filename + suffix):
+                os.unlink(database.filename + suffix)
+
+    async def migrate() -> None:
+        await database.migrate(filename)
+        await database.stop()
+
+    results.append(measure(loop, 'SqliteStorage.migrate', count, migrate,
+                           repeat, remove_database))
+
+    async def get_session() -> None:
+        async with SqliteStorage(key, filename=database.filename) as storage:
+            storage.get_session(f'@user{count - 1}')
+
+    results.append(measure(loop, 'SqliteStorage.get', count, get_session,
+                           repeat))
+
+    keeper = CLIKeeper()
+    keeper._storage = loaded
+
+    async def render_list() -> None:
+        with contextlib.redirect_stdout(io.StringIO()):
+            await keeper.list()
+
+    results.append(measure(loop, 'CLIKeeper.list', count, render_list,
+                           repeat))
+    return results
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark the sessions storage '
+                                        'without network access.')
+    parser.add_argument('--sizes',
+                        type=int, nargs='+', default=SIZES,
+                        help='numbers of sessions to benchmark')
+    parser.add_argument('--repeat',
+                        type=int, default=REPEAT,
+                        help='timed runs of every operation')
+    parser.add_argument('--output',
+                        help='write JSON results to a file instead of stdout')
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    loop = asyncio.new_event_loop()
+    header = kdf.new_header()
+    results = [measure(loop, 'transform_password', 0,
+                       lambda: EncryptedJsonStorage.transform_password(
+                           PASSWORD, header
+                       ), args.repeat)]
+    with tempfile.TemporaryDirectory() as directory:
+        for count in args.sizes:
+            results.extend(bench_size(loop, directory, count, args.repeat))
+    loop.close()
+
+    report = {'version': version.__version__,
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'kdf': kdf.cost(header),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,20 @@
 from . import version
 from .cli import main
-from .keeper import BaseKeeper, CLIKeeper
-from .storage import AbstractStorage, EncryptedJsonStorage
+from .storage import (AbstractStorage, EncryptedJsonStorage, ShardedStorage,
+                      SqliteStorage)
 
 
 __all__ = ('BaseKeeper', 'CLIKeeper',
-           'AbstractStorage', 'EncryptedJsonStorage',
+           'AbstractStorage', 'EncryptedJsonStorage', 'ShardedStorage',
+           'SqliteStorage',
            'main')
 __version__ = version.__version__
+
+
+def __getattr__(name: str):
+    # Keepers import Telethon, see session_keeper.keeper.
+    if name in ('BaseKeeper', 'CLIKeeper'):
+        from . import keeper
+
+        return getattr(keeper, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,5 +1,11 @@
-from .keeper import CLIKeeper
+from .keeper.args import answer_password, parse_args
 
 
 def main():
-    CLIKeeper.run()
+    args = parse_args()
+    password = answer_password()
+    # Importing Telethon takes most of the startup time, so it is deferred
+    # until the arguments are valid and the password is entered.
+    from .keeper import CLIKeeper
+
+    CLIKeeper.run(args, password)
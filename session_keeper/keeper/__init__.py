@@ -1,6 +1,20 @@
-from .base import BaseKeeper
-from .cli import CLIKeeper
+from importlib import import_module
 
+from .agent import AgentClient, KeeperAgent
+from .batch import BatchResult
+from .exceptions import AgentError, ClientUnavailable, SessionUnauthorized
 
-__all__ = ('BaseKeeper', 'CLIKeeper')
+
+__all__ = ('BaseKeeper', 'CLIKeeper', 'KeeperAgent', 'AgentClient',
+           'BatchResult', 'AgentError', 'ClientUnavailable',
+           'SessionUnauthorized')
 # TODO: gui keeper class
+
+# These pull in Telethon, so they are imported on first access.
+_LAZY = {'BaseKeeper': '.base', 'CLIKeeper': '.cli'}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(import_module(_LAZY[name], __name__), name)
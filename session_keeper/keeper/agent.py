@@ -0,0 +1,258 @@
+"""A long-running keeper serving other programs over a Unix socket, so they
+share its unlocked storage and connected clients.
+
+The protocol is JSON lines. A request is an object with ``command``
+(``list``, ``get`` or ``remove``), ``session`` for ``get`` and ``sessions``
+for ``remove``, given like in the CLI: a list number, a phone (``+...``),
+a mention (``@...``) or ``id:<Telegram ID>``. An ``id`` is copied to the
+response, which has ``ok`` and either the result or an ``error``::
+
+    > {"id": 1, "command": "get", "session": "@username"}
+    < {"id": 1, "ok": true, "message": "Login code: 12345.", "date": "..."}
+"""
+import asyncio
+import json
+import os
+import stat
+from functools import partial
+from typing import (Any, Dict, List, Optional, Set, Tuple, TYPE_CHECKING,
+                    Union)
+
+from .exceptions import AgentError
+
+if TYPE_CHECKING:
+    from telethon.tl.types import Message
+
+    from .base import BaseKeeper
+    from ..session import Session
+
+
+__all__ = ('AgentClient', 'KeeperAgent')
+
+
+CACHE_TTL = 1.0
+
+Key = Union[int, str]
+
+
+class KeeperAgent:
+    """Serves ``list``, ``get`` and ``remove`` of a started keeper on a Unix
+    socket only its owner may connect to.
+
+    Concurrent ``get`` requests for a session share one call to the keeper,
+    and the message is served from memory for ``cache_ttl`` seconds after
+    it, unless a newer one arrives as an update meanwhile.
+    """
+
+    def __init__(self, keeper: 'BaseKeeper', *,
+                 cache_ttl: float = CACHE_TTL):
+        self._keeper = keeper
+        self._cache_ttl = cache_ttl
+        self._fetching: Dict['Session', asyncio.Future] = {}
+        self._cache: Dict['Session', Tuple[float, 'Message']] = {}
+        self._connections: Set[asyncio.Task] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._path: Optional[str] = None
+
+    @property
+    def path(self) -> Optional[str]:
+        return self._path
+
+    async def get(self, key: Key) -> 'Message':
+        session = self._keeper.get_session(key)
+        cached = self._cache.get(session)
+        if cached is not None:
+            expires, message = cached
+            if expires > asyncio.get_event_loop().time():
+                latest = self._keeper.latest_message(session)
+                if latest is not None and latest.id > message.id:
+                    return latest
+                return message
+        future = self._fetching.get(session)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._keeper.get_message(session)
+            )
+            self._fetching[session] = future
+            future.add_done_callback(partial(self._fetched, session))
+        # A consumer going away must not cancel the call for the others.
+        return await asyncio.shield(future)
+
+    def _fetched(self, session: 'Session', future: asyncio.Future) -> None:
+        del self._fetching[session]
+        if not future.cancelled() and future.exception() is None:
+            expires = asyncio.get_event_loop().time() + self._cache_ttl
+            self._cache[session] = expires, future.result()
+
+    async def _list(self, request: dict) -> dict:
+        sessions = await self._keeper.list()
+        return {'sessions': [self._keeper.session_json(number, session)
+                             for number, session in enumerate(sessions)]}
+
+    async def _get(self, request: dict) -> dict:
+        message = await self.get(_key(request.get('session')))
+        return {'message': message.message,
+                'date': message.date.isoformat()}
+
+    async def _remove(self, request: dict) -> dict:
+        keys = request.get('sessions')
+        if not isinstance(keys, list):
+            raise AgentError('sessions must be a list.')
+        results = await self._keeper.remove_sessions(map(_key, keys))
+        removed = []
+        for result in results:
+            self._cache.pop(result.session, None)
+            data = {'id': result.session.info.id, 'logged_out': result.ok}
+            if not result.ok:
+                data['error'] = (f'{type(result.error).__name__} '
+                                 f'{result.error}')
+            removed.append(data)
+        return {'removed': removed}
+
+    async def _handle(self, line: bytes) -> dict:
+        response: Dict[str, Any] = {}
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise AgentError('A request must be an object.')
+            if 'id' in request:
+                response['id'] = request['id']
+            command = request.get('command')
+            handler = {'list': self._list, 'get': self._get,
+                       'remove': self._remove}.get(command)
+            if handler is None:
+                raise AgentError(f'Unknown command {command!r}.')
+            with self._keeper.metrics.timer(f'agent_{command}'):
+                result = await handler(request)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            response.update(ok=False, error=f'{type(e).__name__} {e}')
+        else:
+            response.update(ok=True, **result)
+        return response
+
+    async def _serve(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            # Requests of a connection are answered in order, consumers
+            # open more connections to wait for several at once.
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self._handle(line)
+                writer.write(json.dumps(response, ensure_ascii=False)
+                             .encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            # Gone, or sent a line over the limit of the reader.
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def start(self, path: str) -> None:
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise AgentError(f'{path} exists and is not a socket.')
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+            except ConnectionError:
+                # Left by an agent which did not stop cleanly.
+                os.unlink(path)
+            else:
+                writer.close()
+                raise AgentError(f'An agent is already running on {path}.')
+        # The socket gives out auth keys' worth of access, only the owner
+        # may connect.
+        umask = os.umask(0o177)
+        try:
+            self._server = await asyncio.start_unix_server(self._serve, path)
+        finally:
+            os.umask(umask)
+        self._path = path
+
+    async def close(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+
+def _key(key: Any) -> Key:
+    if isinstance(key, bool) or not isinstance(key, (int, str)):
+        raise AgentError(f'Invalid session {key!r}.')
+    return key
+
+
+class AgentClient:
+    """Sends requests to a ``KeeperAgent``, for scripts::
+
+        async with AgentClient('keeper.sock') as agent:
+            message = await agent.get('@username')
+
+    Requests on one client are sent one at a time. Failed ones raise
+    ``AgentError``.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._id = 0
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_unix_connection(
+            self._path
+        )
+        self._lock = asyncio.Lock()
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def __aenter__(self) -> 'AgentClient':
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def request(self, command: str, **params: Any) -> dict:
+        async with self._lock:
+            self._id += 1
+            data = {'id': self._id, 'command': command, **params}
+            self._writer.write(json.dumps(data).encode() + b'\n')
+            await self._writer.drain()
+            line = await self._reader.readline()
+        if not line:
+            raise AgentError('The agent closed the connection.')
+        response = json.loads(line)
+        if not response.pop('ok'):
+            raise AgentError(response['error'])
+        del response['id']
+        return response
+
+    async def list(self) -> List[dict]:
+        return (await self.request('list'))['sessions']
+
+    async def get(self, key: Key) -> dict:
+        """The last message from Telegram, with ``message`` and
+        ``date``."""
+        return await self.request('get', session=key)
+
+    async def remove(self, *keys: Key) -> List[dict]:
+        return (await self.request('remove', sessions=list(keys)))['removed']
@@ -0,0 +1,120 @@
+import getpass
+import os
+from argparse import ArgumentParser, Namespace
+from typing import List, Optional
+
+from .health import HEALTH_INTERVAL, PROBE_RATE
+from .pool import IDLE_TIMEOUT, POOL_SIZE
+from .utils import CLIENT_TIMEOUT, CONCURRENCY
+
+
+__all__ = ('answer_password', 'parse_args')
+
+
+PASSWORD_ENV = 'SESSION_KEEPER_PASSWORD'
+COMMANDS = ('list', 'get', 'get-all', 'watch', 'remove', 'import', 'export')
+
+
+def answer_password() -> str:
+    password = os.environ.get(PASSWORD_ENV)
+    if password is not None:
+        return password
+    return getpass.getpass('Please enter a password to access sessions: ')
+
+
+def parse_args(args: Optional[List[str]] = None) -> Namespace:
+    parser = ArgumentParser(
+        epilog='Without a command an interactive shell is started. '
+               f'The password is read from ${PASSWORD_ENV} if set.'
+    )
+    parser.add_argument('command',
+                        nargs='?', choices=COMMANDS,
+                        help='run a single command and exit')
+    parser.add_argument('sessions',
+                        nargs='*', metavar='SESSION',
+                        help='a number from the list, a phone (+...), '
+                             'a mention (@...) or id:<Telegram ID>, paths '
+                             'for import and export')
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='print results of a command as JSON')
+    parser.add_argument('--filename',
+                        type=str, required=False,
+                        help='path to a sessions file')
+    parser.add_argument('--shards',
+                        type=int, metavar='N',
+                        help='keep sessions in N files which are decrypted '
+                             'in parallel, for large storages')
+    parser.add_argument('--sqlite',
+                        action='store_true',
+                        help='keep sessions in an SQLite database')
+    parser.add_argument('--migrate',
+                        metavar='FILE',
+                        help='create the SQLite database from a sessions '
+                             'file, implies --sqlite')
+    parser.add_argument('--agent',
+                        metavar='SOCKET',
+                        help='keep running and serve list, get and remove '
+                             'as JSON lines on the Unix socket SOCKET')
+    parser.add_argument('--test',
+                        action='store_true',
+                        help='run keeper on test Telegram server')
+    parser.add_argument('--concurrency',
+                        type=int, default=CONCURRENCY,
+                        help='how many clients to connect at once')
+    parser.add_argument('--timeout',
+                        type=float, default=CLIENT_TIMEOUT,
+                        help='seconds to wait for a single client')
+    parser.add_argument('--pool-size',
+                        type=int, default=POOL_SIZE,
+                        help='how many clients to keep connected')
+    parser.add_argument('--idle-timeout',
+                        type=float, default=IDLE_TIMEOUT,
+                        help='seconds before an unused client is '
+                             'disconnected')
+    parser.add_argument('--trust-sessions',
+                        action='store_true',
+                        help='connect clients without checking authorization '
+                             'first, revoked sessions are detected in the '
+                             'background')
+    parser.add_argument('--health-interval',
+                        type=float, default=HEALTH_INTERVAL,
+                        metavar='SECONDS',
+                        help='check every session in the background about '
+                             'every SECONDS in the interactive shell, 0 '
+                             'disables checks')
+    parser.add_argument('--probe-rate',
+                        type=float, default=PROBE_RATE,
+                        help='how many background checks to start per '
+                             'second at most')
+    parser.add_argument('--calibrate',
+                        type=float, metavar='SECONDS',
+                        help='re-encrypt sessions with a key derivation '
+                             'cost that takes SECONDS to unlock on this '
+                             'machine')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='print how long every phase took on exit')
+    parser.add_argument('--metrics',
+                        metavar='FILE',
+                        help='write phase timings to FILE, in the Prometheus '
+                             'text format for *.prom files and as JSON '
+                             'otherwise')
+    args = parser.parse_args(args)
+    if args.command == 'get' and len(args.sessions) != 1:
+        parser.error('get needs exactly one SESSION')
+    if args.command == 'list' and args.sessions:
+        parser.error('list takes no SESSION')
+    if args.command == 'remove' and not args.sessions:
+        parser.error('remove needs at least one SESSION')
+    if args.command == 'import' and not args.sessions:
+        parser.error('import needs at least one PATH')
+    if args.command == 'export' and len(args.sessions) != 1:
+        parser.error('export needs exactly one PATH')
+    if args.probe_rate <= 0:
+        parser.error('--probe-rate must be positive')
+    if args.agent and args.command:
+        parser.error('--agent runs no command')
+    if args.shards and (args.sqlite or args.migrate):
+        parser.error('--shards can not be used with SQLite')
+    return args
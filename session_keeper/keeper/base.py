@@ -1,9 +1,22 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import List, Optional
+from datetime import datetime, timezone
+from functools import partial
+from typing import (AsyncIterator, Awaitable, Callable, Dict, Iterable, List,
+                    Optional, Set, Tuple, Union)
 
-from telethon import TelegramClient
-from telethon.tl.types import Message
+from telethon import errors, events, TelegramClient
+from telethon.tl.types import Message, User
 
+from . import exceptions as exc
+from .batch import BatchResult, run_batch
+from .cache import MessageCache
+from .health import Health, HealthChecker, PROBE_CONCURRENCY, PROBE_RATE
+from .pool import ClientPool, IDLE_TIMEOUT, POOL_SIZE
+from .transfer import (DUPLICATE, FAILED, IMPORTED, ImportResult, new_session,
+                       Source)
+from .utils import CLIENT_TIMEOUT, CONCURRENCY
+from ..metrics import Metrics, NULL_METRICS
 from ..session import Session
 from ..storage import AbstractStorage, EncryptedJsonStorage, StorageNotFound
 
@@ -11,13 +24,32 @@ from ..storage import AbstractStorage, EncryptedJsonStorage, StorageNotFound
 __all__ = ('BaseKeeper',)
 
 
+ID_PREFIX = 'id:'
+TELEGRAM_ID = 777000
+
+
 class BaseKeeper(ABC):
     _storage: AbstractStorage
-    _clients: List[TelegramClient]
+    _pool: ClientPool
+    _failures: Dict[Session, BaseException]
+    _revoked: Set[Session]
+    _removing: Set[Session]
+    _tasks: Set[asyncio.Future]
+    _health: Optional[HealthChecker]
     _test_mode: bool
+    _client_factory: Callable[..., TelegramClient]
 
     def __init__(self):
-        self._clients = []
+        self._failures = {}
+        self._revoked = set()
+        self._removing = set()
+        self._tasks = set()
+        self._health = None
+        self._trust_sessions = False
+        self._messages = MessageCache()
+        self._metrics = NULL_METRICS
+        self._client_timeout = CLIENT_TIMEOUT
+        self._concurrency = CONCURRENCY
         self._started = False
 
     @property
@@ -28,56 +60,472 @@ class BaseKeeper(ABC):
     def test_mode(self) -> bool:
         return self._test_mode
 
+    @property
+    def failures(self) -> Dict[Session, BaseException]:
+        return self._failures
+
+    @property
+    def revoked(self) -> Set[Session]:
+        """Sessions found to be logged out on the Telegram side."""
+        return self._revoked
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._metrics
+
+    def health(self, session: Session) -> Optional[Health]:
+        """The last background check of the session, if any."""
+        if self._health is None:
+            return None
+        return self._health.get(session)
+
+    def status(self, session: Session) -> Optional[str]:
+        """``revoked``, ``unavailable`` if the last connection failed, or
+        the status of the last background check."""
+        if session in self._revoked:
+            return 'revoked'
+        if session in self._failures:
+            return 'unavailable'
+        health = self.health(session)
+        return health.status if health else None
+
+    def checked(self, session: Session) -> Optional[datetime]:
+        """The time of the last background check of the session, in
+        UTC."""
+        health = self.health(session)
+        if health is None:
+            return None
+        return datetime.fromtimestamp(health.checked, timezone.utc)
+
+    def session_json(self, number: int, session: Session) -> dict:
+        """The session as JSON, with its list ``number``."""
+        info = session.info
+        checked = self.checked(session)
+        return {'number': number, 'id': info.id, 'phone': info.phone,
+                'mention': info.mention, 'status': self.status(session),
+                'checked': checked and checked.isoformat()}
+
     # TODO: implement this method with custom login instead telethon start
     @abstractmethod
     async def add(self) -> None:
         pass
 
-    async def remove(self, number: int) -> None:
-        client = self._clients.pop(number)
-        await self._storage.remove_session(number)
-        await client.log_out()
+    def get_session(self, key: Union[int, str]) -> Session:
+        """Resolves a list number, ``id:<Telegram ID>``, phone (``+...``)
+        or mention to a stored session."""
+        if isinstance(key, int):
+            return self._storage.sessions[key]
+        if key.startswith(ID_PREFIX):
+            return self._storage.get_session(int(key[len(ID_PREFIX):]))
+        return self._storage.get_session(key)
+
+    async def remove(self, key: Union[int, str]) -> Optional[BatchResult]:
+        """Logs out and removes a single session, see
+        ``remove_sessions``."""
+        results = await self.remove_sessions([key])
+        return results[0] if results else None
+
+    async def remove_sessions(
+            self, keys: Iterable[Union[int, str]], *,
+            concurrency: Optional[int] = None
+    ) -> List[BatchResult]:
+        """Logs out the sessions given by ``keys`` at once, at most
+        ``concurrency`` at a time, and then removes them from the storage
+        with a single write.
+
+        Keys are resolved before anything changes, so list numbers refer to
+        the list as it was. Sessions are removed even if their log out
+        failed, the results with an error tell which ones may still be
+        authorized in Telegram. Sessions which another call is removing
+        already are skipped, that call reports them.
+        """
+        sessions = [session for session in dict.fromkeys(
+            self.get_session(key) for key in keys
+        ) if session not in self._removing]
+        self._removing.update(sessions)
+        try:
+            results = [result async for result in run_batch(
+                sessions, self._log_out, concurrency or self._concurrency
+            )]
+            await self._storage.remove_sessions(sessions)
+        finally:
+            self._removing.difference_update(sessions)
+        for session in sessions:
+            self._failures.pop(session, None)
+            self._revoked.discard(session)
+            if self._health is not None:
+                self._health.discard(session)
+            # A client connected by a get meanwhile.
+            client = self._pool.discard(session)
+            if client is not None:
+                await self._disconnect_client(client)
+        return results
+
+    async def _log_out(self, session: Session) -> None:
+        if session in self._revoked:
+            # Telegram has already dropped the authorization.
+            return
+        # The pooled client is taken over, others get a client of their
+        # own, so the pool does not churn.
+        client = self._pool.discard(session)
+        if client is None:
+            client = self._client_factory(session, self._storage.api_id,
+                                          self._storage.api_hash)
+        try:
+            with self._metrics.timer('client_log_out'):
+                await asyncio.wait_for(self._connect_and_log_out(client),
+                                       self._client_timeout)
+        finally:
+            await self._disconnect_client(client)
+
+    @staticmethod
+    async def _connect_and_log_out(client: TelegramClient) -> None:
+        if not client.is_connected():
+            await client.connect()
+        if not await client.log_out():
+            raise exc.ClientUnavailable('Telegram refused to log out the '
+                                        'session.')
 
     async def list(self) -> List[Session]:
+        await self._storage.load_sessions()
         return self._storage.sessions
 
-    async def get(self, number: int) -> Message:
-        client = self._clients[number]
-        return (await client.get_messages(777000))[0]
+    def latest_message(self, session: Session) -> Optional[Message]:
+        """The last message from Telegram the client of the session got,
+        if it is connected, without a request."""
+        return self._messages.latest(session)
+
+    async def get_message(self, session: Session) -> Message:
+        """Like ``get``, for a session already resolved."""
+        with self._metrics.timer('get'):
+            async with self._pool.client(session) as client:
+                # A connected client gets new messages as updates, so only
+                # the first get after connecting needs a request.
+                message = self._messages.latest(session)
+                if message is None:
+                    try:
+                        with self._metrics.timer('client_get_messages'):
+                            messages = await client.get_messages(TELEGRAM_ID)
+                    except errors.UnauthorizedError as e:
+                        await self._revoke(session, e)
+                        raise exc.ClientUnavailable(
+                            f'Session is unavailable: {type(e).__name__} {e}'
+                        ) from e
+                    message = messages[0]
+                    self._messages.put(session, message, notify=False)
+                return message
+
+    async def get(self, key: Union[int, str]) -> Message:
+        return await self.get_message(self.get_session(key))
+
+    async def get_all(
+            self, keys: Optional[Iterable[Union[int, str]]] = None, *,
+            concurrency: Optional[int] = None
+    ) -> AsyncIterator[BatchResult]:
+        """Fetches the last message from Telegram for every session, or the
+        ones given by ``keys``, and yields results as they arrive."""
+        sessions = await self._get_sessions(keys)
+        async for result in run_batch(sessions, self.get_message,
+                                      concurrency or self._concurrency):
+            yield result
+
+    async def _get_sessions(
+            self, keys: Optional[Iterable[Union[int, str]]]
+    ) -> List[Session]:
+        if keys is None:
+            return list(await self.list())
+        return [self.get_session(key) for key in keys]
+
+    async def watch(
+            self, keys: Optional[Iterable[Union[int, str]]] = None
+    ) -> AsyncIterator[Tuple[Session, Message]]:
+        """Yields new messages from Telegram for every session, or the ones
+        given by ``keys``, as they arrive.
+
+        The watched sessions stay connected until the iteration stops,
+        sessions which fail to connect are left out (see ``failures``).
+        """
+        sessions = await self._get_sessions(keys)
+        queue = self._messages.subscribe()
+        acquired = []
+        try:
+            async for result in run_batch(sessions, self._pool.acquire,
+                                          self._concurrency):
+                if result.ok:
+                    acquired.append(result.session)
+            watched = set(acquired)
+            while True:
+                session, message = await queue.get()
+                if session in watched:
+                    yield session, message
+        finally:
+            self._messages.unsubscribe(queue)
+            for session in acquired:
+                self._pool.release(session)
+
+    async def import_sessions(
+            self, sources: Iterable[Source], *,
+            concurrency: Optional[int] = None
+    ) -> AsyncIterator[ImportResult]:
+        """Checks the sessions of ``sources`` (see ``transfer``) with Telegram
+        and yields a result for each as they complete. Sessions of accounts
+        which are stored or met before are duplicates. The new sessions are
+        stored together, with a single write, after the last result or
+        when the iteration stops."""
+        auth_keys: Set[bytes] = set()
+        ids: Set[int] = set()
+        imported: List[Session] = []
+
+        async def validate(source: Source) -> ImportResult:
+            name, load = source
+            session = load()
+            if session.auth_key.key in auth_keys:
+                return ImportResult(name, DUPLICATE)
+            auth_keys.add(session.auth_key.key)
+            me = await self._get_me(session)
+            try:
+                self._storage.get_session(me.id)
+            except LookupError:
+                pass
+            else:
+                return ImportResult(name, DUPLICATE)
+            if me.id in ids:
+                return ImportResult(name, DUPLICATE)
+            ids.add(me.id)
+            # A fresh session keeps only the account among its entities.
+            session = new_session(session.dc_id, session.server_address,
+                                  session.port, session.auth_key.key)
+            session.process_entities([me])
+            imported.append(session)
+            return ImportResult(name, IMPORTED, session)
+
+        try:
+            async for result in run_batch(sources, validate,
+                                          concurrency or self._concurrency):
+                if result.ok:
+                    yield result.result
+                else:
+                    # The source stands in for the session here.
+                    yield ImportResult(result.session[0], FAILED,
+                                       error=result.error)
+        finally:
+            # Sessions reported as imported are kept when the sources fail
+            # or the caller stops early.
+            if imported:
+                await self._storage.add_sessions(imported)
+
+    async def _get_me(self, session: Session,
+                      phase: str = 'client_import') -> User:
+        """Checks a session with a client of its own, which does not take
+        a place in the pool."""
+        client = self._client_factory(session, self._storage.api_id,
+                                      self._storage.api_hash)
+        try:
+            with self._metrics.timer(phase):
+                return await asyncio.wait_for(self._authorize_client(client),
+                                              self._client_timeout)
+        finally:
+            await client.disconnect()
+
+    async def _probe(self, session: Session) -> None:
+        # A connected client is reused, others are not pulled into the
+        # pool, so probes do not evict clients in use.
+        try:
+            if session in self._pool:
+                async with self._pool.client(session) as client:
+                    with self._metrics.timer('health_probe'):
+                        me = await asyncio.wait_for(client.get_me(),
+                                                    self._client_timeout)
+                if me is None:
+                    raise exc.SessionUnauthorized(
+                        'The session is not authorized.'
+                    )
+            else:
+                await self._get_me(session, 'health_probe')
+        except errors.UnauthorizedError as e:
+            error = exc.SessionUnauthorized(f'{type(e).__name__} {e}')
+            await self._revoke(session, error)
+            raise error from e
+        except exc.SessionUnauthorized as e:
+            await self._revoke(session, e)
+            raise
+
+    async def _on_message(self, session: Session,
+                          event: events.NewMessage.Event) -> None:
+        self._messages.put(session, event.message)
 
     @abstractmethod
     async def setup_storage(self) -> None:
         pass
 
+    async def _connect_client(self, session: Session) -> TelegramClient:
+        client = self._client_factory(session, self._storage.api_id,
+                                      self._storage.api_hash)
+        if self._trust_sessions:
+            connect = client.connect()
+        else:
+            connect = self._authorize_client(client)
+        try:
+            with self._metrics.timer('client_connect'):
+                await asyncio.wait_for(connect, self._client_timeout)
+        except asyncio.CancelledError:
+            # Not a failure of the session, an Exception before Python 3.8.
+            await self._disconnect_client(client)
+            raise
+        except Exception as e:
+            self._failures[session] = e
+            if isinstance(e, exc.SessionUnauthorized):
+                self._revoked.add(session)
+            await self._disconnect_client(client)
+            raise exc.ClientUnavailable(
+                f'Session is unavailable: {type(e).__name__} {e}'
+            ) from e
+        self._failures.pop(session, None)
+        self._subscribe(session, client)
+        if self._trust_sessions:
+            self._spawn(self._validate_client(session, client))
+        return client
+
+    def _spawn(self, aw: Awaitable) -> None:
+        task = asyncio.ensure_future(aw)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _validate_client(self, session: Session,
+                               client: TelegramClient) -> None:
+        try:
+            with self._metrics.timer('client_validate'):
+                me = await asyncio.wait_for(client.get_me(),
+                                            self._client_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Unknown yet, the next request will tell.
+            return
+        if me is None:
+            await self._revoke(session, exc.SessionUnauthorized(
+                'The session is not authorized.'
+            ))
+
+    async def _revoke(self, session: Session, error: BaseException) -> None:
+        """Flags a session whose auth key Telegram no longer accepts and
+        drops its client."""
+        self._failures[session] = error
+        self._revoked.add(session)
+        client = self._pool.discard(session)
+        if client is not None:
+            await self._disconnect_client(client)
+
+    def _subscribe(self, session: Session, client: TelegramClient) -> None:
+        client.add_event_handler(
+            partial(self._on_message, session),
+            events.NewMessage(incoming=True,
+                              func=lambda e: e.chat_id == TELEGRAM_ID)
+        )
+
+    def _put_client(self, client: TelegramClient) -> None:
+        """Hands an already authorized client over to the pool."""
+        self._subscribe(client.session, client)
+        self._pool.put(client.session, client)
+
+    @staticmethod
+    async def _authorize_client(client: TelegramClient) -> User:
+        # Unlike client.start() this never falls back to the interactive
+        # login flow, so a revoked session fails instead of prompting.
+        await client.connect()
+        me = await client.get_me()
+        if me is None:
+            raise exc.SessionUnauthorized('The session is not authorized.')
+        return me
+
+    async def _disconnect_client(self, client: TelegramClient) -> None:
+        # Without updates the cached messages would go stale.
+        self._messages.discard(client.session)
+        try:
+            with self._metrics.timer('client_disconnect'):
+                await asyncio.wait_for(client.disconnect(),
+                                       self._client_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._failures[client.session] = e
+
     async def start(
             self, password: str, *,
             test_mode: bool = False,
-            filename: Optional[str] = None
+            filename: Optional[str] = None,
+            concurrency: int = CONCURRENCY,
+            client_timeout: float = CLIENT_TIMEOUT,
+            pool_size: int = POOL_SIZE,
+            idle_timeout: float = IDLE_TIMEOUT,
+            kdf_cost: Optional[dict] = None,
+            client_factory: Optional[Callable[..., TelegramClient]] = None,
+            metrics: Optional[Metrics] = None,
+            trust_sessions: bool = False,
+            storage_factory: Optional[Callable[..., AbstractStorage]] = None,
+            health_interval: Optional[float] = None,
+            probe_rate: float = PROBE_RATE,
+            probe_concurrency: int = PROBE_CONCURRENCY
     ) -> None:
+        """``client_factory`` is called like ``TelegramClient`` to create
+        clients for stored sessions, e.g. a ``fake.FakeBackend``, and
+        ``storage_factory`` like ``EncryptedJsonStorage`` to create the
+        storage. Phases are timed into ``metrics`` if given.
+
+        With ``trust_sessions`` clients only connect and the stored user
+        info is trusted, authorization is checked in the background and
+        revoked sessions end up in ``revoked``.
+
+        With ``health_interval`` every session is probed in the background
+        about that often, at most ``probe_rate`` probes per second and
+        ``probe_concurrency`` at once (see ``health.HealthChecker``), and
+        the results are given by ``health``.
+        """
         self._test_mode = test_mode
-        kwargs = {'password': password}
+        self._trust_sessions = trust_sessions
+        self._client_factory = client_factory or TelegramClient
+        self._client_timeout = client_timeout
+        self._concurrency = concurrency
+        if metrics is not None:
+            self._metrics = metrics
+        kwargs = {'password': password, 'kdf_cost': kdf_cost,
+                  'metrics': self._metrics}
         if filename:
             kwargs.update({'filename': filename})
-        storage = None
-        while not storage:
-            self._storage = storage = EncryptedJsonStorage(**kwargs)
-            try:
-                await storage.start()
-            except StorageNotFound:
-                await self.setup_storage()
-                storage = None
+        self._storage = storage = (storage_factory
+                                   or EncryptedJsonStorage)(**kwargs)
+        try:
+            await storage.start()
+        except StorageNotFound:
+            # A storage is ready once set up, so the key is derived once.
+            await self.setup_storage()
 
-        for session in storage.sessions:
-            client = TelegramClient(session, storage.api_id, storage.api_hash)
-            await client.start()
-            self._clients.append(client)
+        self._failures.clear()
+        self._revoked.clear()
+        self._pool = ClientPool(self._connect_client, self._disconnect_client,
+                                max_size=pool_size, idle_timeout=idle_timeout,
+                                concurrency=concurrency)
+        self._pool.start()
+        if health_interval:
+            # Rounds take the sessions without waiting for them.
+            await self._storage.load_sessions()
+            self._health = HealthChecker(
+                self._probe, lambda: self._storage.sessions,
+                interval=health_interval, rate=probe_rate,
+                concurrency=probe_concurrency
+            )
+            self._health.start()
 
-        self._storage = storage
         self._started = True
 
     async def stop(self) -> None:
-        for client in self._clients:
-            await client.disconnect()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._health is not None:
+            await self._health.close()
+            self._health = None
+        await self._pool.close()
         await self._storage.stop()
         self._started = False
 
@@ -0,0 +1,83 @@
+import asyncio
+from typing import (Any, AsyncIterator, Awaitable, Callable, Iterable,
+                    Optional, TYPE_CHECKING)
+
+if TYPE_CHECKING:
+    from ..session import Session
+
+
+__all__ = ('BatchResult', 'run_batch')
+
+
+class BatchResult:
+    __slots__ = ('session', 'result', 'error', 'elapsed')
+
+    def __init__(self, session: 'Session', result: Any,
+                 error: Optional[BaseException], elapsed: float):
+        self.session = session
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        return (f'BatchResult(session={self.session.info!r}, '
+                f'result={self.result!r}, error={self.error!r}, '
+                f'elapsed={self.elapsed:.3f})')
+
+
+async def run_batch(
+        sessions: Iterable['Session'],
+        func: Callable[['Session'], Awaitable],
+        limit: int
+) -> AsyncIterator[BatchResult]:
+    """Runs ``func`` for every session, at most ``limit`` at once, and
+    yields the results in the order they complete. An exception is
+    returned in the result instead of stopping the batch, unless it comes
+    from iterating ``sessions``."""
+    loop = asyncio.get_event_loop()
+    queue = asyncio.Queue()
+    sessions = iter(sessions)
+
+    async def worker() -> None:
+        # Workers share the iterator, so only ``limit`` tasks exist no
+        # matter how many sessions there are.
+        try:
+            for session in sessions:
+                started = loop.time()
+                try:
+                    result, error = await func(session), None
+                except asyncio.CancelledError:
+                    # An Exception before Python 3.8, it stops the worker
+                    # instead of making a result.
+                    raise
+                except Exception as e:
+                    result, error = None, e
+                queue.put_nowait(BatchResult(session, result, error,
+                                             loop.time() - started))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # The iterable itself failed, e.g. a file it reads, which ends
+            # the batch.
+            queue.put_nowait(e)
+        queue.put_nowait(None)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(limit)]
+    try:
+        running = len(workers)
+        while running:
+            result = await queue.get()
+            if result is None:
+                running -= 1
+            elif isinstance(result, Exception):
+                raise result
+            else:
+                yield result
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,56 @@
+import asyncio
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from telethon.tl.types import Message
+
+from ..session import Session
+
+
+__all__ = ('MessageCache',)
+
+
+CACHE_SIZE = 5
+
+
+class MessageCache:
+    """Keeps the last messages from Telegram per session and passes new
+    ones to subscribers."""
+
+    def __init__(self, size: int = CACHE_SIZE):
+        self._size = size
+        self._messages: Dict[Session, Deque[Message]] = {}
+        self._subscribers: Set[asyncio.Queue] = set()
+
+    def __contains__(self, session: Session) -> bool:
+        return session in self._messages
+
+    def latest(self, session: Session) -> Optional[Message]:
+        messages = self._messages.get(session)
+        return messages[-1] if messages else None
+
+    def messages(self, session: Session) -> List[Message]:
+        return list(self._messages.get(session, ()))
+
+    def put(self, session: Session, message: Message, *,
+            notify: bool = True) -> None:
+        messages = self._messages.setdefault(session,
+                                             deque(maxlen=self._size))
+        # A fetched message may arrive after a newer update.
+        if messages and message.id <= messages[-1].id:
+            return
+        messages.append(message)
+        if notify:
+            for queue in self._subscribers:
+                queue.put_nowait((session, message))
+
+    def discard(self, session: Session) -> None:
+        self._messages.pop(session, None)
+
+    def subscribe(self) -> 'asyncio.Queue[Tuple[Session, Message]]':
+        queue = asyncio.Queue()
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
@@ -1,15 +1,31 @@
 import asyncio
-import getpass
+import json
+import os
+import signal
 import sys
-from argparse import ArgumentParser, Namespace
-from typing import Optional
+from argparse import Namespace
+from collections import Counter
+from functools import partial
+from typing import Optional, Union
 
 from tabulate import tabulate
 from telethon import TelegramClient
+from telethon.tl.types import Message
 
-from .base import BaseKeeper
+from .agent import KeeperAgent
+from .args import answer_password, parse_args
+from .base import BaseKeeper, ID_PREFIX
+from .console import Console
+from .exceptions import AgentError, ClientUnavailable
+from .transfer import (DUPLICATE, export_line, FAILED, IMPORTED,
+                       iter_sources, SESSION_EXTENSION, write_session_file)
+from ..metrics import Metrics
 from ..session import Session
-from ..storage import InvalidPassword, MismatchedVersionError
+from ..storage import (AmbiguousSession, InvalidPassword, kdf,
+                       MismatchedVersionError, SessionExistsError,
+                       ShardedStorage, SqliteStorage, StorageNotFound,
+                       StorageSettedError)
+from ..storage.sqlite import FILENAME as SQLITE_FILENAME
 from ..version import __version__ as keeper_version
 
 
@@ -17,58 +33,92 @@ __all__ = ('CLIKeeper',)
 
 
 class CLIKeeper(BaseKeeper):
-    @staticmethod
-    def _answer_password() -> str:
-        return getpass.getpass('Please enter a password to access sessions: ')
+    _answer_password = staticmethod(answer_password)
+    _parse_args = staticmethod(parse_args)
 
-    @staticmethod
-    def _parse_args() -> Namespace:
-        parser = ArgumentParser()
-        parser.add_argument('--filename',
-                            type=Optional[str], required=False,
-                            help='path to a sessions file')
-        parser.add_argument('--test',
-                            action='store_true',
-                            help='run keeper on test Telegram server')
-        return parser.parse_args()
+    def __init__(self):
+        super().__init__()
+        self._json = False
+        self._status = 0
+        self._profile = False
+        self._metrics_file = None
+        self._migrate = None
+        self._interactive = True
+        self._console = Console()
 
     @staticmethod
     def _print_help() -> None:
         print('COMMANDS:\n'
               'add\t\t\tadd telegram session\n'
-              'remove <NUMBER>\t\tremove session\n'
+              'remove <SESSION...>\tlog out and remove sessions\n'
               'list\t\t\tsessions list\n'
-              'get <NUMBER>\t\tget last message from Telegram for session\n'
-              'exit\t\t\texit from program')
+              'get <SESSION>\t\tget last message from Telegram for session\n'
+              'get-all [SESSION...]\tget last messages for all or given '
+              'sessions\n'
+              'watch [SESSION...]\tprint new messages from Telegram until '
+              'Ctrl+C\n'
+              'import PATH...\t\timport Telethon .session files, '
+              'directories of them and files of string sessions\n'
+              'export PATH\t\texport string sessions to a file or '
+              '.session files to a directory\n'
+              'exit\t\t\texit from program\n'
+              'SESSION is a number from the list, a phone (+...), a mention '
+              '(@...) or id:<Telegram ID>')
+
+    def _print_error(self, text: str) -> None:
+        self._status = 1
+        # Keep stdout parsable for scripts.
+        print(text, file=sys.stderr if self._json else sys.stdout)
+
+    def _print_incorrect_command(self) -> None:
+        self._print_error('You entered the command incorrectly. Enter help '
+                          'to find out the correct option.')
+
+    def _print_non_existent_session(
+            self, error: Optional[LookupError] = None
+    ) -> None:
+        if isinstance(error, AmbiguousSession):
+            self._print_error(str(error))
+            return
+        self._print_error('There is no such session or messages from '
+                          'Telegram are missing.')
 
     @staticmethod
-    def _print_incorrect_command() -> None:
-        print('You entered the command incorrectly. Enter help to find out '
-              'the correct option.')
+    def _print_json(data: object) -> None:
+        print(json.dumps(data, ensure_ascii=False))
 
     @staticmethod
-    def _print_non_existent_session() -> None:
-        print('There is no session with this number or messages from Telegram '
-              'are missing.')
+    def _message_json(message: Message) -> dict:
+        return {'message': message.message,
+                'date': message.date.isoformat()}
 
-    @classmethod
-    def _get_session_number(cls, command: str) -> Optional[int]:
-        number = None
+    @staticmethod
+    def _parse_session_key(key: str) -> Optional[Union[int, str]]:
+        if key.isdigit():
+            return int(key)
+        if key.startswith(ID_PREFIX) and not key[len(ID_PREFIX):].isdigit():
+            return None
+        return key or None
+
+    async def _get_session_key(
+            self, command: str
+    ) -> Optional[Union[int, str]]:
+        key = None
         params = command.split(' ')
         if len(params) == 2:
-            number = params[1]
-        if len(params) > 2:
-            cls._print_incorrect_command()
+            key = self._parse_session_key(params[1])
+        if len(params) > 2 or key is None and not self._interactive:
+            # A single command must not prompt, which would mix with its
+            # output and fail without a terminal.
+            self._print_incorrect_command()
             return
 
-        while True:
-            if number is None:
-                number = input('Please enter the session number (you can see '
-                               'it by the list command): ')
-            try:
-                return int(number)
-            except ValueError:
-                number = None
+        while key is None:
+            key = self._parse_session_key(await self._console.input(
+                'Please enter the session number (you can see it by the list '
+                'command), phone, mention or id:<Telegram ID>: '
+            ))
+        return key
 
     async def add(self) -> None:
         client = TelegramClient(
@@ -77,66 +127,335 @@ class CLIKeeper(BaseKeeper):
         )
         if self.test_mode:
             client.session.set_dc(2, '149.154.167.40', 443)
-        await client.start()
+        # Telethon would prompt with a blocking input().
+        await client.start(
+            phone=partial(self._console.input,
+                          'Please enter your phone (or bot token): '),
+            code_callback=partial(self._console.input,
+                                  'Please enter the code you received: '),
+            password=partial(self._console.input,
+                             'Please enter your password: ', secret=True)
+        )
 
-        await self._storage.add_session(client.session)
-        self._clients.append(client)
+        try:
+            await self._storage.add_session(client.session)
+        except SessionExistsError:
+            # The login created a second authorization, drop it.
+            await client.log_out()
+            print('This account is already in storage.')
+            return
+        self._put_client(client)
         print('Session added to storage.')
 
     async def remove(self, command: str) -> None:
-        number = self._get_session_number(command)
-        if number is None:
-            return
+        params = command.split()[1:]
+        if params:
+            keys = [self._parse_session_key(key) for key in params]
+            if None in keys:
+                self._print_incorrect_command()
+                return
+        else:
+            key = await self._get_session_key(command)
+            if key is None:
+                return
+            keys = [key]
+        numbers = {session: number for number, session
+                   in enumerate(await super().list())}
+
         try:
-            await super().remove(number)
-        except IndexError:
-            self._print_non_existent_session()
+            results = await self.remove_sessions(keys)
+        except LookupError as e:
+            self._print_non_existent_session(e)
             return
-        print('Session removed from storage.')
+        failed = 0
+        for result in results:
+            error = (None if result.ok else
+                     f'{type(result.error).__name__} {result.error}')
+            failed += error is not None
+            if self._json:
+                data = self.session_json(numbers[result.session],
+                                         result.session)
+                data['logged_out'] = result.ok
+                if error:
+                    data['error'] = error
+                self._print_json(data)
+            elif error:
+                print(f'{numbers[result.session]}\t'
+                      f'{result.session.info.phone}\t'
+                      f'Log out failed: {error}')
+        if failed:
+            # The sessions are gone from the storage but may still work.
+            self._status = 1
+        if not self._json:
+            print(f'Removed {len(results)} sessions from storage, '
+                  f'{failed} log outs failed.')
 
     async def list(self) -> None:
-        table = [(number, session.id, session.phone, session.mention)
-                 for number, session in enumerate(await super().list())]
+        if self._json:
+            self._print_json([
+                self.session_json(number, session)
+                for number, session in enumerate(await super().list())
+            ])
+            return
+        table = []
+        for number, session in enumerate(await super().list()):
+            status = self.status(session) or ''
+            checked = self.checked(session)
+            if checked is not None:
+                status += checked.strftime(', checked %H:%M UTC')
+            table.append((number, session.info.id, session.info.phone,
+                          session.info.mention, status))
         print(tabulate(table,
-                       headers=('№', 'Telegram ID', 'Phone', 'Mention'),
+                       headers=('№', 'Telegram ID', 'Phone', 'Mention',
+                                'Status'),
                        tablefmt='pretty'))
 
     async def get(self, command: str) -> None:
-        number = self._get_session_number(command)
-        if number is None:
+        key = await self._get_session_key(command)
+        if key is None:
             return
 
         try:
-            message = await super().get(number)
-        except IndexError:
-            self._print_non_existent_session()
+            session = self.get_session(key)
+            message = await super().get(key)
+        except LookupError as e:
+            self._print_non_existent_session(e)
+            return
+        except ClientUnavailable as e:
+            self._print_error(str(e))
+            return
+        if self._json:
+            number = self._storage.sessions.index(session)
+            self._print_json({**self.session_json(number, session),
+                              **self._message_json(message)})
             return
         print(tabulate(((message.message,),
                         (message.date.strftime('%H:%M %d.%m.%Y UTC'),)),
                        headers=('Last message from Telegram',),
                        tablefmt='grid'))
 
+    async def get_all(self, command: str) -> None:
+        keys = [self._parse_session_key(key) for key in command.split()[1:]]
+        if None in keys:
+            self._print_incorrect_command()
+            return
+        numbers = {session: number for number, session
+                   in enumerate(await super().list())}
+
+        try:
+            async for result in super().get_all(keys or None):
+                number = numbers[result.session]
+                if self._json:
+                    data = self.session_json(number, result.session)
+                    if result.ok:
+                        data.update(self._message_json(result.result))
+                    else:
+                        data['error'] = (f'{type(result.error).__name__} '
+                                         f'{result.error}')
+                    data['elapsed'] = round(result.elapsed, 3)
+                    self._print_json(data)
+                    continue
+                phone = result.session.info.phone
+                if result.ok:
+                    text = ' '.join(result.result.message.split())
+                else:
+                    text = f'{type(result.error).__name__} {result.error}'
+                print(f'{number}\t{phone}\t{result.elapsed:.2f}s\t{text}')
+        except LookupError as e:
+            self._print_non_existent_session(e)
+
+    async def watch(self, command: str) -> None:
+        keys = [self._parse_session_key(key) for key in command.split()[1:]]
+        if None in keys:
+            self._print_incorrect_command()
+            return
+        numbers = {session: number for number, session
+                   in enumerate(await super().list())}
+
+        loop = asyncio.get_event_loop()
+        stopped = loop.create_future()
+        try:
+            loop.add_signal_handler(signal.SIGINT, stopped.set_result, None)
+            interruptible = True
+        except NotImplementedError:
+            # No signal handlers on Windows, Ctrl+C exits the program there.
+            interruptible = False
+        watch = super().watch(keys or None)
+        try:
+            if not self._json:
+                print('Waiting for messages, press Ctrl+C to stop.')
+            while True:
+                received = asyncio.ensure_future(watch.__anext__())
+                await asyncio.wait((received, stopped),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not received.done():
+                    received.cancel()
+                    await asyncio.wait((received,))
+                    break
+                session, message = received.result()
+                if self._json:
+                    self._print_json({
+                        **self.session_json(numbers[session], session),
+                        **self._message_json(message)
+                    })
+                    continue
+                text = ' '.join(message.message.split())
+                print(f'{numbers[session]}\t{session.info.phone}\t{text}')
+        except LookupError as e:
+            self._print_non_existent_session(e)
+        finally:
+            if interruptible:
+                loop.remove_signal_handler(signal.SIGINT)
+            await watch.aclose()
+
+    async def import_sessions(self, command: str) -> None:
+        paths = command.split()[1:]
+        if not paths:
+            self._print_incorrect_command()
+            return
+        counts = Counter()
+        progress = not self._json and sys.stderr.isatty()
+        try:
+            async for result in super().import_sessions(iter_sources(paths)):
+                counts[result.status] += 1
+                error = (f'{type(result.error).__name__} {result.error}'
+                         if result.status == FAILED else None)
+                if self._json:
+                    data = {'source': result.source, 'status': result.status}
+                    if result.status == IMPORTED:
+                        data['id'] = result.session.info.id
+                    if error:
+                        data['error'] = error
+                    self._print_json(data)
+                    continue
+                if error:
+                    if progress:
+                        print(file=sys.stderr)
+                    print(f'{result.source}\t{error}')
+                if progress:
+                    print(f'\rChecked {sum(counts.values())} sessions',
+                          end='', file=sys.stderr, flush=True)
+        except (OSError, ValueError) as e:
+            self._print_error(f'Import failed: {e}')
+            return
+        if progress:
+            print(file=sys.stderr)
+        if not self._json:
+            print(f'Imported {counts[IMPORTED]} sessions, '
+                  f'{counts[DUPLICATE]} duplicates, '
+                  f'{counts[FAILED]} failed.')
+
+    async def export(self, command: str) -> None:
+        params = command.split()
+        if len(params) != 2:
+            self._print_incorrect_command()
+            return
+        path = params[1]
+        sessions = await super().list()
+        # Auth keys are written in clear, only the owner may read them:
+        # files, SQLite journals included, are created owner-only and
+        # existing ones are made so before anything is written.
+        umask = os.umask(0o077)
+        try:
+            if os.path.isdir(path):
+                for session in sessions:
+                    filename = os.path.join(
+                        path, f'{session.info.id}{SESSION_EXTENSION}'
+                    )
+                    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o600)
+                    try:
+                        os.fchmod(fd, 0o600)
+                    finally:
+                        os.close(fd)
+                    write_session_file(session, filename)
+            else:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                             0o600)
+                with open(fd, 'w') as file:
+                    os.fchmod(fd, 0o600)
+                    for session in sessions:
+                        file.write(export_line(session) + '\n')
+        except OSError as e:
+            self._print_error(f'Export failed: {e}')
+            return
+        finally:
+            os.umask(umask)
+        if self._json:
+            self._print_json({'path': path, 'exported': len(sessions)})
+        else:
+            print(f'Exported {len(sessions)} sessions to {path}.')
+
     async def setup_storage(self) -> None:
+        if self._migrate and isinstance(self._storage, SqliteStorage):
+            await self._storage.migrate(self._migrate)
+            print(f'Sessions are copied from {self._migrate}.')
+            return
         api_id = None
         while not api_id:
-            api_id = input('Please enter api id: ')
+            api_id = await self._console.input('Please enter api id: ')
             try:
                 api_id = int(api_id)
             except ValueError:
                 print('You entered an invalid value.')
-        api_hash = getpass.getpass('Please enter api hash: ')
+        api_hash = await self._console.input('Please enter api hash: ',
+                                             secret=True)
         await self._storage.setup(api_id, api_hash)
 
-    async def start(self) -> None:
-        args = self._parse_args()
-        password = self._answer_password()
+    async def start(self, args: Namespace,
+                    password: Optional[str] = None) -> None:
+        kdf_cost = None
+        if args.calibrate:
+            kdf_cost = kdf.calibrate(args.calibrate)
+            print('Calibrated key derivation: ' + ', '.join(
+                f'{key}={value}' for key, value in kdf_cost.items()
+            ))
+        if password is None:
+            password = self._answer_password()
+        self._profile = args.profile
+        self._metrics_file = args.metrics
+        self._migrate = args.migrate
+        if args.migrate and os.path.exists(args.filename or SQLITE_FILENAME):
+            raise StorageSettedError(
+                f'{args.filename or SQLITE_FILENAME} already exists, '
+                f'--migrate only creates a new database.'
+            )
+        storage_factory = None
+        if args.sqlite or args.migrate:
+            storage_factory = SqliteStorage
+        elif args.shards:
+            storage_factory = partial(ShardedStorage, shards=args.shards)
         await super().start(
-            password, test_mode=args.test, filename=args.filename
+            password, test_mode=args.test, filename=args.filename,
+            concurrency=args.concurrency, client_timeout=args.timeout,
+            pool_size=args.pool_size, idle_timeout=args.idle_timeout,
+            kdf_cost=kdf_cost,
+            metrics=Metrics() if args.profile or args.metrics else None,
+            trust_sessions=args.trust_sessions,
+            storage_factory=storage_factory,
+            # Single commands are over before a check would start.
+            health_interval=None if args.command else args.health_interval,
+            probe_rate=args.probe_rate
         )
 
+    def _report_metrics(self) -> None:
+        if self._metrics_file:
+            self._metrics.dump(self._metrics_file)
+        if self._profile:
+            table = [(phase, count, errors, f'{total:.3f}',
+                      *(f'{value * 1000:.1f}' for value in timings))
+                     for phase, count, errors, total, *timings
+                     in self._metrics.summary()]
+            print(tabulate(table,
+                           headers=('Phase', 'Count', 'Errors', 'Total, s',
+                                    'Mean, ms', 'p50, ms', 'p95, ms',
+                                    'Max, ms'),
+                           tablefmt='pretty'),
+                  file=sys.stderr)
+
     async def process_command(self) -> None:
-        command = input('> ')
+        await self.execute(await self._console.input('> '))
 
+    async def execute(self, command: str) -> None:
         if command == 'exit':
             sys.exit()
         if command == 'help':
@@ -151,35 +470,107 @@ class CLIKeeper(BaseKeeper):
         if command == 'list':
             await self.list()
             return
+        if command.startswith('get-all'):
+            await self.get_all(command)
+            return
         if command.startswith('get'):
             await self.get(command)
             return
+        if command.startswith('watch'):
+            await self.watch(command)
+            return
+        if command.startswith('import'):
+            await self.import_sessions(command)
+            return
+        if command.startswith('export'):
+            await self.export(command)
+            return
 
         print('Incorrect command. Enter help to see the list of commands.')
 
-    async def _run(self) -> None:
+    async def _run(self, args: Optional[Namespace] = None,
+                   password: Optional[str] = None) -> int:
+        if args is None:
+            args = self._parse_args()
+        self._json = args.json
+        try:
+            return await self._run_keeper(args, password)
+        finally:
+            self._report_metrics()
+
+    async def _run_keeper(self, args: Namespace,
+                          password: Optional[str]) -> int:
         try:
-            await self.start()
-        except MismatchedVersionError as e:
+            await self.start(args, password)
+        except (MismatchedVersionError, StorageNotFound,
+                StorageSettedError) as e:
+            # StorageNotFound comes only from the source of --migrate.
             print(e)
-            return
+            return 1
         except InvalidPassword:
             print('Invalid password')
+            return 1
+
+        if args.agent:
+            return await self._run_agent(args.agent)
+
+        if args.command:
+            self._interactive = False
+            # Only the sessions the command needs get connected.
+            try:
+                await self.execute(' '.join((args.command, *args.sessions)))
+            finally:
+                await self.stop()
+            return self._status
 
         self._print_help()
 
         try:
             while True:
                 await self.process_command()
-        except (SystemExit, KeyboardInterrupt):
+                if self._metrics_file:
+                    self._metrics.dump(self._metrics_file)
+        except (SystemExit, KeyboardInterrupt, EOFError):
             await self.stop()
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             print(e)
+        return 0
+
+    async def _run_agent(self, path: str) -> int:
+        agent = KeeperAgent(self)
+        try:
+            await agent.start(path)
+        except (OSError, AgentError) as e:
+            self._print_error(f'Agent failed: {e}')
+            await self.stop()
+            return 1
+        loop = asyncio.get_event_loop()
+        stopped = loop.create_future()
+
+        def stop() -> None:
+            if not stopped.done():
+                stopped.set_result(None)
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop)
+        try:
+            print(f'Agent is listening on {path}, press Ctrl+C to stop.',
+                  flush=True)
+            await stopped
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            await agent.close()
+            await self.stop()
+        return 0
 
     @classmethod
-    def run(cls) -> None:
+    def run(cls, args: Optional[Namespace] = None,
+            password: Optional[str] = None) -> None:
         # TODO: maybe change args parsing (after gui added)
-        asyncio.run(cls()._run())
+        sys.exit(asyncio.run(cls()._run(args, password)))
 
 
 if __name__ == '__main__':
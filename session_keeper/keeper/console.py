@@ -0,0 +1,65 @@
+import asyncio
+import getpass
+import signal
+import threading
+from concurrent.futures import Future
+from typing import Optional
+
+
+__all__ = ('Console',)
+
+
+class Console:
+    """Reads lines from the terminal in a daemon thread, so the event loop,
+    and with it the clients, keeps running while the operator types.
+
+    A read that was waited for but cancelled is left running and its line
+    goes to the next ``input``, as only one thread may read stdin at once.
+    The thread never keeps the program from exiting.
+    """
+
+    def __init__(self):
+        self._pending: Optional[Future] = None
+
+    @staticmethod
+    def _read(future: Future, prompt: str, secret: bool) -> None:
+        try:
+            line = (getpass.getpass if secret else input)(prompt)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(line)
+
+    async def input(self, prompt: str = '', *, secret: bool = False) -> str:
+        """Like ``input``, or ``getpass.getpass`` if ``secret``: EOF raises
+        ``EOFError`` and Ctrl+C ``KeyboardInterrupt``."""
+        if self._pending is None:
+            self._pending = Future()
+            threading.Thread(target=self._read,
+                             args=(self._pending, prompt, secret),
+                             daemon=True).start()
+        pending = self._pending
+        loop = asyncio.get_event_loop()
+        interrupted = loop.create_future()
+        try:
+            loop.add_signal_handler(signal.SIGINT, interrupted.set_result,
+                                    None)
+            interruptible = True
+        except RuntimeError:
+            # NotImplementedError on Windows, or not the main thread: no
+            # signal handlers, Ctrl+C reaches the loop as usual.
+            interruptible = False
+        # Cancelling the wait must not cancel the read.
+        line = asyncio.shield(asyncio.wrap_future(pending))
+        try:
+            await asyncio.wait((line, interrupted),
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if interruptible:
+                loop.remove_signal_handler(signal.SIGINT)
+            if not line.done():
+                line.cancel()
+        if line.cancelled():
+            raise KeyboardInterrupt
+        self._pending = None
+        return line.result()
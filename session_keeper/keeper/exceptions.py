@@ -0,0 +1,10 @@
+class ClientUnavailable(Exception):
+    pass
+
+
+class SessionUnauthorized(Exception):
+    pass
+
+
+class AgentError(Exception):
+    pass
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import random
+from datetime import datetime, timezone
+from typing import (Awaitable, Callable, Dict, Iterable, List, Optional, Tuple,
+                    Union)
+
+from telethon import errors, events
+from telethon.crypto import AuthKey
+from telethon.tl.types import Message, PeerUser, User
+
+from .base import TELEGRAM_ID
+from ..session import Session
+
+
+__all__ = ('FakeBackend', 'FakeClient')
+
+
+Latency = Union[float, Tuple[float, float]]
+
+
+class FakeBackend:
+    """An in-process stand-in for Telegram, pass it to ``BaseKeeper.start``
+    as ``client_factory`` to run a keeper without network.
+
+    Every request waits ``latency`` seconds, or a random time within the
+    given range, and fails with ``FloodWaitError`` of ``flood_wait_seconds``
+    with the ``flood_wait`` probability. Sessions of ``dead`` users never
+    connect and the ones of ``unauthorized`` users are revoked. Each user
+    starts with one login code message from Telegram in the history.
+    Sessions made by ``login`` carry no user info, like the ones imported
+    from Telethon files.
+    """
+
+    def __init__(self, *, latency: Latency = 0.0, flood_wait: float = 0.0,
+                 flood_wait_seconds: int = 30, dead: Iterable[int] = (),
+                 unauthorized: Iterable[int] = (),
+                 seed: Optional[int] = None):
+        self.latency = latency
+        self.flood_wait = flood_wait
+        self.flood_wait_seconds = flood_wait_seconds
+        self.dead = set(dead)
+        self.unauthorized = set(unauthorized)
+        self.clients: List[FakeClient] = []
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._history: Dict[int, List[Message]] = {}
+        self._message_id = 0
+        self._accounts: Dict[bytes, int] = {}
+
+    def __call__(self, session: Session, api_id: int, api_hash: str,
+                 **kwargs) -> 'FakeClient':
+        client = FakeClient(self, session)
+        self.clients.append(client)
+        return client
+
+    def login(self, user_id: int) -> Session:
+        """Returns a new authorized session of the user without entities."""
+        session = Session()
+        session.set_dc(2, '149.154.167.40', 443)
+        session.auth_key = AuthKey(os.urandom(256))
+        self._accounts[session.auth_key.key] = user_id
+        return session
+
+    def user_id(self, session: Session) -> int:
+        if self._accounts:
+            user_id = self._accounts.get(session.auth_key.key)
+            if user_id is not None:
+                return user_id
+        return session.id
+
+    def _new_message(self, text: str) -> Message:
+        self._message_id += 1
+        return Message(id=self._message_id, peer_id=PeerUser(TELEGRAM_ID),
+                       date=datetime.now(timezone.utc), message=text,
+                       from_id=PeerUser(TELEGRAM_ID))
+
+    def _login_code(self) -> str:
+        return f'Login code: {self._random.randrange(10 ** 5):05d}.'
+
+    def history(self, user_id: int) -> List[Message]:
+        if user_id not in self._history:
+            self._history[user_id] = [self._new_message(self._login_code())]
+        return self._history[user_id]
+
+    async def send(self, user_id: int, text: Optional[str] = None) -> Message:
+        """Sends a message (a new login code by default) from Telegram to
+        the user and delivers it to connected clients as an update."""
+        message = self._new_message(text or self._login_code())
+        self.history(user_id).append(message)
+        for client in self.clients:
+            if client.is_connected() and client.user_id == user_id:
+                await client._dispatch(message)
+        return message
+
+    async def _request(self) -> None:
+        self.requests += 1
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = self._random.uniform(*latency)
+        await asyncio.sleep(latency)
+        if self.flood_wait and self._random.random() < self.flood_wait:
+            raise errors.FloodWaitError(request=None,
+                                        capture=self.flood_wait_seconds)
+
+
+class FakeClient:
+    """Implements the part of ``TelegramClient`` used by keepers."""
+
+    def __init__(self, backend: FakeBackend, session: Session):
+        self.session = session
+        self.user_id = backend.user_id(session)
+        self._backend = backend
+        self._connected = False
+        self._handlers: List[Tuple[Callable[..., Awaitable],
+                                   Optional[events.NewMessage]]] = []
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    async def connect(self) -> None:
+        if self.user_id in self._backend.dead:
+            # Like an unreachable server, only a timeout stops it.
+            await asyncio.get_event_loop().create_future()
+        await self._backend._request()
+        self._connected = True
+
+    async def get_me(self) -> Optional[User]:
+        await self._backend._request()
+        if self.user_id in self._backend.unauthorized:
+            return None
+        return User(self.user_id, access_hash=0,
+                    username=f'user{self.user_id}',
+                    phone=f'7999{self.user_id:07d}')
+
+    def _check_authorized(self) -> None:
+        if self.user_id in self._backend.unauthorized:
+            raise errors.AuthKeyUnregisteredError(request=None)
+
+    async def get_messages(self, entity: int, limit: int = 1) -> List[Message]:
+        await self._backend._request()
+        self._check_authorized()
+        if entity != TELEGRAM_ID:
+            return []
+        return self._backend.history(self.user_id)[::-1][:limit]
+
+    async def log_out(self) -> bool:
+        await self._backend._request()
+        self._check_authorized()
+        self._backend.unauthorized.add(self.user_id)
+        self._connected = False
+        return True
+
+    async def disconnect(self) -> None:
+        self._connected = False
+
+    def add_event_handler(self, callback: Callable[..., Awaitable],
+                          event: Optional[events.NewMessage] = None) -> None:
+        self._handlers.append((callback, event))
+
+    async def _dispatch(self, message: Message) -> None:
+        event = events.NewMessage.Event(message)
+        for callback, builder in self._handlers:
+            if builder is None or builder.func is None or builder.func(event):
+                await callback(event)
@@ -0,0 +1,135 @@
+import asyncio
+import random
+import time
+from typing import (Awaitable, Callable, Dict, Iterable, Optional, Set,
+                    TYPE_CHECKING)
+
+from .exceptions import SessionUnauthorized
+
+if TYPE_CHECKING:
+    from ..session import Session
+
+
+__all__ = ('Health', 'HealthChecker', 'OK', 'REVOKED', 'UNREACHABLE')
+
+
+HEALTH_INTERVAL = 3600.0
+PROBE_RATE = 1.0
+PROBE_CONCURRENCY = 4
+JITTER = 0.5
+
+OK = 'ok'
+REVOKED = 'revoked'
+UNREACHABLE = 'unreachable'
+
+
+class Health:
+    __slots__ = ('status', 'checked', 'error')
+
+    def __init__(self, status: str, checked: float,
+                 error: Optional[BaseException] = None):
+        self.status = status
+        # Unix time of the probe.
+        self.checked = checked
+        self.error = error
+
+    def __repr__(self) -> str:
+        return (f'Health(status={self.status!r}, checked={self.checked!r}, '
+                f'error={self.error!r})')
+
+
+class HealthChecker:
+    """Probes every session in turn, so each is checked about every
+    ``interval`` seconds, and keeps the last result.
+
+    Probes start at most ``rate`` per second and run at most
+    ``concurrency`` at once, so the load stays the same for any number of
+    sessions: a fleet too large for the interval is just checked less
+    often. Pauses between probes are jittered by ``jitter`` of their length,
+    so keepers started together do not probe in step.
+
+    ``probe`` raises ``SessionUnauthorized`` for a revoked session and any
+    other exception for one it could not reach.
+    """
+
+    def __init__(self, probe: Callable[['Session'], Awaitable[None]],
+                 sessions: Callable[[], Iterable['Session']], *,
+                 interval: float = HEALTH_INTERVAL,
+                 rate: float = PROBE_RATE,
+                 concurrency: int = PROBE_CONCURRENCY,
+                 jitter: float = JITTER):
+        self._probe = probe
+        self._sessions = sessions
+        self._interval = interval
+        self._rate = rate
+        self._concurrency = concurrency
+        self._jitter = jitter
+        self._random = random.Random()
+        self._health: Dict['Session', Health] = {}
+        self._round: Set['Session'] = set()
+        self._probes: Set[asyncio.Future] = set()
+        self._runner: Optional[asyncio.Task] = None
+
+    def __contains__(self, session: 'Session') -> bool:
+        return session in self._health
+
+    def __len__(self) -> int:
+        return len(self._health)
+
+    def get(self, session: 'Session') -> Optional[Health]:
+        return self._health.get(session)
+
+    def discard(self, session: 'Session') -> None:
+        """Forgets a removed session, it is skipped if not probed yet."""
+        self._health.pop(session, None)
+        self._round.discard(session)
+
+    def start(self) -> None:
+        if self._runner is None:
+            self._runner = asyncio.ensure_future(self._run())
+
+    def _pause(self, sessions: int) -> float:
+        pause = self._interval / sessions if sessions else self._interval
+        jitter = self._random.uniform(1 - self._jitter, 1 + self._jitter)
+        # Jitter never pushes probes over the rate.
+        return max(pause * jitter, 1 / self._rate)
+
+    async def _run(self) -> None:
+        semaphore = asyncio.Semaphore(self._concurrency)
+        while True:
+            sessions = list(self._sessions())
+            self._round = set(sessions)
+            if not sessions:
+                await asyncio.sleep(self._pause(0))
+            for session in sessions:
+                await asyncio.sleep(self._pause(len(sessions)))
+                if session not in self._round:
+                    continue
+                await semaphore.acquire()
+                probe = asyncio.ensure_future(self._check(session))
+                self._probes.add(probe)
+                probe.add_done_callback(self._probes.discard)
+                probe.add_done_callback(lambda _: semaphore.release())
+
+    async def _check(self, session: 'Session') -> None:
+        try:
+            await self._probe(session)
+        except SessionUnauthorized as e:
+            health = Health(REVOKED, time.time(), e)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            health = Health(UNREACHABLE, time.time(), e)
+        else:
+            health = Health(OK, time.time())
+        if session in self._round:
+            self._health[session] = health
+
+    async def close(self) -> None:
+        tasks = set(self._probes)
+        if self._runner is not None:
+            tasks.add(self._runner)
+            self._runner = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,160 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import (AsyncIterator, Awaitable, Callable, Dict, Iterator,
+                    Optional, TYPE_CHECKING)
+
+from .utils import CONCURRENCY, gather_limited
+
+if TYPE_CHECKING:
+    from telethon import TelegramClient
+
+    from ..session import Session
+
+
+__all__ = ('ClientPool',)
+
+
+POOL_SIZE = 8
+IDLE_TIMEOUT = 300.0
+
+
+class _Entry:
+    __slots__ = ('client', 'users', 'last_used')
+
+    def __init__(self, client: 'TelegramClient', now: float):
+        self.client = client
+        self.users = 0
+        self.last_used = now
+
+
+class ClientPool:
+    """Connects clients on first use and keeps at most ``max_size`` of them.
+
+    Clients that are not in use are disconnected when the pool is over
+    capacity (least recently used first) or when they were idle for longer
+    than ``idle_timeout`` seconds.
+    """
+
+    def __init__(
+            self,
+            connect: Callable[['Session'], Awaitable['TelegramClient']],
+            disconnect: Callable[['TelegramClient'], Awaitable[None]], *,
+            max_size: int = POOL_SIZE,
+            idle_timeout: float = IDLE_TIMEOUT,
+            concurrency: int = CONCURRENCY
+    ):
+        self._connect = connect
+        self._disconnect = disconnect
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._concurrency = concurrency
+        self._entries: 'OrderedDict[Session, _Entry]' = OrderedDict()
+        self._connecting: Dict['Session', asyncio.Future] = {}
+        self._reaper: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, session: 'Session') -> bool:
+        return session in self._entries
+
+    def __iter__(self) -> Iterator['TelegramClient']:
+        return (entry.client for entry in self._entries.values())
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size
+
+    @staticmethod
+    def _now() -> float:
+        return asyncio.get_event_loop().time()
+
+    def start(self) -> None:
+        if self._reaper is None and self._idle_timeout:
+            self._reaper = asyncio.ensure_future(self._reap())
+
+    async def _reap(self) -> None:
+        while True:
+            await asyncio.sleep(self._idle_timeout / 2)
+            await self._evict()
+
+    async def _evict(self, idle: bool = True) -> None:
+        """Disconnects unused clients over the capacity, least recently used
+        first, and with ``idle`` also the ones unused for too long."""
+        deadline = self._now() - self._idle_timeout
+        excess = len(self._entries) - self._max_size
+        victims = []
+        for session, entry in self._entries.items():
+            if excess <= 0 and not idle:
+                break
+            if entry.users:
+                continue
+            if excess > 0 or (self._idle_timeout
+                              and entry.last_used <= deadline):
+                victims.append(session)
+                excess -= 1
+        evicted = [self._entries.pop(session).client for session in victims]
+        await gather_limited((self._disconnect(client) for client in evicted),
+                             self._concurrency)
+
+    def put(self, session: 'Session', client: 'TelegramClient') -> None:
+        """Adopts an already connected client."""
+        self._entries[session] = _Entry(client, self._now())
+        self._entries.move_to_end(session)
+
+    def discard(self, session: 'Session') -> Optional['TelegramClient']:
+        """Forgets a client without disconnecting it."""
+        entry = self._entries.pop(session, None)
+        return entry.client if entry else None
+
+    async def _open(self, session: 'Session') -> None:
+        try:
+            client = await self._connect(session)
+        finally:
+            del self._connecting[session]
+        self.put(session, client)
+
+    async def acquire(self, session: 'Session') -> 'TelegramClient':
+        # Concurrent acquirers of the same session share one connection
+        # attempt.
+        while session not in self._entries:
+            future = self._connecting.get(session)
+            if future is None:
+                future = asyncio.ensure_future(self._open(session))
+                self._connecting[session] = future
+            await asyncio.shield(future)
+        entry = self._entries[session]
+        entry.users += 1
+        entry.last_used = self._now()
+        self._entries.move_to_end(session)
+        # Idle clients are left to the reaper, a scan of the whole pool on
+        # every acquire would make batches quadratic.
+        if len(self._entries) > self._max_size:
+            await self._evict(idle=False)
+        return entry.client
+
+    def release(self, session: 'Session') -> None:
+        entry = self._entries.get(session)
+        if entry is not None:
+            entry.users -= 1
+            entry.last_used = self._now()
+
+    @asynccontextmanager
+    async def client(
+            self, session: 'Session'
+    ) -> AsyncIterator['TelegramClient']:
+        client = await self.acquire(session)
+        try:
+            yield client
+        finally:
+            self.release(session)
+
+    async def close(self) -> None:
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        clients = list(self)
+        self._entries.clear()
+        await gather_limited((self._disconnect(client) for client in clients),
+                             self._concurrency)
@@ -0,0 +1,128 @@
+"""Bulk import and export of sessions.
+
+Telethon ``.session`` files and string sessions hold only the data center
+and the auth key, ``BaseKeeper.import_sessions`` finds out the account with
+a ``get_me`` request. Exported files are read back by ``iter_sources``.
+"""
+import os
+import sqlite3
+from functools import partial
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+from telethon.crypto import AuthKey
+from telethon.sessions import SQLiteSession, StringSession
+
+from ..session import Session
+
+
+__all__ = ('ImportResult', 'Source', 'IMPORTED', 'DUPLICATE', 'FAILED',
+           'new_session', 'iter_sources', 'load_session_file',
+           'load_string_session', 'dump_string_session', 'export_line',
+           'write_session_file')
+
+
+SESSION_EXTENSION = '.session'
+
+IMPORTED = 'imported'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+
+
+# A name to report and a function which loads the session.
+Source = Tuple[str, Callable[[], Session]]
+
+
+class ImportResult:
+    __slots__ = ('source', 'status', 'session', 'error')
+
+    def __init__(self, source: str, status: str,
+                 session: Optional[Session] = None,
+                 error: Optional[BaseException] = None):
+        self.source = source
+        self.status = status
+        self.session = session
+        self.error = error
+
+    def __repr__(self) -> str:
+        return (f'ImportResult(source={self.source!r}, '
+                f'status={self.status!r}, error={self.error!r})')
+
+
+def new_session(dc_id: int, server_address: str, port: int,
+                auth_key: bytes) -> Session:
+    session = Session()
+    session.set_dc(dc_id, server_address, port)
+    session.auth_key = AuthKey(auth_key)
+    return session
+
+
+def load_session_file(filename: str) -> Session:
+    # Opened read only: Telethon would upgrade an old file in place.
+    uri = Path(os.path.abspath(filename)).as_uri() + '?mode=ro'
+    try:
+        db = sqlite3.connect(uri, uri=True)
+        try:
+            row = db.execute('SELECT dc_id, server_address, port, auth_key '
+                             'FROM sessions').fetchone()
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        raise ValueError(f'{filename} is not a Telethon session file.') from e
+    if row is None or not row[3]:
+        raise ValueError(f'{filename} has no auth key.')
+    return new_session(*row)
+
+
+def load_string_session(string: str) -> Session:
+    try:
+        session = StringSession(string)
+    except Exception as e:
+        raise ValueError('Not a valid string session.') from e
+    if session.auth_key is None:
+        raise ValueError('The string session has no auth key.')
+    return new_session(session.dc_id, session.server_address, session.port,
+                       session.auth_key.key)
+
+
+def iter_sources(paths: Iterable[str]) -> Iterator[Source]:
+    """Yields a source for every ``.session`` file, the ones in given
+    directories too, and for every line of other files with a string
+    session as its last word. Files are read as sources are taken."""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(SESSION_EXTENSION):
+                    filename = os.path.join(path, name)
+                    yield filename, partial(load_session_file, filename)
+        elif path.endswith(SESSION_EXTENSION):
+            yield path, partial(load_session_file, path)
+        else:
+            with open(path) as file:
+                for number, line in enumerate(file, 1):
+                    words = line.split()
+                    if words and not words[0].startswith('#'):
+                        yield (f'{path}:{number}',
+                               partial(load_string_session, words[-1]))
+
+
+def dump_string_session(session: Session) -> str:
+    return StringSession.save(session)
+
+
+def export_line(session: Session) -> str:
+    """Telegram ID, phone, mention and the string session."""
+    info = session.info
+    return (f'{info.id} {info.phone} {info.mention} '
+            f'{dump_string_session(session)}')
+
+
+def write_session_file(session: Session, filename: str) -> None:
+    file_session = SQLiteSession(filename)
+    try:
+        file_session.set_dc(session.dc_id, session.server_address,
+                            session.port)
+        file_session.auth_key = session.auth_key
+        file_session.save()
+    finally:
+        file_session.close()
@@ -0,0 +1,16 @@
+import asyncio
+from typing import Awaitable, Iterable, List
+
+
+CONCURRENCY = 16
+CLIENT_TIMEOUT = 30.0
+
+
+async def gather_limited(aws: Iterable[Awaitable], limit: int) -> List:
+    semaphore = asyncio.Semaphore(limit)
+
+    async def limited(aw: Awaitable):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(limited(aw) for aw in aws))
@@ -0,0 +1,174 @@
+"""Phase timings of the storage and keepers.
+
+Phases are timed with ``Metrics.timer`` and collected into latency
+histograms, which can be dumped as JSON or in the Prometheus text format
+(e.g. for the node exporter textfile collector). Subclasses may override
+``observe`` to forward timings elsewhere.
+"""
+import json
+import os
+import tempfile
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+__all__ = ('Histogram', 'Metrics', 'NullMetrics', 'NULL_METRICS')
+
+
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, 30.0, 60.0)
+PROMETHEUS_NAME = 'session_keeper_phase_seconds'
+PROMETHEUS_ERRORS = 'session_keeper_phase_errors_total'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'count', 'errors', 'sum', 'max')
+
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        # The last one counts values above every bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile by linear interpolation within its bucket,
+        like ``histogram_quantile`` in Prometheus."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets + (self.max,), self.counts):
+            if count and seen + count >= rank:
+                upper = min(bound, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.max
+
+    def as_dict(self) -> dict:
+        return {'count': self.count, 'errors': self.errors, 'sum': self.sum,
+                'max': self.max,
+                'buckets': dict(zip([*map(str, self.buckets), '+Inf'],
+                                    self.counts))}
+
+
+class Metrics:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self._buckets = buckets
+        self._histograms: Dict[str, Histogram] = {}
+
+    def __getitem__(self, phase: str) -> Histogram:
+        histogram = self._histograms.get(phase)
+        if histogram is None:
+            histogram = self._histograms[phase] = Histogram(self._buckets)
+        return histogram
+
+    def __contains__(self, phase: str) -> bool:
+        return phase in self._histograms
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._histograms)
+
+    def observe(self, phase: str, seconds: float,
+                error: Optional[BaseException] = None) -> None:
+        histogram = self[phase]
+        histogram.observe(seconds)
+        if error is not None:
+            histogram.errors += 1
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.observe(phase, time.perf_counter() - start, e)
+            raise
+        self.observe(phase, time.perf_counter() - start)
+
+    def summary(self) -> List[tuple]:
+        """Rows of phase, count, errors, total, mean, p50, p95 and max."""
+        return [(phase, h.count, h.errors, h.sum, h.mean, h.quantile(0.5),
+                 h.quantile(0.95), h.max)
+                for phase, h in self._histograms.items()]
+
+    def as_dict(self) -> dict:
+        return {phase: histogram.as_dict()
+                for phase, histogram in self._histograms.items()}
+
+    def to_json(self) -> str:
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        lines = [f'# HELP {PROMETHEUS_NAME} Duration of keeper phases.',
+                 f'# TYPE {PROMETHEUS_NAME} histogram']
+        for phase, histogram in self._histograms.items():
+            total = 0
+            for bound, count in zip([*map(repr, histogram.buckets), '+Inf'],
+                                    histogram.counts):
+                total += count
+                lines.append(f'{PROMETHEUS_NAME}_bucket'
+                             f'{{phase="{phase}",le="{bound}"}} {total}')
+            lines.append(f'{PROMETHEUS_NAME}_sum{{phase="{phase}"}} '
+                         f'{histogram.sum!r}')
+            lines.append(f'{PROMETHEUS_NAME}_count{{phase="{phase}"}} '
+                         f'{histogram.count}')
+        lines.extend((f'# HELP {PROMETHEUS_ERRORS} Failed keeper phases.',
+                      f'# TYPE {PROMETHEUS_ERRORS} counter'))
+        for phase, histogram in self._histograms.items():
+            lines.append(f'{PROMETHEUS_ERRORS}{{phase="{phase}"}} '
+                         f'{histogram.errors}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename: str) -> None:
+        """Writes Prometheus text for ``*.prom`` files and JSON otherwise.
+        The file is replaced atomically, so scrapers never see a partial
+        one."""
+        if filename.endswith('.prom'):
+            data = self.to_prometheus()
+        else:
+            data = self.to_json()
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temp_filename = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                # mkstemp makes the file owner-only, but collectors, like
+                # the node exporter's textfile one, often run as another
+                # user.
+                os.fchmod(fd, 0o644)
+                file.write(data)
+            os.replace(temp_filename, filename)
+        except BaseException:
+            os.unlink(temp_filename)
+            raise
+
+
+class NullMetrics(Metrics):
+    """Discards everything, used when no metrics are collected."""
+
+    def observe(self, phase: str, seconds: float,
+                error: Optional[BaseException] = None) -> None:
+        pass
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        yield
+
+
+NULL_METRICS = NullMetrics()
@@ -1,30 +1,64 @@
 import base64 as b64
+from typing import Callable, Optional, Union
 
 from telethon.sessions import MemorySession
 
 
+class SessionInfo:
+    __slots__ = ('id', 'phone', 'mention')
+
+    def __init__(self, id: int, phone: str, mention: str):
+        self.id = id
+        self.phone = phone
+        self.mention = mention
+
+    def __repr__(self) -> str:
+        return (f'SessionInfo(id={self.id!r}, phone={self.phone!r}, '
+                f'mention={self.mention!r})')
+
+
 class Session(MemorySession):
+    _info: Optional[SessionInfo]
+
+    def __init__(self):
+        super().__init__()
+        self._info = None
+
     @property
     def entities(self) -> tuple:
         return list(self._entities)[0]
 
+    @property
+    def info(self) -> SessionInfo:
+        # Computed once: entities of other users are added to the set as
+        # soon as the client receives them.
+        if self._info is None:
+            entities = self.entities
+            if entities[2]:
+                mention = '@' + entities[2]
+            else:
+                mention = entities[4]
+            self._info = SessionInfo(entities[0], '+' + entities[3], mention)
+        return self._info
+
     @property
     def id(self) -> int:
-        return self.entities[0]
+        return self.info.id
 
     @property
     def phone(self) -> str:
-        return '+' + self.entities[3]
+        return self.info.phone
 
     @property
     def mention(self) -> str:
-        if self.entities[2]:
-            return '@' + self.entities[2]
-        return self.entities[4]
+        return self.info.mention
+
+    @property
+    def raw_auth_key(self) -> bytes:
+        return self.auth_key.key
 
     def _encode_auth_key(self) -> str:
-        key = self.auth_key.key
-        key = b64.urlsafe_b64encode(key)
+        key = b64.urlsafe_b64encode(self.raw_auth_key)
         return key.decode()
 
     def as_dict(self) -> dict:
@@ -34,16 +68,52 @@ class Session(MemorySession):
 
 
 class KeeperSession(Session):
-    def __init__(self, **kwargs):
-        from telethon.crypto import AuthKey
+    """A stored session. Its metadata comes from the storage as is and the
+    auth key is only decrypted and built when a client needs it.
+
+    ``auth_key`` is the raw key, its base64 form or a callable which
+    returns the raw key.
+    """
+
+    _auth_key_data: Optional[Union[bytes, str, Callable[[], bytes]]]
 
+    def __init__(self, **kwargs):
         super().__init__()
 
+        self._info = SessionInfo(*[
+            kwargs.get(key) for key in ('id', 'phone', 'mention')
+        ])
         self._dc_id, self._server_address, self._port, auth_key = [
             kwargs.get(key) for key in ('dc_id', 'server_address', 'port',
                                         'auth_key')
         ]
-        self._auth_key = AuthKey(self._decode_auth_key(auth_key))
+        self._auth_key_data = auth_key
+
+    @property
+    def auth_key(self):
+        if self._auth_key is None and self._auth_key_data is not None:
+            from telethon.crypto import AuthKey
+
+            self._auth_key = AuthKey(self.raw_auth_key)
+            self._auth_key_data = None
+        return self._auth_key
+
+    @auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._auth_key_data = None
+
+    @property
+    def raw_auth_key(self) -> bytes:
+        if self._auth_key is None and self._auth_key_data is not None:
+            if callable(self._auth_key_data):
+                self._auth_key_data = self._auth_key_data()
+            elif isinstance(self._auth_key_data, str):
+                self._auth_key_data = self._decode_auth_key(
+                    self._auth_key_data
+                )
+            return self._auth_key_data
+        return super().raw_auth_key
 
     @staticmethod
     def _decode_auth_key(encoded_key: str) -> bytes:
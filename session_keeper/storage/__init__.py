@@ -1,9 +1,15 @@
+from . import kdf
 from .abstract import AbstractStorage
 from .ejs import EncryptedJsonStorage
-from .exceptions import (InvalidPassword, MismatchedVersionError,
-                         StorageNotFound, StorageSettedError)
+from .exceptions import (AmbiguousSession, InvalidPassword,
+                         MismatchedVersionError, SessionExistsError,
+                         SessionNotFound, StorageNotFound,
+                         StorageSettedError)
+from .sharded import ShardedStorage
+from .sqlite import SqliteStorage
 
 
 __all__ = ('AbstractStorage', 'EncryptedJsonStorage',
-           'InvalidPassword', 'MismatchedVersionError', 'StorageNotFound',
-           'StorageSettedError')
+           'AmbiguousSession', 'InvalidPassword', 'MismatchedVersionError',
+           'SessionExistsError', 'SessionNotFound', 'ShardedStorage',
+           'SqliteStorage', 'StorageNotFound', 'StorageSettedError', 'kdf')
@@ -1,7 +1,8 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import Iterable, List, TYPE_CHECKING, Union
 
-from ..session import Session
+if TYPE_CHECKING:
+    from ..session import Session
 
 
 class AbstractStorage(ABC):
@@ -20,18 +21,40 @@ class AbstractStorage(ABC):
         pass
 
     @abstractmethod
-    async def add_session(self, session: Session) -> None:
+    async def add_session(self, session: 'Session') -> None:
         pass
 
+    async def add_sessions(self, sessions: Iterable['Session']) -> None:
+        """Adds sessions at once, storages write them in one go."""
+        for session in sessions:
+            await self.add_session(session)
+        await self.save()
+
     @abstractmethod
-    async def remove_session(self, number: int) -> None:
+    async def remove_session(self, session: 'Session') -> None:
         pass
 
+    async def remove_sessions(self, sessions: Iterable['Session']) -> None:
+        """Removes sessions at once, storages write the change in one
+        go."""
+        for session in sessions:
+            await self.remove_session(session)
+        await self.save()
+
+    @abstractmethod
+    def get_session(self, key: Union[int, str]) -> 'Session':
+        """Finds a session by Telegram ID, phone (``+...``) or mention."""
+
     @property
     @abstractmethod
-    def sessions(self) -> List[Session]:
+    def sessions(self) -> List['Session']:
         pass
 
+    async def load_sessions(self) -> None:
+        """Reads ``sessions`` ahead, storages which read them lazily do
+        it without blocking the loop."""
+        self.sessions
+
     @abstractmethod
     async def setup(self, api_id: int, api_hash: str) -> None:
         pass
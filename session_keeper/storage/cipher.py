@@ -0,0 +1,54 @@
+import asyncio
+import base64 as b64
+import os
+from typing import TYPE_CHECKING, Union
+
+from . import exceptions as exc, kdf
+from ..metrics import Metrics
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+__all__ = ('NONCE_SIZE', 'new_aead', 'seal', 'unlock', 'unseal')
+
+
+NONCE_SIZE = 12
+
+Buffer = Union[bytes, memoryview]
+
+
+def new_aead(key: bytes) -> 'AESGCM':
+    """Returns the cipher for a key made by ``kdf.derive``."""
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    return AESGCM(b64.urlsafe_b64decode(key))
+
+
+def seal(aead: 'AESGCM', data: bytes, associated: bytes) -> bytes:
+    """Encrypts data under a fresh nonce, which is prepended to it."""
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + aead.encrypt(nonce, data, associated)
+
+
+def unseal(aead: 'AESGCM', sealed: Buffer, associated: bytes) -> bytes:
+    from cryptography.exceptions import InvalidTag
+
+    try:
+        return aead.decrypt(sealed[:NONCE_SIZE], sealed[NONCE_SIZE:],
+                            associated)
+    except InvalidTag:
+        raise exc.InvalidPassword
+
+
+async def unlock(password: Union[bytes, str], header: dict,
+                 metrics: Metrics) -> bytes:
+    """Returns the key of a storage: a password is derived with the
+    header in the default executor, a key is returned as it is."""
+    if isinstance(password, bytes):
+        return password
+    # Key derivation is slow on purpose, so it must not block the loop.
+    with metrics.timer('storage_kdf'):
+        return await asyncio.get_event_loop().run_in_executor(
+            None, kdf.derive, password, header
+        )
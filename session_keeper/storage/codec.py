@@ -0,0 +1,116 @@
+import ipaddress
+import struct
+import zlib
+from functools import lru_cache
+from typing import Iterator, Tuple, TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from ..session import Session
+
+
+__all__ = ('HEADER', 'SESSION', 'TOMBSTONE',
+           'pack_header', 'pack_session', 'pack_tombstone', 'pack_frame',
+           'unpack_frame')
+
+
+HEADER = 0
+SESSION = 1
+TOMBSTONE = 2
+
+RAW = 0
+ZLIB = 1
+
+# type, api_id
+_HEADER = struct.Struct('>Bq')
+# type, key, id, dc_id, port, address
+_SESSION = struct.Struct('>BIqBH16s')
+# type, key
+_TOMBSTONE = struct.Struct('>BI')
+_LENGTH = struct.Struct('>H')
+
+Buffer = Union[bytes, memoryview]
+
+
+def _pack_str(value: str) -> bytes:
+    value = (value or '').encode()
+    return _LENGTH.pack(len(value)) + value
+
+
+def _unpack_str(buffer: Buffer, offset: int) -> Tuple[str, int]:
+    length, = _LENGTH.unpack_from(buffer, offset)
+    offset += _LENGTH.size
+    return bytes(buffer[offset:offset + length]).decode(), offset + length
+
+
+# There are only a handful of data center addresses.
+@lru_cache(maxsize=64)
+def _pack_address(address: str) -> bytes:
+    address = ipaddress.ip_address(address)
+    if address.version == 4:
+        address = ipaddress.IPv6Address('::ffff:' + str(address))
+    return address.packed
+
+
+@lru_cache(maxsize=64)
+def _unpack_address(packed: bytes) -> str:
+    address = ipaddress.IPv6Address(packed)
+    return str(address.ipv4_mapped or address)
+
+
+def pack_header(api_id: int, api_hash: str) -> bytes:
+    return _HEADER.pack(HEADER, api_id) + _pack_str(api_hash)
+
+
+def pack_session(key: int, session: 'Session') -> bytes:
+    """Packs session metadata, the auth key is stored apart from it."""
+    info = session.info
+    return (_SESSION.pack(SESSION, key, info.id, session.dc_id,
+                          session.port,
+                          _pack_address(session.server_address))
+            + _pack_str(info.phone) + _pack_str(info.mention))
+
+
+def pack_tombstone(key: int) -> bytes:
+    return _TOMBSTONE.pack(TOMBSTONE, key)
+
+
+def pack_frame(entries: bytes, compress: bool = False) -> bytes:
+    if compress:
+        compressed = zlib.compress(entries)
+        if len(compressed) < len(entries):
+            return bytes((ZLIB,)) + compressed
+    return bytes((RAW,)) + entries
+
+
+def unpack_frame(frame: Buffer) -> Iterator[tuple]:
+    """Yields ``(HEADER, api_id, api_hash)``, ``(SESSION, key, kwargs)``
+    and ``(TOMBSTONE, key)`` entries of a decrypted frame. ``kwargs`` are
+    ``KeeperSession`` arguments but the auth key."""
+    buffer = memoryview(frame)
+    if buffer[0] == ZLIB:
+        buffer = memoryview(zlib.decompress(buffer[1:]))
+    else:
+        buffer = buffer[1:]
+    offset = 0
+    while offset < len(buffer):
+        kind = buffer[offset]
+        if kind == HEADER:
+            _, api_id = _HEADER.unpack_from(buffer, offset)
+            api_hash, offset = _unpack_str(buffer, offset + _HEADER.size)
+            yield HEADER, api_id, api_hash
+        elif kind == SESSION:
+            _, key, id_, dc_id, port, address = _SESSION.unpack_from(
+                buffer, offset
+            )
+            phone, offset = _unpack_str(buffer, offset + _SESSION.size)
+            mention, offset = _unpack_str(buffer, offset)
+            yield SESSION, key, {'id': id_, 'phone': phone,
+                                 'mention': mention, 'dc_id': dc_id,
+                                 'port': port,
+                                 'server_address': _unpack_address(address)}
+        elif kind == TOMBSTONE:
+            _, key = _TOMBSTONE.unpack_from(buffer, offset)
+            offset += _TOMBSTONE.size
+            yield TOMBSTONE, key
+        else:
+            raise ValueError(f'Unknown storage entry type: {kind}.')
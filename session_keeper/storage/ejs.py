@@ -1,52 +1,138 @@
+import asyncio
 import base64 as b64
 import json
 import os
-from typing import List, Union
+import struct
+import tempfile
+from functools import partial
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Tuple, TYPE_CHECKING, Union)
 
-from . import exceptions as exc
+from . import cipher, codec, exceptions as exc, kdf
 from .abstract import AbstractStorage
-from ..session import KeeperSession, Session
+from ..metrics import Metrics, NULL_METRICS
+
+if TYPE_CHECKING:
+    from ..session import Session
 
 
 FILENAME = 'sessions.tgsk'
-CURRENT_VERSION = b'1'
-PASS_HASH_SALT = b''
-PASS_HASH_ITERATES = 8
+CURRENT_VERSION = b'5'
+# A single Fernet token with the whole storage as JSON, read only to
+# migrate it.
+LEGACY_VERSION = b'1'
+# Ends the header line.
+RECORD_SEPARATOR = b'\n'
+FRAME_LENGTH = struct.Struct('>I')
+# Frame kind and record key, authenticated but not encrypted.
+FRAME_INFO = struct.Struct('>BI')
+META_FRAME = 0
+KEY_FRAME = 1
+MAX_HEADER_SIZE = 1024
+SAVE_DELAY = 0.5
 
 
 class EncryptedJsonStorage(AbstractStorage):
+    """Stores sessions in an append-only log of encrypted records.
+
+    The file starts with the version byte and a plain JSON line with the
+    key derivation header (see ``kdf``), followed by length-prefixed
+    AES-GCM frames. Metadata frames hold binary entries (see ``codec``):
+    the API credentials, sessions added under a record key and tombstones
+    which remove the session with that key. Every auth key is a frame of
+    its own, tagged with the record key in clear, so unlocking decrypts
+    only the metadata and an auth key is decrypted when a client needs it.
+    Adding or removing a session costs a single append, the log is
+    compacted by ``save`` into one, optionally compressed, metadata frame
+    and the key frames, which are copied as they are.
+
+    Records are written behind: changes made within ``save_delay`` seconds
+    are appended and fsynced together, ``stop`` flushes whatever is left.
+    Full rewrites go to a temporary file which then replaces the storage.
+    A ``read_only`` storage never writes the file, a version 1 file is read
+    as it is instead of being migrated.
+    """
+
     def __init__(self, password: Union[bytes, str], *,
                  filename: str = FILENAME,
-                 version: Union[bytes, int] = CURRENT_VERSION):
+                 version: Union[bytes, int] = CURRENT_VERSION,
+                 save_delay: float = SAVE_DELAY,
+                 kdf_cost: Optional[dict] = None,
+                 compress: bool = False,
+                 read_only: bool = False,
+                 metrics: Optional[Metrics] = None):
         super().__init__()
+        self._metrics = NULL_METRICS if metrics is None else metrics
         self._filename = filename
+        self._read_only = read_only
         self._version = bytes(version)
-        self._set_fernet(password)
-        self._sessions = []
+        self._save_delay = save_delay
+        self._password = password
+        self._kdf_cost = kdf_cost
+        self._compress = compress
+        self._header = None
+        self._key: Optional[bytes] = None
+        self._fernet = None
+        self._aead = None
+        if isinstance(password, bytes):
+            self._set_key(password)
+        self._sessions: Dict[int, 'Session'] = {}
+        self._keys: Dict['Session', int] = {}
+        self._by_id: Dict[int, 'Session'] = {}
+        # Phones and mentions, which fall back to display names, may
+        # repeat.
+        self._by_phone: Dict[str, List['Session']] = {}
+        self._by_mention: Dict[str, List['Session']] = {}
+        self._list: Optional[List['Session']] = None
+        self._sealed: Dict[int, memoryview] = {}
+        self._next_key = 0
+        self._garbage = 0
+        self._pending = []
+        self._rewrite = False
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock: Optional[asyncio.Lock] = None
 
     @staticmethod
-    def transform_password(
-            password: str, hash_salt: bytes, hash_iterates: int
-    ) -> bytes:
-        password = password.encode()
+    def transform_password(password: str, header: dict) -> bytes:
+        return kdf.derive(password, header)
 
-        from cryptography.hazmat.primitives import hashes
-        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    def _set_key(self, key: bytes) -> None:
+        from cryptography.fernet import Fernet
 
-        kdf = PBKDF2HMAC(hashes.SHA256(), 32, hash_salt, hash_iterates)
-        return b64.urlsafe_b64encode(kdf.derive(password))
+        # Fernet only reads version 1 files.
+        self._key = key
+        self._fernet = Fernet(key)
+        self._aead = cipher.new_aead(key)
 
-    def _set_fernet(
-            self, password: Union[bytes, str],
-            hash_salt: bytes = PASS_HASH_SALT,
-            hash_iterates: int = PASS_HASH_ITERATES
-    ) -> None:
-        from cryptography.fernet import Fernet
+    async def _unlock(self, header: dict) -> None:
+        self._header = header
+        if not isinstance(self._password, bytes):
+            self._set_key(await cipher.unlock(self._password, header,
+                                              self._metrics))
+
+    @staticmethod
+    async def _run(function: Callable, *args) -> Any:
+        """Runs blocking file I/O and crypto in the default executor, so
+        connected clients keep up with pings and updates meanwhile."""
+        return await asyncio.get_event_loop().run_in_executor(
+            None, partial(function, *args)
+        )
 
-        if isinstance(password, str):
-            password = self.transform_password(password, hash_salt,
-                                               hash_iterates)
-        self._fernet = Fernet(password)
+    def _lock(self) -> asyncio.Lock:
+        # Appends and rewrites of the file never interleave. The lock is
+        # created on first use, within the running loop.
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        return self._write_lock
+
+    async def rekey(self, kdf_cost: Optional[dict] = None) -> None:
+        """Rewrites the storage with a new salt and the given cost."""
+        # Sealed auth keys can not be copied under another key.
+        for key in self._sealed:
+            self._sessions[key].raw_auth_key
+        self._sealed.clear()
+        await self._unlock(kdf.new_header(kdf_cost))
+        await self.save()
 
     @property
     def filename(self) -> str:
@@ -60,75 +146,419 @@ class EncryptedJsonStorage(AbstractStorage):
     def api_hash(self) -> str:
         return self._api_hash
 
-    async def add_session(self, session: Session) -> None:
-        self._sessions.append(session)
+    @property
+    def kdf_header(self) -> Optional[dict]:
+        return self._header
+
+    @property
+    def key(self) -> Optional[bytes]:
+        """The key derived from the password, which opens the storage
+        without deriving it again."""
+        return self._key
 
-    async def remove_session(self, number: int) -> None:
-        self._sessions.pop(number)
+    @property
+    def garbage(self) -> int:
+        """Number of records in the file that compaction would drop."""
+        return self._garbage
 
     @property
-    def sessions(self) -> List[Session]:
-        return self._sessions
-
-    def _as_dict(self) -> dict:
-        sessions = []
-        for session in self.sessions:
-            sessions.append(session.as_dict())
-        return {'api_id': self._api_id,
-                'api_hash': self._api_hash,
-                'sessions': sessions}
-
-    def _as_json(self) -> str:
-        return json.dumps(self._as_dict())
-
-    async def _from_json(self, data: str) -> None:
-        data = json.loads(data)
-        self._api_id = data['api_id']
-        self._api_hash = data['api_hash']
-        for session in data.get('sessions'):
-            await self.add_session(KeeperSession(**session))
+    def dirty(self) -> bool:
+        return bool(self._pending) or self._rewrite
+
+    async def _append(self, *records: Tuple[int, int, bytes]) -> None:
+        # Nothing is on disk before setup, the first save writes it all.
+        if self._api_id is None:
+            return
+        self._pending.extend(records)
+        await self._schedule_flush()
+
+    async def _schedule_flush(self) -> None:
+        if not self._save_delay:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._save_delay)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except OSError:
+            # Records stay pending, stop() retries and raises.
+            pass
+
+    def _cancel_flush(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def flush(self) -> None:
+        """Writes pending records if there are any."""
+        self._cancel_flush()
+        if self._read_only:
+            return
+        async with self._lock():
+            if self._rewrite:
+                await self._save()
+            elif self._pending:
+                await self._flush()
+
+    async def _flush(self) -> None:
+        records, self._pending = self._pending, []
+        try:
+            with self._metrics.timer('storage_flush'):
+                await self._run(self._append_records, records)
+        except BaseException:
+            # A partial append may have left a torn record in the middle of
+            # the log, so the next attempt rewrites the whole file.
+            self._pending[:0] = records
+            self._rewrite = True
+            raise
+
+    def _append_records(self, records: List[Tuple[int, int, bytes]]) -> None:
+        frames = [self._encrypt_record(kind, key, data)
+                  for kind, key, data in records if kind == KEY_FRAME]
+        # Key frames go first: a torn append may orphan a key, but never
+        # leaves a session without one.
+        entries = b''.join(data for kind, _, data in records
+                           if kind == META_FRAME)
+        if entries:
+            frames.append(self._encrypt_record(
+                META_FRAME, 0, codec.pack_frame(entries)
+            ))
+        with open(self.filename, 'ab') as file:
+            file.write(b''.join(frames))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _index(self, key: int, session: 'Session') -> None:
+        info = session.info
+        self._sessions[key] = session
+        self._keys[session] = key
+        self._by_id[info.id] = session
+        self._by_phone.setdefault(info.phone, []).append(session)
+        self._by_mention.setdefault(info.mention, []).append(session)
+        self._list = None
+
+    def _unindex(self, session: 'Session') -> int:
+        key = self._keys.pop(session)
+        del self._sessions[key]
+        info = session.info
+        if self._by_id.get(info.id) is session:
+            del self._by_id[info.id]
+        for index, value in ((self._by_phone, info.phone),
+                             (self._by_mention, info.mention)):
+            sessions = index.get(value)
+            if sessions and session in sessions:
+                sessions.remove(session)
+                if not sessions:
+                    del index[value]
+        self._list = None
+        return key
+
+    def _load(self, sessions: Dict[int, 'Session']) -> None:
+        self._sessions = {}
+        self._keys = {}
+        self._by_id = {}
+        self._by_phone = {}
+        self._by_mention = {}
+        for key, session in sessions.items():
+            self._index(key, session)
+        self._next_key = max(sessions, default=-1) + 1
+
+    def get_session(self, key: Union[int, str]) -> 'Session':
+        if isinstance(key, int):
+            session = self._by_id.get(key)
+            if session is None:
+                raise exc.SessionNotFound(f'There is no session for {key}.')
+            return session
+        index = self._by_phone if key.startswith('+') else self._by_mention
+        sessions = index.get(key)
+        if not sessions:
+            raise exc.SessionNotFound(f'There is no session for {key}.')
+        if len(sessions) > 1:
+            raise exc.AmbiguousSession(f'{len(sessions)} sessions match '
+                                       f'{key}, use id:<Telegram ID>.')
+        return sessions[0]
+
+    def _add(self, session: 'Session') -> Tuple[Tuple[int, int, bytes], ...]:
+        key = self._next_key
+        self._next_key += 1
+        self._index(key, session)
+        return ((KEY_FRAME, key, session.raw_auth_key),
+                (META_FRAME, key, codec.pack_session(key, session)))
+
+    async def add_session(self, session: 'Session') -> None:
+        if session.id in self._by_id:
+            raise exc.SessionExistsError(
+                f'Session for {session.id} is already stored.'
+            )
+        await self._append(*self._add(session))
 
-    def _encrypt_sessions(self) -> bytes:
-        data = self._as_json().encode()
-        data = b64.urlsafe_b64encode(data)
-        return self._fernet.encrypt(data)
+    async def add_sessions(self, sessions: Iterable['Session']) -> None:
+        """Adds sessions with a single append, written right away."""
+        sessions = list(sessions)
+        ids = set()
+        for session in sessions:
+            if session.id in self._by_id or session.id in ids:
+                raise exc.SessionExistsError(
+                    f'Session for {session.id} is already stored.'
+                )
+            ids.add(session.id)
+        records = []
+        for session in sessions:
+            records.extend(self._add(session))
+        await self._append(*records)
+        await self.flush()
 
-    async def _decrypt_sessions(self, data: bytes) -> None:
+    def _remove(self, session: 'Session') -> Tuple[int, int, bytes]:
+        key = self._unindex(session)
+        self._sealed.pop(key, None)
+        if self._api_id is not None:
+            # The tombstone and the records it cancels are garbage now.
+            self._garbage += 3
+        return META_FRAME, key, codec.pack_tombstone(key)
+
+    async def remove_session(self, session: 'Session') -> None:
+        await self._append(self._remove(session))
+
+    async def remove_sessions(self, sessions: Iterable['Session']) -> None:
+        """Removes sessions with a single append, written right away."""
+        sessions = list(sessions)
+        for session in sessions:
+            if session not in self._keys:
+                raise exc.SessionNotFound(
+                    f'Session for {session.id} is not stored.'
+                )
+        await self._append(*map(self._remove, dict.fromkeys(sessions)))
+        await self.flush()
+
+    @property
+    def sessions(self) -> List['Session']:
+        if self._list is None:
+            self._list = list(self._sessions.values())
+        return self._list
+
+    @staticmethod
+    def _frame(kind: int, key: int, sealed: bytes) -> bytes:
+        return (FRAME_LENGTH.pack(len(sealed)) + FRAME_INFO.pack(kind, key)
+                + sealed)
+
+    def _encrypt_record(self, kind: int, key: int, data: bytes) -> bytes:
+        associated = self._version + FRAME_INFO.pack(kind, key)
+        return self._frame(kind, key,
+                           cipher.seal(self._aead, data, associated))
+
+    def _decrypt_record(self, kind: int, key: int,
+                        sealed: memoryview) -> bytes:
+        return cipher.unseal(self._aead, sealed,
+                             self._version + FRAME_INFO.pack(kind, key))
+
+    @staticmethod
+    def _iter_frames(
+            data: memoryview
+    ) -> Iterator[Tuple[int, int, memoryview]]:
+        offset = 0
+        # A frame cut short by an interrupted append ends the log.
+        while offset + FRAME_LENGTH.size + FRAME_INFO.size <= len(data):
+            length, = FRAME_LENGTH.unpack_from(data, offset)
+            offset += FRAME_LENGTH.size
+            kind, key = FRAME_INFO.unpack_from(data, offset)
+            offset += FRAME_INFO.size
+            if offset + length > len(data):
+                break
+            yield kind, key, data[offset:offset + length]
+            offset += length
+
+    def _encrypt_sessions(
+            self, sessions: Optional[Dict[int, 'Session']] = None,
+            sealed_keys: Optional[Dict[int, memoryview]] = None
+    ) -> bytes:
+        if sessions is None:
+            sessions, sealed_keys = self._sessions, self._sealed
+        entries = [codec.pack_header(self._api_id, self._api_hash)]
+        for key, session in sessions.items():
+            entries.append(codec.pack_session(key, session))
+        frame = codec.pack_frame(b''.join(entries), self._compress)
+        frames = [self._encrypt_record(META_FRAME, 0, frame)]
+        for key, session in sessions.items():
+            sealed = sealed_keys.get(key)
+            if sealed is None:
+                frames.append(self._encrypt_record(KEY_FRAME, key,
+                                                   session.raw_auth_key))
+            else:
+                frames.append(self._frame(KEY_FRAME, key, sealed))
+        return b''.join(frames)
+
+    async def _decrypt_sessions(self, data: memoryview) -> int:
+        with self._metrics.timer('storage_decrypt'):
+            return await self._run(self._unpack_frames, data)
+
+    def _unpack_frames(self, data: memoryview) -> int:
+        """Loads the frames and returns the length of the data they take,
+        which is short of the whole data after a torn append."""
+        sessions: Dict[int, dict] = {}
+        sealed_keys: Dict[int, memoryview] = {}
+        entries = 0
+        end = 0
+        for kind, key, sealed in self._iter_frames(data):
+            end += FRAME_LENGTH.size + FRAME_INFO.size + len(sealed)
+            if kind == KEY_FRAME:
+                sealed_keys[key] = sealed
+                continue
+            frame = self._decrypt_record(kind, key, sealed)
+            for entry in codec.unpack_frame(frame):
+                if entry[0] == codec.HEADER:
+                    _, self._api_id, self._api_hash = entry
+                    continue
+                entries += 1
+                if entry[0] == codec.SESSION:
+                    _, key, kwargs = entry
+                    sessions[key] = kwargs
+                else:
+                    sessions.pop(entry[1], None)
+        self._load_entries(sessions, sealed_keys)
+        self._garbage = (entries + len(sealed_keys)
+                         - len(self._sessions) - len(self._sealed))
+        return end
+
+    def _load_entries(self, sessions: Dict[int, dict],
+                      sealed_keys: Dict[int, memoryview]) -> None:
+        # Sessions are Telethon objects, Telethon is imported only once a
+        # storage is read.
+        from ..session import KeeperSession
+
+        loaded: Dict[int, Session] = {}
+        for key, kwargs in sessions.items():
+            if key not in sealed_keys:
+                continue
+            kwargs['auth_key'] = partial(self._decrypt_record, KEY_FRAME,
+                                         key, sealed_keys[key])
+            loaded[key] = KeeperSession(**kwargs)
+        self._load(loaded)
+        self._sealed = {key: sealed for key, sealed in sealed_keys.items()
+                        if key in loaded}
+
+    async def _decrypt_legacy_sessions(self, data: bytes) -> None:
         from cryptography.fernet import InvalidToken
 
+        from ..session import KeeperSession
+
         try:
             data = self._fernet.decrypt(data)
         except InvalidToken:
             raise exc.InvalidPassword
 
-        data = b64.urlsafe_b64decode(data)
-        await self._from_json(data.decode())
+        data = json.loads(b64.urlsafe_b64decode(data).decode())
+        self._api_id = data['api_id']
+        self._api_hash = data['api_hash']
+        self._load(dict(enumerate(
+            KeeperSession(**session) for session in data.get('sessions')
+        )))
 
     async def setup(self, api_id: int, api_hash: str) -> None:
         if self._api_id and self._api_hash:
             raise exc.StorageSettedError('Storage already has been setted.')
         self._api_id = api_id
         self._api_hash = api_hash
-        await self.save()
+        await self.rekey(self._kdf_cost)
 
     async def start(self):
+        with self._metrics.timer('storage_start'):
+            await self._read()
+
+    async def _read(self) -> None:
         if not os.path.isfile(self.filename):
             raise exc.StorageNotFound(f'File {self.filename} does not exist.')
+        with self._metrics.timer('storage_read'):
+            data = memoryview(await self._run(self._read_file))
+        version, data = bytes(data[:1]), data[1:]
+        if not data:
+            raise exc.StorageNotFound(f'File {self.filename} is empty.')
+        if version == self._version:
+            header, data = self._split_header(data)
+            await self._unlock(header)
+            if await self._decrypt_sessions(data) < len(data):
+                # Records appended after a torn one would never be read,
+                # the next write replaces the file instead.
+                self._rewrite = True
+            if (self._kdf_cost and not self._read_only
+                    and kdf.cost(self._kdf_cost) != kdf.cost(self._header)):
+                await self.rekey(self._kdf_cost)
+        elif (version == LEGACY_VERSION
+              and self._version == CURRENT_VERSION):
+            await self._unlock(kdf.LEGACY_HEADER)
+            with self._metrics.timer('storage_decrypt'):
+                await self._decrypt_legacy_sessions(bytes(data))
+            if not self._read_only:
+                await self.rekey(self._kdf_cost)
+        else:
+            raise exc.MismatchedVersionError('The version of the file '
+                                             'does not match the version '
+                                             'of the storage.')
+
+    def _read_file(self) -> bytes:
         with open(self.filename, 'rb') as file:
-            data = file.read()
-            version, data = data[:1], data[1:]
-            if not data:
-                raise exc.StorageNotFound(f'File {self.filename} is empty.')
-            if version != self._version:
-                raise exc.MismatchedVersionError('The version of the file '
-                                                 'does not match the version '
-                                                 'of the storage.')
-            await self._decrypt_sessions(data)
+            return file.read()
+
+    @staticmethod
+    def _split_header(data: memoryview) -> Tuple[dict, memoryview]:
+        end = bytes(data[:MAX_HEADER_SIZE]).index(RECORD_SEPARATOR)
+        return json.loads(bytes(data[:end]).decode()), data[end + 1:]
+
+    async def compact(self) -> None:
+        await self.save()
+
+    def _write_atomic(self, data: bytes,
+                      filename: Optional[str] = None) -> None:
+        filename = filename or self.filename
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temp_filename = tempfile.mkstemp(dir=directory, prefix='.tgsk-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_filename, filename)
+        except BaseException:
+            os.unlink(temp_filename)
+            raise
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
 
     async def save(self) -> None:
-        with open(self.filename, 'wb') as file:
-            file.write(self._version + self._encrypt_sessions())
-            file.flush()
+        self._cancel_flush()
+        if self._read_only:
+            return
+        async with self._lock():
+            await self._save()
+
+    async def _save(self) -> None:
+        header = self._version + json.dumps(self._header).encode()
+        # The snapshot is written in another thread, changes made meanwhile
+        # stay pending and are appended to the new file.
+        sessions = dict(self._sessions)
+        sealed_keys = dict(self._sealed)
+        self._pending.clear()
+        self._rewrite = False
+        self._garbage = 0
+        try:
+            with self._metrics.timer('storage_encrypt'):
+                data = await self._run(self._encrypt_sessions, sessions,
+                                       sealed_keys)
+            with self._metrics.timer('storage_write'):
+                await self._run(self._write_atomic,
+                                header + RECORD_SEPARATOR + data)
+        except BaseException:
+            self._rewrite = True
+            raise
 
     async def stop(self) -> None:
-        await self.save()
+        if self._garbage > len(self._sessions):
+            await self.compact()
+        else:
+            await self.flush()
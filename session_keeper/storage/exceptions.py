@@ -12,3 +12,15 @@ class MismatchedVersionError(Exception):
 
 class InvalidPassword(Exception):
     pass
+
+
+class SessionExistsError(Exception):
+    pass
+
+
+class SessionNotFound(LookupError):
+    pass
+
+
+class AmbiguousSession(LookupError):
+    pass
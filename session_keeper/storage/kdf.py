@@ -0,0 +1,87 @@
+import base64 as b64
+import os
+import time
+from typing import Optional
+
+
+PBKDF2 = 'pbkdf2-sha256'
+SCRYPT = 'scrypt'
+ALGORITHMS = (PBKDF2, SCRYPT)
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+DEFAULT_COST = {'algorithm': SCRYPT, 'n': 2 ** 15, 'r': 8, 'p': 1}
+# Version 1 files were encrypted with a fixed, unsalted key.
+LEGACY_HEADER = {'algorithm': PBKDF2, 'salt': '', 'iterations': 8}
+
+MIN_SCRYPT_N = 2 ** 14
+MAX_SCRYPT_N = 2 ** 20
+MIN_PBKDF2_ITERATIONS = 100_000
+
+
+def _cost_keys(algorithm: str) -> tuple:
+    if algorithm == PBKDF2:
+        return ('iterations',)
+    if algorithm == SCRYPT:
+        return ('n', 'r', 'p')
+    raise ValueError(f'Unknown key derivation algorithm: {algorithm}.')
+
+
+def cost(header: dict) -> dict:
+    """Returns the header without its salt."""
+    algorithm = header['algorithm']
+    return {'algorithm': algorithm,
+            **{key: header[key] for key in _cost_keys(algorithm)}}
+
+
+def new_header(kdf_cost: Optional[dict] = None) -> dict:
+    """Returns a header with a fresh random salt."""
+    header = cost(kdf_cost or DEFAULT_COST)
+    header['salt'] = b64.urlsafe_b64encode(os.urandom(SALT_SIZE)).decode()
+    return header
+
+
+def derive(password: str, header: dict) -> bytes:
+    """Derives a Fernet key with the algorithm, salt and cost parameters
+    named by the header. This is CPU bound, run it in an executor."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+    salt = b64.urlsafe_b64decode(header['salt'].encode())
+    algorithm = header['algorithm']
+    _cost_keys(algorithm)
+    if algorithm == PBKDF2:
+        kdf = PBKDF2HMAC(hashes.SHA256(), KEY_SIZE, salt,
+                         header['iterations'])
+    else:
+        kdf = Scrypt(salt, KEY_SIZE, header['n'], header['r'], header['p'])
+    return b64.urlsafe_b64encode(kdf.derive(password.encode()))
+
+
+def _measure(kdf_cost: dict) -> float:
+    header = new_header(kdf_cost)
+    started = time.perf_counter()
+    derive('calibration', header)
+    return time.perf_counter() - started
+
+
+def calibrate(target: float, algorithm: str = SCRYPT) -> dict:
+    """Picks cost parameters which take about ``target`` seconds to derive
+    a key on this machine."""
+    if algorithm == PBKDF2:
+        probe = {'algorithm': PBKDF2, 'iterations': MIN_PBKDF2_ITERATIONS}
+        iterations = probe['iterations'] * target / _measure(probe)
+        return {'algorithm': PBKDF2,
+                'iterations': max(MIN_PBKDF2_ITERATIONS, int(iterations))}
+
+    _cost_keys(algorithm)
+    probe = {'algorithm': SCRYPT, 'n': MIN_SCRYPT_N, 'r': 8, 'p': 1}
+    scale = target / _measure(probe)
+    # Time grows linearly with both n and p, but only n costs memory, so n
+    # stays a power of two under the cap and p takes the rest.
+    n = MIN_SCRYPT_N
+    while n < MAX_SCRYPT_N and scale >= 2:
+        n *= 2
+        scale /= 2
+    return {'algorithm': SCRYPT, 'n': n, 'r': 8, 'p': max(1, round(scale))}
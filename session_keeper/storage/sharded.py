@@ -0,0 +1,308 @@
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from itertools import starmap
+from typing import (Callable, Dict, List, Optional, Set, Tuple,
+                    TYPE_CHECKING, Union)
+
+from . import cipher, codec, exceptions as exc, kdf
+from .ejs import (EncryptedJsonStorage, FRAME_INFO, KEY_FRAME, META_FRAME,
+                  RECORD_SEPARATOR, SAVE_DELAY)
+from ..metrics import Metrics
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+FILENAME = 'sessions.tgss'
+SHARDED_VERSION = b'S'
+SHARDS = 16
+# Record key of the manifest frame, which no session gets.
+MANIFEST_KEY = 2 ** 32 - 1
+# Below this many bytes worker processes cost more than they save.
+PARALLEL_THRESHOLD = 2 ** 20
+
+
+def _seal(aead: 'AESGCM', version: bytes, kind: int, key: int,
+          data: bytes) -> bytes:
+    associated = version + FRAME_INFO.pack(kind, key)
+    return EncryptedJsonStorage._frame(kind, key,
+                                       cipher.seal(aead, data, associated))
+
+
+def _decrypt_shard(key: bytes, version: bytes, index: int,
+                   frames: List[bytes]) -> List[tuple]:
+    """Decrypts and unpacks metadata frames of a shard. Runs in worker
+    processes, so it takes and returns only plain data."""
+    aead = cipher.new_aead(key)
+    associated = version + FRAME_INFO.pack(META_FRAME, index)
+    entries = []
+    for sealed in frames:
+        entries.extend(codec.unpack_frame(cipher.unseal(aead, sealed,
+                                                        associated)))
+    return entries
+
+
+def _encrypt_shard(key: bytes, version: bytes, index: int, entries: bytes,
+                   auth_keys: List[Tuple[int, bytes]],
+                   compress: bool) -> bytes:
+    """Encrypts metadata and new auth keys of a shard in a worker
+    process."""
+    aead = cipher.new_aead(key)
+    frames = [_seal(aead, version, META_FRAME, index,
+                    codec.pack_frame(entries, compress))]
+    for record_key, auth_key in auth_keys:
+        frames.append(_seal(aead, version, KEY_FRAME, record_key, auth_key))
+    return b''.join(frames)
+
+
+class ShardedStorage(EncryptedJsonStorage):
+    """Spreads sessions over ``shards`` encrypted files, so they are
+    decrypted and encrypted in parallel and a change rewrites only the
+    shard of the session.
+
+    The manifest at ``filename`` holds the version byte, a plain JSON line
+    with the key derivation header, the number of shards and their
+    generation, and a frame with the API credentials. A session with record
+    key ``k`` lives in ``<filename>.<generation>.<k % shards>``, which holds
+    the version byte, one metadata frame bound to the shard number and
+    the key frames of its sessions (see ``EncryptedJsonStorage``).
+
+    Shards are rewritten whole, atomically, ``save_delay`` seconds after a
+    change. Rekeying and resharding write a new generation of shards before
+    the manifest, so a crash leaves either the old or the new one. Large
+    storages use up to ``processes`` worker processes, the CPU count by
+    default.
+    """
+
+    def __init__(self, password: Union[bytes, str], *,
+                 filename: str = FILENAME,
+                 shards: Optional[int] = None,
+                 processes: Optional[int] = None,
+                 save_delay: float = SAVE_DELAY,
+                 kdf_cost: Optional[dict] = None,
+                 compress: bool = False,
+                 metrics: Optional[Metrics] = None):
+        super().__init__(password, filename=filename,
+                         version=SHARDED_VERSION, save_delay=save_delay,
+                         kdf_cost=kdf_cost, compress=compress,
+                         metrics=metrics)
+        self._requested_shards = shards
+        self._shards = shards or SHARDS
+        self._generation = 0
+        self._processes = (os.cpu_count() or 1
+                           if processes is None else processes)
+        self._executor: Optional[Executor] = None
+        self._changed: Set[int] = set()
+
+    @property
+    def shards(self) -> int:
+        return self._shards
+
+    @property
+    def garbage(self) -> int:
+        return 0
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._changed) or self._rewrite
+
+    def _shard_filename(self, index: int) -> str:
+        return f'{self.filename}.{self._generation}.{index}'
+
+    def _executor_for(self, size: int) -> Optional[Executor]:
+        if (self._processes <= 1 or self._shards <= 1
+                or size < PARALLEL_THRESHOLD):
+            return None
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                min(self._processes, self._shards)
+            )
+        return self._executor
+
+    async def _map(self, function: Callable, jobs: List[tuple],
+                   size: int) -> list:
+        executor = self._executor_for(size)
+        if executor is None:
+            return await self._run(list, starmap(function, jobs))
+        loop = asyncio.get_event_loop()
+        return await asyncio.gather(*(
+            loop.run_in_executor(executor, partial(function, *job))
+            for job in jobs
+        ))
+
+    async def rekey(self, kdf_cost: Optional[dict] = None) -> None:
+        self._generation += 1
+        self._rewrite = True
+        await super().rekey(kdf_cost)
+
+    async def _append(self, *records: Tuple[int, int, bytes]) -> None:
+        self._changed.update(key % self._shards for _, key, _ in records)
+        if self._api_id is None:
+            return
+        await self._schedule_flush()
+
+    async def flush(self) -> None:
+        self._cancel_flush()
+        if self.dirty:
+            await self.save()
+
+    async def _read(self) -> None:
+        if not os.path.isfile(self.filename):
+            raise exc.StorageNotFound(f'File {self.filename} does not exist.')
+        with self._metrics.timer('storage_read'):
+            data = memoryview(await self._run(self._read_file))
+            version, data = bytes(data[:1]), data[1:]
+            if not data:
+                raise exc.StorageNotFound(f'File {self.filename} is empty.')
+            if version != self._version:
+                raise exc.MismatchedVersionError('The version of the file '
+                                                 'does not match the version '
+                                                 'of the storage.')
+            manifest, data = self._split_header(data)
+            self._shards = manifest['shards']
+            self._generation = manifest['generation']
+            shards = await asyncio.gather(*(
+                self._run(self._read_shard, index)
+                for index in range(self._shards)
+            ))
+        await self._unlock(manifest['kdf'])
+        for kind, key, sealed in self._iter_frames(data):
+            for entry in codec.unpack_frame(
+                    self._decrypt_record(kind, key, sealed)
+            ):
+                _, self._api_id, self._api_hash = entry
+        with self._metrics.timer('storage_decrypt'):
+            await self._decrypt_shards(shards)
+
+        resize = self._requested_shards not in (None, self._shards)
+        if resize:
+            self._shards = self._requested_shards
+        if (self._kdf_cost
+                and kdf.cost(self._kdf_cost) != kdf.cost(self._header)):
+            await self.rekey(self._kdf_cost)
+        elif resize:
+            self._generation += 1
+            self._rewrite = True
+            await self.save()
+
+    def _read_shard(self, index: int) -> memoryview:
+        filename = self._shard_filename(index)
+        try:
+            with open(filename, 'rb') as file:
+                data = memoryview(file.read())
+        except FileNotFoundError:
+            raise exc.StorageNotFound(f'Shard {filename} does not exist.')
+        if bytes(data[:1]) != self._version:
+            raise exc.MismatchedVersionError(f'The version of {filename} '
+                                             f'does not match the version '
+                                             f'of the storage.')
+        return data[1:]
+
+    async def _decrypt_shards(self, shards: List[memoryview]) -> None:
+        jobs = []
+        sealed_keys: Dict[int, memoryview] = {}
+        for index, data in enumerate(shards):
+            frames = []
+            for kind, key, sealed in self._iter_frames(data):
+                if kind == KEY_FRAME:
+                    sealed_keys[key] = sealed
+                else:
+                    frames.append(bytes(sealed))
+            jobs.append((self._key, self._version, index, frames))
+        results = await self._map(_decrypt_shard, jobs,
+                                  sum(map(len, shards)))
+        sessions: Dict[int, dict] = {}
+        for entries in results:
+            for entry in entries:
+                if entry[0] == codec.SESSION:
+                    sessions[entry[1]] = entry[2]
+        # Sessions are listed in the order they were added.
+        self._load_entries(dict(sorted(sessions.items())), sealed_keys)
+
+    def _manifest(self) -> bytes:
+        header = {'kdf': self._header, 'shards': self._shards,
+                  'generation': self._generation}
+        frame = self._encrypt_record(META_FRAME, MANIFEST_KEY,
+                                     codec.pack_frame(codec.pack_header(
+                                         self._api_id, self._api_hash
+                                     )))
+        return (self._version + json.dumps(header).encode()
+                + RECORD_SEPARATOR + frame)
+
+    async def _encrypt_shards(self, shards: Set[int]) -> Dict[int, bytes]:
+        keys: Dict[int, List[int]] = {index: [] for index in shards}
+        for key in self._sessions:
+            shard = keys.get(key % self._shards)
+            if shard is not None:
+                shard.append(key)
+
+        jobs = []
+        copied = {}
+        size = 0
+        for index, shard in keys.items():
+            entries = b''.join(codec.pack_session(key, self._sessions[key])
+                               for key in shard)
+            auth_keys = []
+            frames = []
+            for key in shard:
+                sealed = self._sealed.get(key)
+                if sealed is None:
+                    auth_keys.append((key,
+                                      self._sessions[key].raw_auth_key))
+                else:
+                    frames.append(self._frame(KEY_FRAME, key, sealed))
+            copied[index] = b''.join(frames)
+            size += len(entries) + len(copied[index])
+            jobs.append((self._key, self._version, index, entries, auth_keys,
+                         self._compress))
+        results = await self._map(_encrypt_shard, jobs, size)
+        return {index: result + copied[index]
+                for index, result in zip(keys, results)}
+
+    def _remove_stale_shards(self) -> None:
+        directory, name = os.path.split(os.path.abspath(self.filename))
+        pattern = re.compile(re.escape(name) + r'\.(\d+)\.(\d+)')
+        for entry in os.listdir(directory):
+            match = pattern.fullmatch(entry)
+            if (match and (int(match[1]) != self._generation
+                           or int(match[2]) >= self._shards)):
+                try:
+                    os.unlink(os.path.join(directory, entry))
+                except FileNotFoundError:
+                    pass
+
+    def _write_shards(self, data: Dict[int, bytes], rewrite: bool) -> None:
+        for index, body in data.items():
+            self._write_atomic(self._version + body,
+                               self._shard_filename(index))
+        if rewrite:
+            self._write_atomic(self._manifest())
+            self._remove_stale_shards()
+
+    async def _save(self) -> None:
+        # Rewrites changed shards, or every shard and the manifest after
+        # rekeying or resharding.
+        rewrite = self._rewrite
+        shards = set(range(self._shards)) if rewrite else self._changed
+        self._changed = set()
+        try:
+            with self._metrics.timer('storage_encrypt'):
+                data = await self._encrypt_shards(shards)
+            with self._metrics.timer('storage_write'):
+                await self._run(self._write_shards, data, rewrite)
+        except BaseException:
+            self._changed |= shards
+            raise
+        self._rewrite = False
+
+    async def stop(self) -> None:
+        try:
+            await self.flush()
+        finally:
+            if self._executor is not None:
+                await self._run(self._executor.shutdown)
+                self._executor = None
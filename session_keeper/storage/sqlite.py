@@ -0,0 +1,410 @@
+import asyncio
+import base64 as b64
+import hashlib
+import hmac
+import json
+import os
+import sqlite3
+from functools import partial
+from itertools import starmap
+from typing import (Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING,
+                    Union)
+
+from . import cipher, codec, exceptions as exc, kdf
+from .abstract import AbstractStorage
+from .ejs import EncryptedJsonStorage, FRAME_INFO, KEY_FRAME, META_FRAME
+from ..metrics import Metrics, NULL_METRICS
+
+if TYPE_CHECKING:
+    from ..session import Session
+
+
+FILENAME = 'sessions.db'
+SQLITE_VERSION = b'Q'
+SCHEMA_VERSION = 1
+# Record key of the API credentials, which no session gets.
+META_KEY = 2 ** 32 - 1
+HASH_SIZE = 16
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    key INTEGER PRIMARY KEY,
+    id_hash BLOB NOT NULL UNIQUE,
+    phone_hash BLOB NOT NULL,
+    mention_hash BLOB NOT NULL,
+    data BLOB NOT NULL,
+    auth_key BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_phone ON sessions (phone_hash);
+CREATE INDEX IF NOT EXISTS sessions_mention ON sessions (mention_hash);
+'''
+INSERT = 'INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?)'
+
+Row = Tuple[int, bytes, bytes, bytes, bytes, bytes]
+
+
+class SqliteStorage(AbstractStorage):
+    """Stores every session in a row of an SQLite database in WAL mode, so
+    adding or removing one is a single small transaction.
+
+    Rows hold the session metadata (see ``codec``) and the auth key
+    encrypted apart with AES-GCM, bound to the record key. Telegram ID,
+    phone and mention are looked up by keyed hashes, so the database keeps
+    no plain identifiers, and ``get_session`` decrypts only the row it
+    finds. The whole table is read once ``sessions`` are needed, or ahead
+    of it by ``load_sessions``. The key derivation header (see ``kdf``) and
+    the API credentials are kept in the ``meta`` table.
+
+    Bulk encryption and decryption run in the default executor. The
+    connection stays on the loop's thread, rows are written and read
+    there.
+    """
+
+    def __init__(self, password: Union[bytes, str], *,
+                 filename: str = FILENAME,
+                 kdf_cost: Optional[dict] = None,
+                 metrics: Optional[Metrics] = None):
+        super().__init__()
+        self._metrics = NULL_METRICS if metrics is None else metrics
+        self._filename = filename
+        self._password = password
+        self._kdf_cost = kdf_cost
+        self._db: Optional[sqlite3.Connection] = None
+        self._header = None
+        self._key: Optional[bytes] = None
+        self._aead = None
+        self._lookup_key = None
+        if isinstance(password, bytes):
+            self._set_key(password)
+        self._sessions: Dict[int, 'Session'] = {}
+        self._keys: Dict['Session', int] = {}
+        self._list: Optional[List['Session']] = None
+        self._next_key = 0
+        self._write_lock: Optional[asyncio.Lock] = None
+
+    transform_password = staticmethod(kdf.derive)
+    _run = staticmethod(EncryptedJsonStorage._run)
+
+    def _lock(self) -> asyncio.Lock:
+        # Keys of new rows and the encryption key stay the same while rows
+        # are encrypted in another thread.
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+        return self._write_lock
+
+    def _set_key(self, key: bytes) -> None:
+        self._key = key
+        self._aead = cipher.new_aead(key)
+        self._lookup_key = hmac.new(b64.urlsafe_b64decode(key), b'lookup',
+                                    hashlib.sha256).digest()
+
+    async def _unlock(self, header: dict) -> None:
+        self._header = header
+        if not isinstance(self._password, bytes):
+            self._set_key(await cipher.unlock(self._password, header,
+                                              self._metrics))
+
+    @property
+    def filename(self) -> str:
+        return self._filename
+
+    @property
+    def api_id(self) -> int:
+        return self._api_id
+
+    @property
+    def api_hash(self) -> str:
+        return self._api_hash
+
+    @property
+    def kdf_header(self) -> Optional[dict]:
+        return self._header
+
+    def _connect(self) -> None:
+        if self._db is not None:
+            return
+        db = sqlite3.connect(self.filename)
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            # A commit may be lost on power failure, but never corrupts
+            # the database.
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(SCHEMA)
+        except sqlite3.DatabaseError as e:
+            db.close()
+            raise exc.MismatchedVersionError(
+                f'File {self.filename} is not an SQLite storage.'
+            ) from e
+        self._db = db
+
+    def _hash(self, kind: str, value: Union[int, str]) -> bytes:
+        return hmac.new(self._lookup_key, f'{kind}:{value}'.encode(),
+                        hashlib.sha256).digest()[:HASH_SIZE]
+
+    def _seal(self, kind: int, key: int, data: bytes) -> bytes:
+        return cipher.seal(self._aead, data,
+                           SQLITE_VERSION + FRAME_INFO.pack(kind, key))
+
+    def _open(self, kind: int, key: int, sealed: bytes) -> bytes:
+        return cipher.unseal(self._aead, sealed,
+                             SQLITE_VERSION + FRAME_INFO.pack(kind, key))
+
+    def _row(self, key: int, session: 'Session') -> Row:
+        info = session.info
+        data = codec.pack_frame(codec.pack_session(key, session))
+        return (key, self._hash('id', info.id),
+                self._hash('phone', info.phone),
+                self._hash('mention', info.mention),
+                self._seal(META_FRAME, key, data),
+                self._seal(KEY_FRAME, key, session.raw_auth_key))
+
+    def _unpack_row(self, key: int, data: bytes, auth_key: bytes) -> dict:
+        (_, _, kwargs), = codec.unpack_frame(self._open(META_FRAME, key,
+                                                        data))
+        kwargs['auth_key'] = partial(self._open, KEY_FRAME, key, auth_key)
+        return kwargs
+
+    def _build(self, key: int, data: bytes, auth_key: bytes) -> 'Session':
+        session = self._sessions.get(key)
+        if session is not None:
+            return session
+        return self._session(key, self._unpack_row(key, data, auth_key))
+
+    def _session(self, key: int, kwargs: dict) -> 'Session':
+        from ..session import KeeperSession
+
+        session = self._sessions[key] = KeeperSession(**kwargs)
+        self._keys[session] = key
+        return session
+
+    def get_session(self, key: Union[int, str]) -> 'Session':
+        if isinstance(key, int):
+            column, lookup = 'id_hash', self._hash('id', key)
+        elif key.startswith('+'):
+            column, lookup = 'phone_hash', self._hash('phone', key)
+        else:
+            column, lookup = 'mention_hash', self._hash('mention', key)
+        # A second row is enough to tell that the key is ambiguous.
+        rows = self._db.execute(
+            f'SELECT key, data, auth_key FROM sessions WHERE {column} = ? '
+            f'LIMIT 2', (lookup,)
+        ).fetchall()
+        if not rows:
+            raise exc.SessionNotFound(f'There is no session for {key}.')
+        if len(rows) > 1:
+            count, = self._db.execute(
+                f'SELECT COUNT(*) FROM sessions WHERE {column} = ?',
+                (lookup,)
+            ).fetchone()
+            raise exc.AmbiguousSession(f'{count} sessions match {key}, use '
+                                       f'id:<Telegram ID>.')
+        return self._build(*rows[0])
+
+    @property
+    def sessions(self) -> List['Session']:
+        if self._list is None:
+            with self._metrics.timer('storage_decrypt'):
+                rows = self._db.execute('SELECT key, data, auth_key '
+                                        'FROM sessions ORDER BY key')
+                self._list = [self._build(*row) for row in rows]
+        return self._list
+
+    async def load_sessions(self) -> None:
+        if self._list is not None:
+            return
+        with self._metrics.timer('storage_decrypt'):
+            rows = self._db.execute('SELECT key, data, auth_key '
+                                    'FROM sessions ORDER BY key').fetchall()
+            unpacked = dict(zip(
+                (row[0] for row in rows),
+                await self._run(list, starmap(self._unpack_row, rows))
+            ))
+        if self._list is not None:
+            return
+        # Rows may have been added or removed meanwhile, added sessions
+        # and ones already found are cached.
+        keys = self._db.execute('SELECT key FROM sessions ORDER BY key')
+        self._list = [self._sessions.get(key)
+                      or self._session(key, unpacked[key])
+                      for key, in keys]
+
+    async def add_session(self, session: 'Session') -> None:
+        async with self._lock():
+            key = self._next_key
+            try:
+                with self._metrics.timer('storage_write'), self._db:
+                    self._db.execute(INSERT, self._row(key, session))
+            except sqlite3.IntegrityError:
+                raise exc.SessionExistsError(
+                    f'Session for {session.id} is already stored.'
+                ) from None
+            self._next_key += 1
+            self._cache(key, session)
+
+    async def add_sessions(self, sessions: Iterable['Session']) -> None:
+        """Adds sessions in a single transaction."""
+        sessions = list(sessions)
+        async with self._lock():
+            keys = range(self._next_key, self._next_key + len(sessions))
+            with self._metrics.timer('storage_encrypt'):
+                rows = await self._run(list, starmap(self._row,
+                                                     zip(keys, sessions)))
+            try:
+                with self._metrics.timer('storage_write'), self._db:
+                    self._db.executemany(INSERT, rows)
+            except sqlite3.IntegrityError:
+                raise exc.SessionExistsError(
+                    'One of the sessions is already stored.'
+                ) from None
+            self._next_key += len(sessions)
+            for key, session in zip(keys, sessions):
+                self._cache(key, session)
+
+    def _cache(self, key: int, session: 'Session') -> None:
+        self._sessions[key] = session
+        self._keys[session] = key
+        if self._list is not None:
+            self._list.append(session)
+
+    async def remove_session(self, session: 'Session') -> None:
+        await self.remove_sessions((session,))
+
+    async def remove_sessions(self, sessions: Iterable['Session']) -> None:
+        """Removes sessions in a single transaction."""
+        sessions = list(dict.fromkeys(sessions))
+        async with self._lock():
+            keys = []
+            for session in sessions:
+                key = self._keys.get(session)
+                if key is None:
+                    raise exc.SessionNotFound(
+                        f'Session for {session.id} is not stored.'
+                    )
+                keys.append((key,))
+            with self._metrics.timer('storage_write'), self._db:
+                self._db.executemany('DELETE FROM sessions WHERE key = ?',
+                                     keys)
+        for session, (key,) in zip(sessions, keys):
+            del self._keys[session]
+            del self._sessions[key]
+        if self._list is not None:
+            removed = set(sessions)
+            self._list = [session for session in self._list
+                          if session not in removed]
+
+    def _write_meta(self) -> None:
+        api = codec.pack_frame(codec.pack_header(self._api_id,
+                                                 self._api_hash))
+        self._db.executemany(
+            'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+            (('version', SCHEMA_VERSION),
+             ('kdf', json.dumps(self._header)),
+             ('api', self._seal(META_FRAME, META_KEY, api)))
+        )
+
+    async def setup(self, api_id: int, api_hash: str) -> None:
+        if self._api_id and self._api_hash:
+            raise exc.StorageSettedError('Storage already has been setted.')
+        self._connect()
+        self._api_id = api_id
+        self._api_hash = api_hash
+        await self.rekey(self._kdf_cost)
+
+    async def rekey(self, kdf_cost: Optional[dict] = None) -> None:
+        """Re-encrypts every row with a new salt and the given cost."""
+        await self.load_sessions()
+        async with self._lock():
+            sessions = self.sessions
+            # Auth keys are decrypted before the old key is gone.
+            with self._metrics.timer('storage_decrypt'):
+                await self._run(list, (session.raw_auth_key
+                                       for session in sessions))
+            await self._unlock(kdf.new_header(kdf_cost))
+            with self._metrics.timer('storage_encrypt'):
+                rows = await self._run(list, starmap(self._row, (
+                    (self._keys[session], session) for session in sessions
+                )))
+            with self._metrics.timer('storage_write'), self._db:
+                self._db.execute('DELETE FROM sessions')
+                self._db.executemany(INSERT, rows)
+                self._write_meta()
+
+    async def migrate(self, filename: str) -> None:
+        """Creates the database from an ``EncryptedJsonStorage`` file,
+        which is only read. The password, key derivation header and
+        therefore the key are kept, so no key is derived twice, and
+        sessions are copied in one transaction. A database created here is
+        removed if the migration fails."""
+        source = EncryptedJsonStorage(self._password, filename=filename,
+                                      read_only=True, metrics=self._metrics)
+        # The source is checked before anything is created.
+        await source.start()
+        created = not os.path.exists(self.filename)
+        self._connect()
+        try:
+            meta = self._db.execute("SELECT 1 FROM meta WHERE name = 'api'")
+            if meta.fetchone():
+                raise exc.StorageSettedError(f'{self.filename} already '
+                                             f'holds sessions.')
+            self._header = source.kdf_header
+            self._set_key(source.key)
+            self._api_id = source.api_id
+            self._api_hash = source.api_hash
+            with self._metrics.timer('storage_encrypt'):
+                rows = await self._run(list, starmap(
+                    self._row, enumerate(source.sessions)
+                ))
+            with self._metrics.timer('storage_write'), self._db:
+                self._db.executemany(INSERT, rows)
+                self._write_meta()
+            self._next_key = len(rows)
+            if not self._header['salt']:
+                # A version 1 file has the fixed, unsalted key.
+                await self.rekey(self._kdf_cost)
+        except BaseException:
+            if created:
+                await self.stop()
+                for suffix in ('', '-wal', '-shm'):
+                    try:
+                        os.unlink(self.filename + suffix)
+                    except FileNotFoundError:
+                        pass
+            raise
+
+    async def start(self) -> None:
+        if not os.path.isfile(self.filename):
+            raise exc.StorageNotFound(f'File {self.filename} does not exist.')
+        with self._metrics.timer('storage_start'):
+            await self._read()
+
+    async def _read(self) -> None:
+        self._connect()
+        meta = dict(self._db.execute('SELECT name, value FROM meta'))
+        if 'api' not in meta:
+            raise exc.StorageNotFound(f'File {self.filename} is empty.')
+        if meta['version'] != SCHEMA_VERSION:
+            raise exc.MismatchedVersionError('The version of the file '
+                                             'does not match the version '
+                                             'of the storage.')
+        await self._unlock(json.loads(meta['kdf']))
+        (_, self._api_id, self._api_hash), = codec.unpack_frame(
+            self._open(META_FRAME, META_KEY, meta['api'])
+        )
+        last, = self._db.execute('SELECT MAX(key) FROM sessions').fetchone()
+        self._next_key = 0 if last is None else last + 1
+        if (self._kdf_cost
+                and kdf.cost(self._kdf_cost) != kdf.cost(self._header)):
+            await self.rekey(self._kdf_cost)
+
+    async def save(self) -> None:
+        # Every change is committed as it is made.
+        pass
+
+    async def stop(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -1,11 +1,13 @@
 import os
 from random import randint
 from tempfile import NamedTemporaryFile
-from typing import Iterator, Tuple
+from typing import Callable, Iterator, Tuple
 
 import pytest
 from session_keeper.session import Session
 from telethon import TelegramClient
+from telethon.crypto import AuthKey
+from telethon.tl.types import User
 
 
 @pytest.fixture
@@ -49,3 +51,19 @@ async def client_with_session(
 def temp_file() -> Iterator[str]:
     file = NamedTemporaryFile('wb')
     yield file.name
+
+
+@pytest.fixture
+def make_session() -> Callable[..., Session]:
+    """Builds an offline session with a random auth key."""
+    def make(user_id: int, *,
+             server_address: str = '149.154.167.40') -> Session:
+        session = Session()
+        session.set_dc(2, server_address, 443)
+        session.auth_key = AuthKey(os.urandom(256))
+        session.process_entities([User(
+            user_id, access_hash=0, username=f'user{user_id}',
+            phone=f'7999{user_id:07d}', first_name=f'User {user_id}'
+        )])
+        return session
+    return make
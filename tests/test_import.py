@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+
+# Cumulative import time of the package in microseconds, Telethon alone
+# takes about twice as much.
+IMPORT_BUDGET = 200_000
+HEAVY_MODULES = ('telethon', 'tabulate')
+
+
+def import_times(*args: str) -> dict:
+    process = subprocess.run((sys.executable, '-X', 'importtime', *args),
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def assert_light(times: dict) -> None:
+    heavy = [module for module in times
+             if module.split('.')[0] in HEAVY_MODULES]
+    assert heavy == []
+
+
+def test_import_is_light():
+    times = import_times('-c', 'import session_keeper')
+    assert_light(times)
+    assert times['session_keeper'] < IMPORT_BUDGET
+
+
+def test_help_is_light():
+    assert_light(import_times('-m', 'session_keeper', '--help'))
+
+
+def test_offline_storage_is_light():
+    assert_light(import_times('-c', (
+        'import asyncio, tempfile\n'
+        'from session_keeper.storage import EncryptedJsonStorage\n'
+        'storage = EncryptedJsonStorage("qwerty",\n'
+        '                               filename=tempfile.mktemp())\n'
+        'asyncio.run(storage.setup(1, "hash"))'
+    )))
@@ -1,13 +1,36 @@
-from typing import Iterator
+import asyncio
+import json
+import os
+import queue
+import signal
+import sys
+import time
+from typing import Callable, Iterator
 
 import pytest
-from session_keeper import BaseKeeper
+from session_keeper import BaseKeeper, CLIKeeper, EncryptedJsonStorage
+from session_keeper.keeper import (AgentClient, AgentError, base,
+                                   ClientUnavailable, KeeperAgent,
+                                   SessionUnauthorized)
+from session_keeper.keeper.args import parse_args, PASSWORD_ENV
+from session_keeper.keeper.batch import run_batch
+from session_keeper.keeper.console import Console
+from session_keeper.keeper.fake import FakeBackend
+from session_keeper.keeper.health import (HealthChecker, OK, REVOKED,
+                                          UNREACHABLE)
+from session_keeper.keeper.transfer import (dump_string_session, DUPLICATE,
+                                            FAILED, IMPORTED, iter_sources,
+                                            load_session_file,
+                                            write_session_file)
+from session_keeper.metrics import Metrics
 from session_keeper.session import Session
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 
 
 PASSWORD = 'qwerty'
 TEST_MODE = True
+DEAD_USER = 3
 
 
 pytestmark = pytest.mark.asyncio
@@ -25,6 +48,38 @@ class Keeper(BaseKeeper):
         pass
 
 
+def last_message(backend: FakeBackend, user_id: int) -> str:
+    return backend.history(user_id)[-1].message
+
+
+@pytest.fixture
+def backend() -> FakeBackend:
+    return FakeBackend(dead=(DEAD_USER,), seed=0)
+
+
+@pytest.fixture
+async def fake_storage(
+        temp_file: str, make_session: Callable[..., Session]
+) -> str:
+    storage = EncryptedJsonStorage(PASSWORD, filename=temp_file)
+    await storage.setup(1, 'hash')
+    for user_id in range(8):
+        await storage.add_session(make_session(user_id))
+    await storage.save()
+    return temp_file
+
+
+@pytest.fixture
+async def fake_keeper(fake_storage: str,
+                      backend: FakeBackend) -> Iterator[Keeper]:
+    keeper = Keeper()
+    await keeper.start(PASSWORD, filename=fake_storage,
+                       concurrency=4, client_timeout=0.1, pool_size=2,
+                       client_factory=backend)
+    yield keeper
+    await keeper.stop()
+
+
 @pytest.fixture
 async def keeper(
         api_id: str, api_hash: str, temp_file: str,
@@ -35,7 +90,7 @@ async def keeper(
     keeper.api_hash = api_hash
     await keeper.start(PASSWORD, test_mode=TEST_MODE, filename=temp_file)
     await keeper._storage.add_session(client_with_session.session)
-    keeper._clients.append(client_with_session)
+    keeper._put_client(client_with_session)
     yield keeper
     await keeper.stop()
 
@@ -58,7 +113,7 @@ async def test_properties(keeper: Keeper):
 async def test_remove(keeper: Keeper):
     await keeper.remove(0)
     assert len(keeper._storage.sessions) == 0
-    assert len(keeper._clients) == 0
+    assert len(keeper._pool) == 0
 
 
 async def test_list(keeper: Keeper):
@@ -70,3 +125,653 @@ async def test_get(keeper: Keeper, api_id: int, api_hash: str):
                                                (await keeper.list())[0])
     msg = await keeper.get(0)
     assert msg
+
+
+async def test_start_is_lazy(fake_keeper: Keeper, backend: FakeBackend):
+    assert len(fake_keeper._pool) == 0
+    session = fake_keeper.get_session('@user0')
+    assert fake_keeper.latest_message(session) is None
+    assert (await fake_keeper.get(0)).message == last_message(backend, 0)
+    assert len(fake_keeper._pool) == 1
+    assert fake_keeper.latest_message(session).message \
+        == last_message(backend, 0)
+
+
+async def test_pool_evicts_least_recently_used(fake_keeper: Keeper):
+    sessions = await fake_keeper.list()
+    for number in (0, 1, 0, 2):
+        await fake_keeper.get(number)
+    assert list(fake_keeper._pool._entries) == [sessions[0], sessions[2]]
+
+
+async def test_get_by_key(fake_keeper: Keeper, backend: FakeBackend):
+    for key, user_id in (('+79990000005', 5), ('@user6', 6), ('id:7', 7)):
+        message = await fake_keeper.get(key)
+        assert message.message == last_message(backend, user_id)
+    with pytest.raises(LookupError):
+        await fake_keeper.get('@nobody')
+
+
+async def test_dead_session_is_reported(fake_keeper: Keeper):
+    sessions = await fake_keeper.list()
+    with pytest.raises(ClientUnavailable):
+        await fake_keeper.get(DEAD_USER)
+    assert list(fake_keeper.failures) == [sessions[DEAD_USER]]
+    assert isinstance(fake_keeper.failures[sessions[DEAD_USER]],
+                      asyncio.TimeoutError)
+    assert await fake_keeper.get(4)
+
+
+async def test_unauthorized_session_is_reported(fake_keeper: Keeper,
+                                                backend: FakeBackend):
+    backend.unauthorized.add(2)
+    with pytest.raises(ClientUnavailable):
+        await fake_keeper.get(2)
+    assert isinstance(fake_keeper.failures[(await fake_keeper.list())[2]],
+                      SessionUnauthorized)
+
+
+async def test_get_all(fake_keeper: Keeper, backend: FakeBackend):
+    results = [result async for result in fake_keeper.get_all()]
+    assert len(results) == 8
+    failed = [result for result in results if not result.ok]
+    assert [result.session.id for result in failed] == [DEAD_USER]
+    assert isinstance(failed[0].error, ClientUnavailable)
+    assert all(result.result.message == last_message(backend,
+                                                     result.session.id)
+               for result in results if result.ok)
+    # The dead session waits for its timeout, so it finishes last.
+    assert results[-1] is failed[0]
+
+
+async def test_get_all_filtered(fake_keeper: Keeper):
+    results = [result async for result
+               in fake_keeper.get_all(['@user1', 'id:5'], concurrency=1)]
+    assert [result.session.id for result in results] == [1, 5]
+    assert all(result.elapsed >= 0 for result in results)
+
+
+async def test_run_batch_stops_with_consumer():
+    started = []
+
+    async def func(number: int) -> int:
+        started.append(number)
+        await asyncio.sleep(0.01)
+        return number
+
+    results = run_batch(range(100), func, 4)
+    async for _ in results:
+        break
+    await results.aclose()
+    await asyncio.sleep(0.05)
+    # Workers are cancelled, not left to run the rest in the background.
+    assert len(started) < 10
+
+
+async def test_get_all_flood_wait(fake_keeper: Keeper, backend: FakeBackend):
+    backend.flood_wait = 1.0
+    results = [result async for result in fake_keeper.get_all([0, 1])]
+    assert all(isinstance(result.error, ClientUnavailable)
+               for result in results)
+    assert all(isinstance(error, FloodWaitError)
+               for error in fake_keeper.failures.values())
+
+
+async def test_get_all_under_load(temp_file: str,
+                                  make_session: Callable[..., Session]):
+    storage = EncryptedJsonStorage(PASSWORD, filename=temp_file)
+    await storage.setup(1, 'hash')
+    storage._load({user_id: make_session(user_id)
+                   for user_id in range(2000)})
+    await storage.save()
+    backend = FakeBackend(latency=(0.01, 0.05), flood_wait=0.01, seed=0)
+    keeper = Keeper()
+    await keeper.start(PASSWORD, filename=temp_file, concurrency=256,
+                       pool_size=2000, client_factory=backend)
+    try:
+        results = [result async for result in keeper.get_all()]
+    finally:
+        await keeper.stop()
+    assert len(results) == 2000
+    errors = [result.error for result in results if not result.ok]
+    assert 0 < len(errors) < 200
+    # Flood waits on connecting are reported as failures to connect.
+    assert all(isinstance(error, (ClientUnavailable, FloodWaitError))
+               for error in errors)
+
+
+async def test_stop_disconnects_clients(fake_keeper: Keeper):
+    await fake_keeper.get(0)
+    await fake_keeper.get(1)
+    clients = list(fake_keeper._pool)
+    await fake_keeper.stop()
+    assert not any(client.is_connected() for client in clients)
+
+
+async def test_get_is_served_from_updates(fake_keeper: Keeper,
+                                          backend: FakeBackend):
+    await fake_keeper.get(0)
+    requests = backend.requests
+    message = await backend.send(0, 'code 12345')
+    assert await fake_keeper.get(0) is message
+    assert backend.requests == requests
+    # An evicted client gets no updates, so its cache is dropped.
+    await fake_keeper.get(1)
+    await fake_keeper.get(2)
+    await backend.send(0)
+    assert await fake_keeper.get(0) is backend.history(0)[-1]
+    assert backend.requests > requests
+
+
+async def test_watch(fake_keeper: Keeper, backend: FakeBackend):
+    watch = fake_keeper.watch(['@user1', DEAD_USER, 'id:5']).__aiter__()
+    received = asyncio.ensure_future(watch.__anext__())
+    while len(fake_keeper._pool) < 2:
+        await asyncio.sleep(0.01)
+    # Watched sessions stay connected beyond the pool size.
+    await fake_keeper.get(0)
+    assert len(fake_keeper._pool) == 3
+    await backend.send(0, 'not watched')
+    await backend.send(5, 'code 12345')
+    session, message = await received
+    assert (session.id, message.message) == (5, 'code 12345')
+    await watch.aclose()
+    assert fake_keeper._pool._entries[session].users == 0
+
+
+async def run_cli(monkeypatch, *args: str) -> int:
+    monkeypatch.setattr(sys, 'argv', ['session-keeper', *args])
+    monkeypatch.setenv(PASSWORD_ENV, PASSWORD)
+    return await CLIKeeper()._run()
+
+
+async def test_cli_get_once(fake_storage: str, backend: FakeBackend,
+                            monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    status = await run_cli(monkeypatch, 'get', '@user5', '--json',
+                           '--filename', fake_storage)
+    assert status == 0
+    assert [client.session.id for client in backend.clients] == [5]
+    output = json.loads(capsys.readouterr().out)
+    assert output['phone'] == '+79990000005'
+    assert output['message'] == last_message(backend, 5)
+
+
+async def test_cli_get_once_fails(fake_storage: str, backend: FakeBackend,
+                                  monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    status = await run_cli(monkeypatch, 'get', '@nobody', '--json',
+                           '--filename', fake_storage)
+    assert status == 1
+    assert capsys.readouterr().out == ''
+
+
+async def test_cli_get_once_never_prompts(fake_storage: str, monkeypatch,
+                                          capsys):
+    def closed(prompt=''):
+        raise EOFError
+
+    monkeypatch.setattr('builtins.input', closed)
+    status = await run_cli(monkeypatch, 'get', 'id:abc', '--json',
+                           '--filename', fake_storage)
+    assert status == 1
+    output = capsys.readouterr()
+    assert output.out == ''
+    assert 'incorrectly' in output.err
+
+
+async def test_metrics(fake_storage: str, backend: FakeBackend):
+    metrics = Metrics()
+    keeper = Keeper()
+    await keeper.start(PASSWORD, filename=fake_storage, client_timeout=0.1,
+                       client_factory=backend, metrics=metrics)
+    try:
+        [result async for result in keeper.get_all()]
+    finally:
+        await keeper.stop()
+    for phase in ('storage_start', 'storage_kdf', 'storage_decrypt'):
+        assert metrics[phase].count == 1
+    assert metrics['client_connect'].count == 8
+    assert metrics['client_connect'].errors == 1
+    assert metrics['client_get_messages'].count == 7
+    assert metrics['get'].count == 8
+
+
+async def test_cli_profile(fake_storage: str, backend: FakeBackend, tmp_path,
+                           monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    filename = str(tmp_path / 'keeper.prom')
+    status = await run_cli(monkeypatch, 'get', '0', '--profile',
+                           '--metrics', filename, '--filename', fake_storage)
+    assert status == 0
+    assert 'client_get_messages' in capsys.readouterr().err
+    with open(filename) as file:
+        assert 'session_keeper_phase_seconds_count{phase="get"} 1' \
+            in file.read()
+
+
+async def test_trusted_sessions_are_validated_later(
+        fake_storage: str, backend: FakeBackend
+):
+    backend.latency = 0.01
+    backend.unauthorized.update((1, 2))
+    keeper = Keeper()
+    await keeper.start(PASSWORD, filename=fake_storage, client_timeout=0.1,
+                       client_factory=backend, trust_sessions=True)
+    sessions = await keeper.list()
+    try:
+        # Only connecting, authorization is checked in the background.
+        await keeper._pool.acquire(sessions[1])
+        assert keeper.revoked == set()
+        await asyncio.gather(*keeper._tasks)
+        assert keeper.revoked == {sessions[1]}
+        assert sessions[1] not in keeper._pool
+
+        with pytest.raises(ClientUnavailable):
+            await keeper.get(2)
+        assert keeper.revoked == {sessions[1], sessions[2]}
+        assert (await keeper.get(0)).message == last_message(backend, 0)
+    finally:
+        await keeper.stop()
+
+
+async def test_revoked_session_is_flagged(fake_keeper: Keeper,
+                                          backend: FakeBackend):
+    backend.unauthorized.add(2)
+    with pytest.raises(ClientUnavailable):
+        await fake_keeper.get(2)
+    assert fake_keeper.revoked == {(await fake_keeper.list())[2]}
+
+
+async def test_import_sessions(fake_keeper: Keeper, backend: FakeBackend,
+                               tmp_path):
+    backend.unauthorized.add(21)
+    twice = dump_string_session(backend.login(20))
+    lines = [twice, twice, dump_string_session(backend.login(20)),
+             dump_string_session(backend.login(1)),
+             dump_string_session(backend.login(21)), '# comment', '',
+             '22 +79990000022 @user22 nonsense']
+    strings = tmp_path / 'sessions.txt'
+    strings.write_text('\n'.join(lines))
+    files = tmp_path / 'files'
+    files.mkdir()
+    write_session_file(backend.login(23), str(files / '23.session'))
+    (files / 'broken.session').write_bytes(b'nonsense')
+
+    results = [result async for result in fake_keeper.import_sessions(
+        iter_sources([str(strings), str(files)])
+    )]
+    statuses = {result.source: result.status for result in results}
+    assert sorted(statuses.values()) == sorted(
+        [IMPORTED] * 2 + [DUPLICATE] * 3 + [FAILED] * 3
+    )
+    assert statuses[f'{strings}:1'] == IMPORTED
+    assert statuses[f'{strings}:2'] == DUPLICATE
+    assert statuses[f'{strings}:4'] == DUPLICATE
+    assert statuses[f'{strings}:5'] == FAILED
+    assert statuses[str(files / '23.session')] == IMPORTED
+
+    storage = fake_keeper._storage
+    assert storage.get_session(23).info.mention == '@user23'
+    assert storage.get_session('+79990000020').id == 20
+    assert not storage.dirty
+    assert (await fake_keeper.get('@user20')).message \
+        == last_message(backend, 20)
+
+
+async def test_import_sessions_stops(fake_keeper: Keeper,
+                                     backend: FakeBackend, tmp_path):
+    strings = tmp_path / 'sessions.txt'
+    strings.write_text('\n'.join(dump_string_session(backend.login(id_))
+                                 for id_ in (20, 21)))
+    missing = str(tmp_path / 'missing.txt')
+    imported = []
+    with pytest.raises(FileNotFoundError):
+        async for result in fake_keeper.import_sessions(
+            iter_sources([str(strings), missing]), concurrency=1
+        ):
+            imported.append(result.session.id)
+    assert sorted(imported) == [20, 21]
+    assert fake_keeper._storage.get_session(21).id == 21
+
+    strings.write_text(dump_string_session(backend.login(22)))
+    results = fake_keeper.import_sessions(iter_sources([str(strings)]),
+                                          concurrency=1)
+    async for result in results:
+        break
+    await results.aclose()
+    assert result.status == IMPORTED
+    assert fake_keeper._storage.get_session(22).id == 22
+
+
+async def test_cli_export(fake_storage: str, backend: FakeBackend,
+                          tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    filename = str(tmp_path / 'sessions.txt')
+    directory = tmp_path / 'files'
+    directory.mkdir()
+    # Existing files are made owner-only too.
+    for path in (filename, str(directory / '5.session')):
+        with open(path, 'w'):
+            pass
+        os.chmod(path, 0o644)
+    for path in (filename, str(directory)):
+        status = await run_cli(monkeypatch, 'export', path,
+                               '--filename', fake_storage)
+        assert status == 0
+        assert capsys.readouterr().out == f'Exported 8 sessions to {path}.\n'
+    for path in [filename, *map(str, directory.iterdir())]:
+        assert os.stat(path).st_mode & 0o777 == 0o600
+    with open(filename) as file:
+        assert file.readline().startswith('0 +79990000000 @user0 1')
+
+    async with EncryptedJsonStorage(PASSWORD,
+                                    filename=fake_storage) as storage:
+        expected = [session.raw_auth_key for session in storage.sessions]
+    exported = [load().auth_key.key for _, load in iter_sources([filename])]
+    assert exported == expected
+    assert (load_session_file(str(directory / '5.session')).auth_key.key
+            == expected[5])
+
+
+async def test_cli_import(fake_storage: str, backend: FakeBackend,
+                          tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    filename = tmp_path / 'sessions.txt'
+    filename.write_text('\n'.join(dump_string_session(backend.login(user_id))
+                                  for user_id in (1, 10, 11)) + '\nnonsense')
+    status = await run_cli(monkeypatch, 'import', str(filename),
+                           '--filename', fake_storage)
+    assert status == 0
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].startswith(f'{filename}:4\tValueError')
+    assert out[1] == 'Imported 2 sessions, 1 duplicates, 1 failed.'
+
+    status = await run_cli(monkeypatch, 'get', '@user11', '--json',
+                           '--filename', fake_storage)
+    assert status == 0
+    assert json.loads(capsys.readouterr().out)['message'] \
+        == last_message(backend, 11)
+
+
+async def wait_for_health(keeper: BaseKeeper, timeout: float = 2.0) -> None:
+    sessions = keeper._storage.sessions
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not all(keeper.health(session) for session in sessions):
+        assert loop.time() < deadline
+        await asyncio.sleep(0.01)
+
+
+async def test_health_checks(fake_storage: str, backend: FakeBackend):
+    backend.unauthorized.add(2)
+    keeper = Keeper()
+    await keeper.start(PASSWORD, filename=fake_storage, client_timeout=0.1,
+                       client_factory=backend, health_interval=0.05,
+                       probe_rate=1000)
+    try:
+        await keeper.get(0)
+        await wait_for_health(keeper)
+        sessions = await keeper.list()
+        statuses = [keeper.health(session).status for session in sessions]
+        assert statuses == [OK, OK, REVOKED, UNREACHABLE, OK, OK, OK, OK]
+        assert keeper.revoked == {sessions[2]}
+        # Probes do not take places in the pool.
+        assert list(keeper._pool) == [backend.clients[0]]
+        assert keeper.health(sessions[3]).checked <= time.time()
+    finally:
+        await keeper.stop()
+
+
+async def test_health_checker_load_is_limited():
+    loop = asyncio.get_event_loop()
+    started = []
+    running = 0
+    most = 0
+
+    async def probe(session: int) -> None:
+        nonlocal running, most
+        started.append(loop.time())
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+
+    checker = HealthChecker(probe, lambda: range(10000), interval=1.0,
+                            rate=100.0, concurrency=2)
+    checker.start()
+    await asyncio.sleep(0)
+    # Removed after the round has begun.
+    checker.discard(0)
+    await asyncio.sleep(0.3)
+    await checker.close()
+    assert most == 2
+    assert len(started) <= 31
+    assert all(later - earlier >= 0.009 for earlier, later
+               in zip(started, started[1:]))
+    assert 0 not in checker and 1 in checker
+
+
+async def test_cli_list_shows_health(fake_storage: str, backend: FakeBackend,
+                                     monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    backend.unauthorized.add(2)
+    keeper = CLIKeeper()
+    await keeper.start(parse_args(['--health-interval', '0.05',
+                                   '--probe-rate', '1000', '--timeout', '0.1',
+                                   '--filename', fake_storage]), PASSWORD)
+    try:
+        await wait_for_health(keeper)
+        await keeper.list()
+        table = capsys.readouterr().out
+        assert table.count('ok, checked') == 6
+        assert 'unreachable, checked' in table
+        keeper._json = True
+        await keeper.list()
+        sessions = json.loads(capsys.readouterr().out)
+        assert sessions[2]['status'] == 'revoked'
+        assert sessions[3]['status'] == 'unreachable'
+        assert sessions[0]['checked'].endswith('+00:00')
+    finally:
+        await keeper.stop()
+
+
+async def test_remove_sessions(fake_keeper: Keeper, backend: FakeBackend):
+    backend.unauthorized.add(4)
+    await fake_keeper.get(1)
+    sessions = await fake_keeper.list()
+    results = await fake_keeper.remove_sessions(
+        [1, '@user3', 'id:4', '+79990000006', '@user1']
+    )
+    assert {result.session.id: result.ok for result in results} \
+        == {1: True, 3: False, 4: False, 6: True}
+    assert backend.unauthorized == {1, 4, 6}
+    assert len(fake_keeper._pool) == 0
+    assert sessions[3] not in fake_keeper.failures
+    assert [session.id for session in await fake_keeper.list()] \
+        == [0, 2, 5, 7]
+    assert not fake_keeper._storage.dirty
+
+    with pytest.raises(LookupError):
+        await fake_keeper.remove_sessions([0, '@nobody'])
+    assert len(await fake_keeper.list()) == 4
+
+
+async def test_remove_sessions_overlapping(fake_keeper: Keeper,
+                                           backend: FakeBackend):
+    first, second, single = await asyncio.gather(
+        fake_keeper.remove_sessions(['@user1', '@user2']),
+        fake_keeper.remove_sessions(['@user2', '@user5']),
+        fake_keeper.remove('@user5')
+    )
+    # Every session is logged out and reported by one call only.
+    assert sorted(result.session.id for result in first) == [1, 2]
+    assert [result.session.id for result in second] == [5]
+    assert single is None
+    assert backend.unauthorized == {1, 2, 5}
+    assert [session.id for session in await fake_keeper.list()] \
+        == [0, 3, 4, 6, 7]
+
+    assert (await fake_keeper.remove('@user0')).ok
+    assert 0 in backend.unauthorized
+
+
+async def test_cli_remove(fake_storage: str, backend: FakeBackend,
+                          monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    status = await run_cli(monkeypatch, 'remove', '0', '@user3', '--timeout',
+                           '0.1', '--filename', fake_storage)
+    assert status == 1
+    out = capsys.readouterr().out.splitlines()
+    assert out[0].startswith('3\t+79990000003\tLog out failed: TimeoutError')
+    assert out[1] == 'Removed 2 sessions from storage, 1 log outs failed.'
+
+    status = await run_cli(monkeypatch, 'list', '--json',
+                           '--filename', fake_storage)
+    assert [session['id'] for session in json.loads(
+        capsys.readouterr().out
+    )] == [1, 2, 4, 5, 6, 7]
+
+
+@pytest.fixture
+def stdin(monkeypatch) -> 'queue.Queue[str]':
+    lines = queue.Queue()
+    monkeypatch.setattr('builtins.input',
+                        lambda prompt='': lines.get(timeout=5))
+    return lines
+
+
+async def test_console(stdin: 'queue.Queue[str]'):
+    console = Console()
+    read = asyncio.ensure_future(console.input('> '))
+    await asyncio.sleep(0.05)
+    assert not read.done()
+    read.cancel()
+    # The line of the cancelled read is not lost.
+    stdin.put('list')
+    assert await console.input('> ') == 'list'
+    stdin.put('exit')
+    assert await console.input('> ') == 'exit'
+
+
+async def test_cli_shell_keeps_clients_running(
+        fake_storage: str, backend: FakeBackend, monkeypatch, capsys,
+        stdin: 'queue.Queue[str]'
+):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    shell = asyncio.ensure_future(run_cli(monkeypatch, '--filename',
+                                          fake_storage))
+    stdin.put('get 0')
+    while not backend.requests:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.05)
+    # Delivered while the shell waits for a command.
+    await backend.send(0, 'Sent while typing')
+    requests = backend.requests
+    stdin.put('get 0')
+    stdin.put('exit')
+    assert await asyncio.wait_for(shell, 5) == 0
+    assert backend.requests == requests
+    assert capsys.readouterr().out.count('Sent while typing') == 1
+
+
+async def test_agent(fake_keeper: Keeper, backend: FakeBackend, tmp_path):
+    backend.latency = 0.02
+    path = str(tmp_path / 'keeper.sock')
+    agent = KeeperAgent(fake_keeper, cache_ttl=0.2)
+    await agent.start(path)
+    try:
+        assert os.stat(path).st_mode & 0o777 == 0o600
+        with pytest.raises(AgentError):
+            await KeeperAgent(fake_keeper).start(path)
+
+        clients = [AgentClient(path) for _ in range(5)]
+        for client in clients:
+            await client.connect()
+        messages = await asyncio.gather(*(client.get('@user5')
+                                          for client in clients))
+        # Connecting, get_me and a single get_messages.
+        assert backend.requests == 3
+        assert {message['message'] for message in messages} \
+            == {last_message(backend, 5)}
+
+        session = fake_keeper._storage.get_session(5)
+        fake_keeper._messages.discard(session)
+        await clients[0].get(5)
+        assert backend.requests == 3
+        await backend.send(5, 'Newer')
+        assert (await clients[0].get('id:5'))['message'] == 'Newer'
+        fake_keeper._messages.discard(session)
+        await asyncio.sleep(0.2)
+        await clients[0].get('@user5')
+        assert backend.requests == 4
+
+        agent_client = clients[1]
+        sessions = await agent_client.list()
+        assert [session['id'] for session in sessions] == list(range(8))
+        assert sessions[5]['mention'] == '@user5'
+        with pytest.raises(AgentError, match='no session'):
+            await agent_client.get('@nobody')
+        removed = await agent_client.remove('@user1', '+79990000003')
+        assert [(session['id'], session['logged_out'])
+                for session in removed] == [(1, True), (3, False)]
+        assert len(await agent_client.list()) == 6
+
+        reader, writer = await asyncio.open_unix_connection(path)
+        writer.write(b'nonsense\n{"id": 7, "command": "get"}\n')
+        responses = [json.loads(await reader.readline()) for _ in range(2)]
+        assert [response['ok'] for response in responses] == [False, False]
+        assert responses[1]['id'] == 7
+        writer.close()
+        for client in clients:
+            await client.close()
+    finally:
+        await agent.close()
+    assert not os.path.exists(path)
+
+
+async def test_cli_agent(fake_storage: str, backend: FakeBackend, tmp_path,
+                         monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    path = str(tmp_path / 'keeper.sock')
+    agent = asyncio.ensure_future(run_cli(monkeypatch, '--agent', path,
+                                          '--filename', fake_storage))
+    while not os.path.exists(path):
+        await asyncio.sleep(0.01)
+    async with AgentClient(path) as client:
+        assert (await client.get('@user2'))['message'] \
+            == last_message(backend, 2)
+    os.kill(os.getpid(), signal.SIGTERM)
+    assert await asyncio.wait_for(agent, 5) == 0
+    assert not os.path.exists(path)
+    assert capsys.readouterr().out.startswith('Agent is listening')
+
+
+async def test_cli_migrate(fake_storage: str, backend: FakeBackend, tmp_path,
+                           monkeypatch, capsys):
+    monkeypatch.setattr(base, 'TelegramClient', backend)
+    filename = str(tmp_path / 'sessions.db')
+    metrics = str(tmp_path / 'metrics.json')
+    status = await run_cli(monkeypatch, 'list', '--json', '--migrate',
+                           fake_storage, '--filename', filename,
+                           '--metrics', metrics)
+    assert status == 0
+    assert len(json.loads(capsys.readouterr().out.splitlines()[-1])) == 8
+    with open(metrics) as file:
+        # Only the source storage derives the key.
+        assert json.load(file)['storage_kdf']['count'] == 1
+
+    status = await run_cli(monkeypatch, 'list', '--migrate', fake_storage,
+                           '--filename', filename)
+    assert status == 1
+    assert 'already exists' in capsys.readouterr().out
+
+
+async def test_cli_migrate_missing_source(tmp_path, monkeypatch, capsys):
+    filename = str(tmp_path / 'sessions.db')
+    status = await run_cli(monkeypatch, 'list', '--migrate',
+                           str(tmp_path / 'missing.tgsk'),
+                           '--filename', filename)
+    assert status == 1
+    assert 'does not exist' in capsys.readouterr().out
+    assert not os.path.exists(filename)
@@ -0,0 +1,58 @@
+import json
+import os
+
+import pytest
+from session_keeper.metrics import Histogram, Metrics, NULL_METRICS
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1.0))
+    for seconds in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(seconds)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.count == 4
+    assert histogram.sum == pytest.approx(2.65)
+    assert histogram.max == 2.0
+    assert histogram.quantile(0.5) == pytest.approx(0.1)
+    assert histogram.quantile(0.75) == pytest.approx(1.0)
+    assert histogram.quantile(1.0) == 2.0
+
+
+def test_timer_counts_errors():
+    metrics = Metrics()
+    with metrics.timer('ok'):
+        pass
+    with pytest.raises(ValueError), metrics.timer('failed'):
+        raise ValueError
+    assert list(metrics) == ['ok', 'failed']
+    assert (metrics['ok'].count, metrics['ok'].errors) == (1, 0)
+    assert (metrics['failed'].count, metrics['failed'].errors) == (1, 1)
+
+
+def test_null_metrics():
+    with NULL_METRICS.timer('phase'):
+        pass
+    assert 'phase' not in NULL_METRICS
+
+
+def test_dump(tmp_path):
+    metrics = Metrics((0.1,))
+    metrics.observe('get', 0.05)
+    metrics.observe('get', 0.5, ValueError())
+
+    metrics.dump(str(tmp_path / 'metrics.prom'))
+    assert os.stat(tmp_path / 'metrics.prom').st_mode & 0o777 == 0o644
+    with open(tmp_path / 'metrics.prom') as file:
+        lines = file.read().splitlines()
+    assert 'session_keeper_phase_seconds_bucket{phase="get",le="0.1"} 1' \
+        in lines
+    assert 'session_keeper_phase_seconds_bucket{phase="get",le="+Inf"} 2' \
+        in lines
+    assert 'session_keeper_phase_seconds_count{phase="get"} 2' in lines
+    assert 'session_keeper_phase_errors_total{phase="get"} 1' in lines
+
+    metrics.dump(str(tmp_path / 'metrics.json'))
+    with open(tmp_path / 'metrics.json') as file:
+        data = json.load(file)
+    assert data['get']['buckets'] == {'0.1': 1, '+Inf': 1}
+    assert data['get']['errors'] == 1
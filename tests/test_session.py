@@ -1,5 +1,8 @@
+from typing import Callable
+
 from session_keeper.session import KeeperSession, Session
 from telethon import TelegramClient
+from telethon.tl.types import User
 
 
 def test_session_as_dict(client_with_session: TelegramClient):
@@ -13,3 +16,27 @@ def test_keeper_session_init(client_with_session: TelegramClient):
     auth_key = session.as_dict()['auth_key']
     KeeperSession(dc_id=session.dc_id, server_address=session.server_address,
                   server_port=session.port, auth_key=auth_key)
+
+
+def test_session_info_is_cached(make_session: Callable[..., Session]):
+    session = make_session(1)
+    info = session.info
+    session.process_entities([User(777000, access_hash=0, first_name='Tg')])
+    assert session.info is info
+    assert (session.id, session.phone, session.mention) == (
+        1, '+79990000001', '@user1'
+    )
+    assert not hasattr(info, '__dict__')
+
+
+def test_keeper_session_auth_key_is_lazy(
+        make_session: Callable[..., Session]
+):
+    data = make_session(1).as_dict()
+    session = KeeperSession(**data)
+    assert session.as_dict() == data
+    assert session._auth_key is None
+
+    key = session.auth_key
+    assert key.key == session.raw_auth_key
+    assert session.auth_key is key
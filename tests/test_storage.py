@@ -1,11 +1,23 @@
+import asyncio
+import base64 as b64
+import json
+import os
+import time
 from tempfile import NamedTemporaryFile
-from typing import Iterator
+from typing import Callable, Iterator
 
 import pytest
-from session_keeper.storage import (EncryptedJsonStorage,
-                                    InvalidPassword, MismatchedVersionError,
+from cryptography.fernet import Fernet
+from session_keeper.session import KeeperSession, Session
+from session_keeper.storage import (AmbiguousSession, EncryptedJsonStorage,
+                                    InvalidPassword, kdf,
+                                    MismatchedVersionError,
+                                    SessionExistsError, SessionNotFound,
+                                    sharded, ShardedStorage, SqliteStorage,
                                     StorageNotFound, StorageSettedError)
 from telethon import TelegramClient
+from telethon.crypto import AuthKey
+from telethon.tl.types import User
 
 
 PASSWORD = 'qwerty'
@@ -31,6 +43,45 @@ async def storage_with_session(
     return storage
 
 
+@pytest.fixture
+async def offline_storage(
+        temp_file: str, make_session: Callable[..., Session]
+) -> Iterator[EncryptedJsonStorage]:
+    storage = EncryptedJsonStorage(PASSWORD, filename=temp_file)
+    await storage.setup(1, 'hash')
+    for user_id in range(4):
+        await storage.add_session(make_session(user_id))
+    await storage.flush()
+    yield storage
+    await storage.stop()
+
+
+@pytest.fixture
+async def sharded_storage(
+        tmp_path, make_session: Callable[..., Session]
+) -> Iterator[ShardedStorage]:
+    storage = ShardedStorage(PASSWORD, filename=str(tmp_path / 'sessions'),
+                             shards=4)
+    await storage.setup(1, 'hash')
+    for user_id in range(10):
+        await storage.add_session(make_session(user_id))
+    await storage.flush()
+    yield storage
+    await storage.stop()
+
+
+@pytest.fixture
+async def sqlite_storage(
+        tmp_path, make_session: Callable[..., Session]
+) -> Iterator[SqliteStorage]:
+    storage = SqliteStorage(PASSWORD, filename=str(tmp_path / 'sessions.db'))
+    await storage.setup(1, 'hash')
+    for user_id in range(4):
+        await storage.add_session(make_session(user_id))
+    yield storage
+    await storage.stop()
+
+
 @pytest.fixture
 def storage_file() -> Iterator[str]:
     with NamedTemporaryFile('wb') as file:
@@ -57,7 +108,7 @@ async def test_encrypt_and_decrypt(storage_with_session: EncryptedJsonStorage):
 
 async def test_remove_session(storage_with_session: EncryptedJsonStorage):
     storage = storage_with_session
-    await storage.remove_session(0)
+    await storage.remove_session(storage.sessions[0])
     assert len(storage.sessions) == 0
 
 
@@ -86,3 +137,537 @@ async def test_invalid_password(storage: EncryptedJsonStorage):
                                     filename=storage.filename)
     with pytest.raises(InvalidPassword):
         await storage2.start()
+
+
+async def test_add_and_remove_append_records(
+        offline_storage: EncryptedJsonStorage
+):
+    size = os.path.getsize(offline_storage.filename)
+    await offline_storage.remove_session(offline_storage.sessions[1])
+    await offline_storage.flush()
+    assert os.path.getsize(offline_storage.filename) > size
+    assert offline_storage.garbage == 3
+
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert [session.id for session in storage.sessions] == [0, 2, 3]
+        assert storage.garbage == 3
+
+
+async def test_torn_record_is_ignored(offline_storage: EncryptedJsonStorage):
+    with open(offline_storage.filename, 'ab') as file:
+        file.write(b'gAAAAAB')
+    storage = EncryptedJsonStorage(PASSWORD,
+                                   filename=offline_storage.filename)
+    await storage.start()
+    assert len(storage.sessions) == 4
+
+
+async def test_append_after_torn_record(
+        offline_storage: EncryptedJsonStorage,
+        make_session: Callable[..., Session]
+):
+    await offline_storage.stop()
+    size = os.path.getsize(offline_storage.filename)
+    await offline_storage.add_session(make_session(4))
+    await offline_storage.flush()
+    # Cut the append inside its metadata frame, whose length prefix would
+    # swallow the records appended after it.
+    with open(offline_storage.filename, 'r+b') as file:
+        file.truncate(os.path.getsize(offline_storage.filename) - 10)
+
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert len(storage.sessions) == 4
+        assert storage.dirty
+        await storage.add_session(make_session(5))
+    assert os.path.getsize(offline_storage.filename) > size
+
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert [session.id for session in storage.sessions] == [0, 1, 2, 3, 5]
+        assert not storage.dirty
+
+
+async def test_compact(offline_storage: EncryptedJsonStorage):
+    for _ in range(3):
+        await offline_storage.remove_session(offline_storage.sessions[0])
+    size = os.path.getsize(offline_storage.filename)
+    await offline_storage.stop()
+    assert os.path.getsize(offline_storage.filename) < size
+    assert offline_storage.garbage == 0
+
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert [session.id for session in storage.sessions] == [3]
+
+
+async def test_migrate_legacy_version(
+        offline_storage: EncryptedJsonStorage
+):
+    data = {'api_id': 1, 'api_hash': 'hash',
+            'sessions': [session.as_dict()
+                         for session in offline_storage.sessions]}
+    data = b64.urlsafe_b64encode(json.dumps(data).encode())
+    fernet = Fernet(kdf.derive(PASSWORD, kdf.LEGACY_HEADER))
+    with open(offline_storage.filename, 'wb') as file:
+        file.write(b'1' + fernet.encrypt(data))
+
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert len(storage.sessions) == 4
+        assert storage.kdf_header['salt']
+    with open(offline_storage.filename, 'rb') as file:
+        assert file.read(1) == b'5'
+
+
+async def test_kdf_header(offline_storage: EncryptedJsonStorage):
+    with open(offline_storage.filename, 'rb') as file:
+        header = json.loads(file.readline()[1:])
+    assert header == offline_storage.kdf_header
+    assert kdf.cost(header) == kdf.DEFAULT_COST
+
+    kdf_cost = {'algorithm': kdf.PBKDF2, 'iterations': 1000}
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename, kdf_cost=kdf_cost
+    ) as storage:
+        assert kdf.cost(storage.kdf_header) == kdf_cost
+        assert storage.kdf_header['salt'] != header['salt']
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert [session.raw_auth_key for session in storage.sessions] == [
+            session.raw_auth_key for session in offline_storage.sessions
+        ]
+
+
+async def test_auth_keys_are_decrypted_lazily(
+        offline_storage: EncryptedJsonStorage
+):
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert all(callable(session._auth_key_data)
+                   for session in storage.sessions)
+        assert storage.get_session('@user1').id == 1
+        await storage.save()
+        assert all(callable(session._auth_key_data)
+                   for session in storage.sessions)
+        expected = offline_storage.sessions[1].raw_auth_key
+        assert storage.sessions[1].auth_key.key == expected
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert storage.sessions[1].raw_auth_key == expected
+
+
+def test_kdf_calibrate():
+    kdf_cost = kdf.calibrate(0.01, kdf.PBKDF2)
+    assert kdf_cost['iterations'] >= kdf.MIN_PBKDF2_ITERATIONS
+    kdf_cost = kdf.calibrate(0.01)
+    assert kdf_cost['n'] == kdf.MIN_SCRYPT_N
+    assert kdf_cost['p'] >= 1
+
+
+async def test_write_behind(offline_storage: EncryptedJsonStorage,
+                            make_session: Callable[..., Session]):
+    size = os.path.getsize(offline_storage.filename)
+    for user_id in range(4, 8):
+        await offline_storage.add_session(make_session(user_id))
+    assert offline_storage.dirty
+    assert os.path.getsize(offline_storage.filename) == size
+
+    await asyncio.sleep(offline_storage._save_delay * 2)
+    assert not offline_storage.dirty
+    assert os.path.getsize(offline_storage.filename) > size
+
+
+async def test_stop_skips_clean_storage(
+        offline_storage: EncryptedJsonStorage
+):
+    inode = os.stat(offline_storage.filename).st_ino
+    mtime = os.stat(offline_storage.filename).st_mtime_ns
+    await offline_storage.stop()
+    assert os.stat(offline_storage.filename).st_ino == inode
+    assert os.stat(offline_storage.filename).st_mtime_ns == mtime
+
+
+async def test_save_replaces_file(offline_storage: EncryptedJsonStorage):
+    inode = os.stat(offline_storage.filename).st_ino
+    await offline_storage.save()
+    assert os.stat(offline_storage.filename).st_ino != inode
+    directory = os.path.dirname(offline_storage.filename)
+    assert not [name for name in os.listdir(directory)
+                if name.startswith('.tgsk-')]
+
+
+async def test_compressed_snapshot(offline_storage: EncryptedJsonStorage,
+                                   make_session: Callable[..., Session]):
+    session = make_session(4, server_address='2001:b28:f23d:f001::a')
+    await offline_storage.add_session(session)
+    await offline_storage.save()
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename, compress=True
+    ) as storage:
+        await storage.save()
+        loaded = storage.sessions[-1]
+        assert loaded.server_address == session.server_address
+        assert loaded.auth_key.key == session.auth_key.key
+        assert (loaded.id, loaded.phone, loaded.mention) == (
+            session.id, session.phone, session.mention
+        )
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert len(storage.sessions) == 5
+
+
+async def test_get_session(offline_storage: EncryptedJsonStorage):
+    session = offline_storage.sessions[2]
+    assert offline_storage.get_session(2) is session
+    assert offline_storage.get_session('+79990000002') is session
+    assert offline_storage.get_session('@user2') is session
+
+    await offline_storage.remove_session(session)
+    for key in (2, '+79990000002', '@user2'):
+        with pytest.raises(SessionNotFound):
+            offline_storage.get_session(key)
+
+    async with EncryptedJsonStorage(
+            PASSWORD, filename=offline_storage.filename
+    ) as storage:
+        assert storage.get_session('@user3').id == 3
+
+
+async def test_repeated_mention(offline_storage: EncryptedJsonStorage,
+                                sqlite_storage: SqliteStorage):
+    # Without a username the mention is the display name.
+    def ivan(user_id: int) -> Session:
+        session = Session()
+        session.set_dc(2, '149.154.167.40', 443)
+        session.auth_key = AuthKey(os.urandom(256))
+        session.process_entities([User(user_id, access_hash=0,
+                                       phone=f'7999{user_id:07d}',
+                                       first_name='Ivan')])
+        return session
+
+    for storage in (offline_storage, sqlite_storage):
+        first, second = ivan(10), ivan(11)
+        await storage.add_session(first)
+        assert storage.get_session('Ivan') is first
+        await storage.add_session(second)
+        with pytest.raises(AmbiguousSession):
+            storage.get_session('Ivan')
+        assert storage.get_session(11) is second
+
+        await storage.remove_session(first)
+        assert storage.get_session('Ivan') is second
+        await storage.remove_session(second)
+        with pytest.raises(SessionNotFound):
+            storage.get_session('Ivan')
+
+
+async def test_add_existing_session(offline_storage: EncryptedJsonStorage,
+                                    make_session: Callable[..., Session]):
+    with pytest.raises(SessionExistsError):
+        await offline_storage.add_session(make_session(1))
+    assert len(offline_storage.sessions) == 4
+
+
+async def test_add_sessions(offline_storage: EncryptedJsonStorage,
+                            sqlite_storage: SqliteStorage,
+                            make_session: Callable[..., Session]):
+    for storage in (offline_storage, sqlite_storage):
+        with pytest.raises(SessionExistsError):
+            await storage.add_sessions([make_session(4), make_session(1)])
+        with pytest.raises(SessionExistsError):
+            await storage.add_sessions([make_session(4), make_session(4)])
+        assert len(storage.sessions) == 4
+        await storage.add_sessions(make_session(user_id)
+                                   for user_id in range(4, 7))
+        assert storage.get_session('@user6').id == 6
+
+    assert not offline_storage.dirty
+    for storage_class, filename in (
+            (EncryptedJsonStorage, offline_storage.filename),
+            (SqliteStorage, sqlite_storage.filename)
+    ):
+        async with storage_class(PASSWORD, filename=filename) as storage:
+            assert [session.id for session in storage.sessions] \
+                == list(range(7))
+
+
+async def test_remove_sessions(offline_storage: EncryptedJsonStorage,
+                               sharded_storage: ShardedStorage,
+                               sqlite_storage: SqliteStorage):
+    storages = (offline_storage, sharded_storage, sqlite_storage)
+    for storage, other in zip(storages, storages[1:] + storages[:1]):
+        sessions = storage.sessions
+        with pytest.raises(SessionNotFound):
+            await storage.remove_sessions([sessions[0], other.sessions[0]])
+        assert storage.sessions == sessions
+        await storage.remove_sessions([sessions[1], sessions[3],
+                                       sessions[1]])
+        expected = [session.id for session in sessions
+                    if session.id not in (1, 3)]
+        assert [session.id for session in storage.sessions] == expected
+
+        async with type(storage)(PASSWORD,
+                                 filename=storage.filename) as reopened:
+            assert [session.id for session in reopened.sessions] == expected
+
+
+async def test_sharded_storage(sharded_storage: ShardedStorage):
+    directory = os.path.dirname(sharded_storage.filename)
+    assert sorted(os.listdir(directory)) == [
+        'sessions', *(f'sessions.1.{index}' for index in range(4))
+    ]
+    async with ShardedStorage(
+            PASSWORD, filename=sharded_storage.filename
+    ) as storage:
+        assert storage.shards == 4
+        assert storage.api_id == 1
+        assert [session.id for session in storage.sessions] == [*range(10)]
+        assert all(callable(session._auth_key_data)
+                   for session in storage.sessions)
+        assert [session.raw_auth_key for session in storage.sessions] == [
+            session.raw_auth_key for session in sharded_storage.sessions
+        ]
+
+    with pytest.raises(InvalidPassword):
+        await ShardedStorage('invalid password',
+                             filename=sharded_storage.filename).start()
+    with pytest.raises(MismatchedVersionError):
+        await EncryptedJsonStorage(PASSWORD,
+                                   filename=sharded_storage.filename).start()
+
+
+async def test_sharded_storage_rewrites_changed_shards(
+        sharded_storage: ShardedStorage, make_session: Callable[..., Session]
+):
+    def inodes() -> list:
+        return [os.stat(sharded_storage._shard_filename(index)).st_ino
+                for index in range(4)]
+
+    before = inodes()
+    await sharded_storage.add_session(make_session(10))
+    await sharded_storage.remove_session(sharded_storage.get_session(3))
+    assert sharded_storage.dirty
+    await sharded_storage.flush()
+    after = inodes()
+    # Record keys 10 and 3 fall into shards 2 and 3.
+    assert after[:2] == before[:2]
+    assert after[2] != before[2] and after[3] != before[3]
+
+    async with ShardedStorage(
+            PASSWORD, filename=sharded_storage.filename
+    ) as storage:
+        assert [session.id for session in storage.sessions] == [
+            0, 1, 2, 4, 5, 6, 7, 8, 9, 10
+        ]
+
+
+async def test_sharded_storage_reshard(sharded_storage: ShardedStorage):
+    async with ShardedStorage(
+            PASSWORD, filename=sharded_storage.filename, shards=3
+    ) as storage:
+        assert storage.shards == 3
+    directory = os.path.dirname(sharded_storage.filename)
+    assert sorted(os.listdir(directory)) == [
+        'sessions', *(f'sessions.2.{index}' for index in range(3))
+    ]
+    async with ShardedStorage(
+            PASSWORD, filename=sharded_storage.filename
+    ) as storage:
+        assert storage.shards == 3
+        assert len(storage.sessions) == 10
+
+
+async def test_sharded_storage_worker_processes(
+        sharded_storage: ShardedStorage, monkeypatch: pytest.MonkeyPatch,
+        make_session: Callable[..., Session]
+):
+    monkeypatch.setattr(sharded, 'PARALLEL_THRESHOLD', 0)
+    storage = ShardedStorage(PASSWORD, filename=sharded_storage.filename,
+                             processes=2)
+    await storage.start()
+    assert storage._executor is not None
+    assert storage.get_session('@user7').raw_auth_key == (
+        sharded_storage.get_session('@user7').raw_auth_key
+    )
+    await storage.add_session(make_session(10))
+    await storage.stop()
+    assert storage._executor is None
+
+    async with ShardedStorage(
+            PASSWORD, filename=sharded_storage.filename
+    ) as storage:
+        assert len(storage.sessions) == 11
+
+
+async def test_sqlite_storage(sqlite_storage: SqliteStorage,
+                              make_session: Callable[..., Session]):
+    with pytest.raises(SessionExistsError):
+        await sqlite_storage.add_session(make_session(1))
+    await sqlite_storage.remove_session(sqlite_storage.get_session(2))
+    expected = sqlite_storage.get_session('@user3').raw_auth_key
+
+    async with SqliteStorage(
+            PASSWORD, filename=sqlite_storage.filename
+    ) as storage:
+        assert (storage.api_id, storage.api_hash) == (1, 'hash')
+        session = storage.get_session('+79990000003')
+        assert session.id == 3
+        assert storage.get_session(3) is session
+        # Only the row found is decrypted.
+        assert len(storage._sessions) == 1
+        assert callable(session._auth_key_data)
+        assert session.raw_auth_key == expected
+        assert [session.id for session in storage.sessions] == [0, 1, 3]
+        assert storage.sessions[2] is session
+        with pytest.raises(SessionNotFound):
+            storage.get_session('@user2')
+
+        await storage.add_session(make_session(2))
+        assert storage.sessions[-1].id == 2
+
+    with open(sqlite_storage.filename, 'rb') as file:
+        data = file.read()
+    assert b'user1' not in data and b'79990000001' not in data
+
+
+async def test_sqlite_storage_errors(sqlite_storage: SqliteStorage,
+                                     storage_file: str):
+    with pytest.raises(InvalidPassword):
+        await SqliteStorage('invalid password',
+                            filename=sqlite_storage.filename).start()
+    with pytest.raises(MismatchedVersionError):
+        await SqliteStorage(PASSWORD, filename=storage_file).start()
+
+
+async def test_sqlite_storage_rekey(sqlite_storage: SqliteStorage):
+    expected = sqlite_storage.get_session('@user1').raw_auth_key
+    kdf_cost = {'algorithm': kdf.PBKDF2, 'iterations': 1000}
+    async with SqliteStorage(
+            PASSWORD, filename=sqlite_storage.filename, kdf_cost=kdf_cost
+    ) as storage:
+        assert kdf.cost(storage.kdf_header) == kdf_cost
+    async with SqliteStorage(
+            PASSWORD, filename=sqlite_storage.filename
+    ) as storage:
+        assert storage.get_session('@user1').raw_auth_key == expected
+
+
+async def test_sqlite_storage_migrate(offline_storage: EncryptedJsonStorage,
+                                      tmp_path):
+    filename = str(tmp_path / 'sessions.db')
+    storage = SqliteStorage(PASSWORD, filename=filename)
+    await storage.migrate(offline_storage.filename)
+    await storage.stop()
+
+    async with SqliteStorage(PASSWORD, filename=filename) as storage:
+        assert storage.kdf_header == offline_storage.kdf_header
+        assert storage.api_id == offline_storage.api_id
+        assert [session.raw_auth_key for session in storage.sessions] == [
+            session.raw_auth_key for session in offline_storage.sessions
+        ]
+        assert storage.get_session('@user2').id == 2
+        with pytest.raises(StorageSettedError):
+            await storage.migrate(offline_storage.filename)
+
+
+async def test_sqlite_storage_load_sessions(
+        sqlite_storage: SqliteStorage, make_session: Callable[..., Session]
+):
+    await sqlite_storage.add_sessions([make_session(4), make_session(5)])
+    auth_keys = [session.auth_key.key for session in sqlite_storage.sessions]
+    await sqlite_storage.stop()
+
+    async with SqliteStorage(PASSWORD,
+                             filename=sqlite_storage.filename) as storage:
+        found = storage.get_session('@user2')
+        await storage.load_sessions()
+        assert storage.sessions[2] is found
+        await storage.remove_session(storage.sessions[0])
+        await storage.rekey()
+    async with SqliteStorage(PASSWORD,
+                             filename=sqlite_storage.filename) as storage:
+        await storage.load_sessions()
+        assert [session.raw_auth_key for session in storage.sessions] \
+            == auth_keys[1:]
+
+
+async def test_sqlite_storage_migrate_fails(
+        offline_storage: EncryptedJsonStorage, tmp_path
+):
+    filename = str(tmp_path / 'sessions.db')
+    with pytest.raises(StorageNotFound):
+        await SqliteStorage(PASSWORD, filename=filename).migrate(
+            str(tmp_path / 'missing.tgsk')
+        )
+    with pytest.raises(InvalidPassword):
+        await SqliteStorage('invalid password', filename=filename).migrate(
+            offline_storage.filename
+        )
+    assert not [name for name in os.listdir(tmp_path)
+                if name.startswith('sessions.db')]
+
+
+async def test_sqlite_storage_migrate_legacy(
+        offline_storage: EncryptedJsonStorage, tmp_path
+):
+    data = {'api_id': 1, 'api_hash': 'hash',
+            'sessions': [session.as_dict()
+                         for session in offline_storage.sessions]}
+    data = b64.urlsafe_b64encode(json.dumps(data).encode())
+    fernet = Fernet(kdf.derive(PASSWORD, kdf.LEGACY_HEADER))
+    with open(offline_storage.filename, 'wb') as file:
+        file.write(b'1' + fernet.encrypt(data))
+    with open(offline_storage.filename, 'rb') as file:
+        legacy = file.read()
+
+    filename = str(tmp_path / 'sessions.db')
+    storage = SqliteStorage(PASSWORD, filename=filename)
+    await storage.migrate(offline_storage.filename)
+    await storage.stop()
+    # The source is only read.
+    with open(offline_storage.filename, 'rb') as file:
+        assert file.read() == legacy
+
+    async with SqliteStorage(PASSWORD, filename=filename) as storage:
+        assert storage.kdf_header['salt']
+        assert len(storage.sessions) == 4
+
+
+async def test_save_keeps_loop_responsive(temp_file: str):
+    storage = EncryptedJsonStorage(Fernet.generate_key(), filename=temp_file)
+    await storage.setup(1, 'hash')
+    storage._load({user_id: KeeperSession(
+        id=user_id, phone=f'+7999{user_id:07d}', mention=f'@user{user_id}',
+        dc_id=2, server_address='149.154.167.40', port=443,
+        auth_key=os.urandom(256)
+    ) for user_id in range(30_000)})
+    gaps = []
+
+    async def tick() -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            gaps.append(time.perf_counter() - started)
+
+    ticker = asyncio.ensure_future(tick())
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await storage.save()
+    storage = EncryptedJsonStorage(storage._key, filename=temp_file)
+    await storage.start()
+    elapsed = time.perf_counter() - started
+    ticker.cancel()
+    assert len(storage.sessions) == 30_000
+    # Blocking the loop would stall it for the whole save and start.
+    assert gaps and max(gaps) < elapsed / 4